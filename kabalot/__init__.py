@@ -0,0 +1 @@
+"""Extract receipts and invoices with the OpenAI API, upload them to Dropbox and summarize them in Excel."""
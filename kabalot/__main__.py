@@ -0,0 +1,3 @@
+from kabalot.cli import main
+
+main()
@@ -0,0 +1,380 @@
+"""Batch mode: extract through the OpenAI Batch API, resuming batches a previous run left in flight."""
+
+import hashlib
+import itertools
+import json
+import os
+import time
+from datetime import datetime
+from types import SimpleNamespace
+
+from kabalot.cache import (count_cache_event, get_cache_key, get_cache_settings, read_cached_extraction,
+    store_cached_extraction)
+from kabalot.config import test_config
+from kabalot.core import (check_invoice_total, fits_document_request, get_checked_page_data, get_checkpointed_page,
+    get_document_settings, read_page_checkpoint)
+from kabalot.metrics import record_model_call, record_stage
+from kabalot.prompt import get_document_request, get_extraction_request, get_mock_invoice_json
+from kabalot.ratelimit import get_openai_client
+from kabalot.render import iter_file_pages
+from kabalot.writer import upload_and_write_invoice
+
+DEFAULT_BATCH_SETTINGS = {
+    "dir": "./batch",
+    "poll_interval_sec": 60,
+    "completion_window": "24h",
+    # The Batch API accepts up to 50,000 requests and 200 MB per input file
+    "max_requests_per_batch": 50000,
+    "max_batch_file_mb": 190,
+}
+
+BATCH_TERMINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+def get_batch_settings(config):
+    settings = dict(DEFAULT_BATCH_SETTINGS)
+    settings.update(config.get("batch", {}))
+    return settings
+
+def get_batch_state_path(settings):
+    return os.path.join(settings["dir"], "state.json")
+
+def load_batch_state(settings):
+    state_path = get_batch_state_path(settings)
+    if not os.path.exists(state_path):
+        return None
+    with open(state_path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def save_batch_state(settings, state):
+    # Write to a temp file first so a crash never leaves a half written state behind
+    state_path = get_batch_state_path(settings)
+    temp_path = f"{state_path}.tmp"
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(state, f, ensure_ascii=False, indent=4)
+    os.replace(temp_path, state_path)
+
+def get_batch_client(settings):
+    if test_config and test_config.get("mock_openai"):
+        return MockBatchClient(os.path.join(settings["dir"], "mock"))
+    return get_openai_client()
+
+def prepare_batch_requests(config, file_paths, settings, state=None):
+    """Render every page into chunked JSONL batch input files and record which file and page each request is for.
+
+    Pages already in the extraction cache are stored with the results right
+    away and don't go into the batch. Given the state of a resumed run, the
+    files it doesn't have yet go into new chunks of it.
+    """
+    cache_settings = get_cache_settings(config)
+    use_cache = cache_settings["enabled"] and not (test_config and test_config.get("mock_openai"))
+    max_bytes = settings["max_batch_file_mb"] * 1024 * 1024
+    if state is None:
+        state = {
+            "run_id": datetime.now().strftime('%Y%m%d_%H%M%S_%f'),
+            "files": [],
+            # Page count per file, "doc" for a single whole-document request, None if rendering failed
+            "pages": {},
+            "cache_keys": {},
+            "batches": [],
+        }
+        os.makedirs(settings["dir"], exist_ok=True)
+        results_path = os.path.join(settings["dir"], "results.jsonl")
+        if os.path.exists(results_path):
+            os.remove(results_path)
+    file_paths = [file_path for file_path in file_paths if file_path not in state["pages"]]
+    chunk_count = len(state["batches"])
+
+    chunk = None
+
+    def add_request(custom_id, body, key):
+        nonlocal chunk
+        if key is not None:
+            state["cache_keys"][custom_id] = key
+            invoice_json = read_cached_extraction(cache_settings, key)
+            if invoice_json is not None:
+                count_cache_event("hits")
+                store_batch_results(settings, {custom_id: invoice_json})
+                return
+            count_cache_event("misses")
+
+        line = json.dumps({
+            "custom_id": custom_id,
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": body,
+        }, ensure_ascii=False) + "\n"
+        line_bytes = len(line.encode('utf-8'))
+        if (chunk is None or chunk["requests"] >= settings["max_requests_per_batch"]
+                or chunk["bytes"] + line_bytes > max_bytes):
+            if chunk is not None:
+                chunk["file"].close()
+            input_path = os.path.join(settings["dir"], f"input_{len(state['batches'])}.jsonl")
+            chunk = {"file": open(input_path, 'w', encoding='utf-8'), "requests": 0, "bytes": 0}
+            state["batches"].append({"input_path": input_path, "input_file_id": None, "batch_id": None, "status": None})
+        chunk["file"].write(line)
+        chunk["requests"] += 1
+        chunk["bytes"] += line_bytes
+
+    document_settings = get_document_settings(config)
+    for file_path in file_paths:
+        print(f"Processing file: {file_path}")
+        if not os.path.isfile(file_path):
+            print(f"Skipping {file_path}, not a file.")
+            continue
+        # Files that fail keep their number, so request ids are never reused
+        seq = len(state["files"])
+        state["files"].append(file_path)
+        state["pages"][file_path] = None
+        try:
+            pages = iter_file_pages(config, file_path)
+            first_pages = []
+            if document_settings["enabled"]:
+                first_pages = list(itertools.islice(pages, document_settings["max_pages"] + 1))
+                if fits_document_request(document_settings, first_pages):
+                    key = get_cache_key(first_pages, document=True) if use_cache else None
+                    add_request(f"{seq}-doc", get_document_request(first_pages), key)
+                    state["pages"][file_path] = "doc"
+                    continue
+            page_count = 0
+            for page_num, page in enumerate(itertools.chain(first_pages, pages)):
+                key = get_cache_key([page]) if use_cache else None
+                add_request(f"{seq}-{page_num}", get_extraction_request(page), key)
+                page_count += 1
+            state["pages"][file_path] = page_count
+        except Exception as e:
+            print(f"Error processing file {file_path}: {str(e)}")
+    if chunk is not None:
+        chunk["file"].close()
+
+    save_batch_state(settings, state)
+    print(f"Prepared {len(state['batches']) - chunk_count} batch input files for {len(file_paths)} files")
+    return state
+
+def submit_batches(batch_client, settings, state):
+    """Upload and create every batch that isn't created yet, saving the state after each step.
+
+    A batch created right before a crash is found again through its metadata
+    instead of being submitted twice. Only a chunk whose input was uploaded
+    can have one, and it is among the latest batches, so just the first page
+    of the batch list is searched.
+    """
+    for chunk_num, batch in enumerate(state["batches"]):
+        if batch["batch_id"]:
+            continue
+        metadata = {"kabalot_run": state["run_id"], "chunk": str(chunk_num)}
+        latest = batch_client.batches.list(limit=100).data if batch["input_file_id"] else []
+        for existing in latest:
+            if (existing.metadata or {}) == metadata:
+                print(f"Found batch {existing.id} submitted before the last crash")
+                batch["batch_id"] = existing.id
+                break
+        else:
+            if not batch["input_file_id"]:
+                with open(batch["input_path"], 'rb') as f:
+                    batch["input_file_id"] = batch_client.files.create(file=f, purpose="batch").id
+                save_batch_state(settings, state)
+            created = batch_client.batches.create(
+                input_file_id=batch["input_file_id"],
+                endpoint="/v1/chat/completions",
+                completion_window=settings["completion_window"],
+                metadata=metadata,
+            )
+            batch["batch_id"] = created.id
+            print(f"Submitted batch {created.id} from {batch['input_path']}")
+        save_batch_state(settings, state)
+
+def wait_for_batches(batch_client, settings, state):
+    while True:
+        pending = 0
+        for batch in state["batches"]:
+            if batch["status"] in BATCH_TERMINAL_STATUSES:
+                continue
+            remote = batch_client.batches.retrieve(batch["batch_id"])
+            batch["status"] = remote.status
+            batch["output_file_id"] = remote.output_file_id
+            batch["error_file_id"] = remote.error_file_id
+            if remote.status not in BATCH_TERMINAL_STATUSES:
+                pending += 1
+            print(f"Batch {batch['batch_id']}: {remote.status}")
+        save_batch_state(settings, state)
+        if not pending:
+            return
+        time.sleep(settings["poll_interval_sec"])
+
+def store_batch_results(settings, results):
+    with open(os.path.join(settings["dir"], "results.jsonl"), 'a', encoding='utf-8') as f:
+        for custom_id, invoice_json in results.items():
+            f.write(json.dumps({"custom_id": custom_id, "content": invoice_json}, ensure_ascii=False) + "\n")
+
+def load_batch_results(settings):
+    results = {}
+    results_path = os.path.join(settings["dir"], "results.jsonl")
+    if os.path.exists(results_path):
+        with open(results_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                entry = json.loads(line)
+                results[entry["custom_id"]] = entry["content"]
+    return results
+
+def download_batch_results(batch_client, config, settings, state):
+    cache_settings = get_cache_settings(config)
+    for batch in state["batches"]:
+        if batch.get("downloaded"):
+            continue
+        results = {}
+        if batch.get("output_file_id"):
+            for line in batch_client.files.content(batch["output_file_id"]).text.splitlines():
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                response = entry.get("response") or {}
+                seq, _, page = entry["custom_id"].partition("-")
+                file_path = state["files"][int(seq)]
+                if response.get("status_code") != 200:
+                    print(f"Batch request {entry['custom_id']} failed: {entry.get('error') or response.get('body')}")
+                    record_stage("openai", 0.0, file_path, failed=True)
+                    continue
+                results[entry["custom_id"]] = response["body"]["choices"][0]["message"]["content"]
+                record_model_call(file_path, None if page == "doc" else [int(page)], response["body"].get("usage"))
+        if batch.get("error_file_id"):
+            for line in batch_client.files.content(batch["error_file_id"]).text.splitlines():
+                if line.strip():
+                    entry = json.loads(line)
+                    print(f"Batch request {entry['custom_id']} failed: {entry.get('error') or entry.get('response')}")
+        store_batch_results(settings, results)
+        for custom_id, invoice_json in results.items():
+            key = state["cache_keys"].get(custom_id)
+            if key:
+                store_cached_extraction(cache_settings, key, invoice_json)
+                count_cache_event("stores")
+        batch["downloaded"] = True
+        save_batch_state(settings, state)
+
+def process_files_in_batch(config, file_paths):
+    """Extract all pages through the OpenAI Batch API, then upload and write the invoices.
+
+    Progress is kept in the batch dir, so a run that crashed or was stopped
+    between submitting and collecting picks up the same batches next time
+    instead of rendering and paying for the pages again. Files that are new
+    since then are added to the resumed run in new batches.
+    """
+    settings = get_batch_settings(config)
+    batch_client = get_batch_client(settings)
+    state = load_batch_state(settings)
+    if state is not None:
+        print(f"Resuming batch run {state['run_id']} with {len(state['files'])} files")
+    state = prepare_batch_requests(config, file_paths, settings, state)
+
+    submit_batches(batch_client, settings, state)
+    wait_for_batches(batch_client, settings, state)
+    download_batch_results(batch_client, config, settings, state)
+
+    results = load_batch_results(settings)
+    for seq, file_path in enumerate(state["files"]):
+        page_count = state["pages"][file_path]
+        if page_count is None:
+            # Failed while rendering, the error was printed then
+            continue
+        try:
+            invoice = []
+            if page_count == "doc":
+                if f"{seq}-doc" not in results:
+                    raise ValueError("no batch result for the invoice")
+                invoice.append(get_checked_page_data(config, file_path, "doc", results[f"{seq}-doc"]))
+            single_page = page_count == 1
+            checkpoint = {} if single_page or page_count == "doc" else read_page_checkpoint(config, file_path)
+            for page_num in range(0 if page_count == "doc" else page_count):
+                custom_id = f"{seq}-{page_num}"
+                if custom_id not in results:
+                    raise ValueError(f"no batch result for page {page_num + 1}")
+                invoice.append(get_checkpointed_page(config, file_path, page_num, checkpoint, single_page, lambda: (
+                    get_checked_page_data(config, file_path, page_num, results[custom_id], whole_invoice=single_page))))
+            check_invoice_total(config, invoice)
+            upload_and_write_invoice(config, file_path, invoice)
+        except Exception as e:
+            print(f"Error processing file {file_path}: {str(e)}")
+
+    # The run is complete, the next run starts a new batch
+    os.remove(get_batch_state_path(settings))
+    print(f"Batch run {state['run_id']} complete")
+
+class MockBatchClient:
+    """Local stand-in for the files and batches endpoints used by process_files_in_batch.
+
+    Everything is kept as files under mock_dir so a batch survives a restart,
+    and every request is answered with the mock invoice. Batches complete on
+    the second retrieve, so polling is exercised too.
+    """
+
+    def __init__(self, mock_dir):
+        self.mock_dir = mock_dir
+        os.makedirs(mock_dir, exist_ok=True)
+        self.files = MockBatchFiles(self)
+        self.batches = MockBatchBatches(self)
+
+    def path(self, name):
+        return os.path.join(self.mock_dir, name)
+
+    def load(self, name):
+        with open(self.path(name), 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def save(self, name, data):
+        with open(self.path(name), 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+
+class MockBatchFiles:
+    def __init__(self, mock):
+        self.mock = mock
+
+    def create(self, file, purpose):
+        file_id = f"file-{hashlib.sha256(file.read()).hexdigest()[:16]}"
+        file.seek(0)
+        with open(self.mock.path(file_id), 'wb') as f:
+            f.write(file.read())
+        return SimpleNamespace(id=file_id, purpose=purpose)
+
+    def content(self, file_id):
+        with open(self.mock.path(file_id), 'r', encoding='utf-8') as f:
+            return SimpleNamespace(text=f.read())
+
+class MockBatchBatches:
+    def __init__(self, mock):
+        self.mock = mock
+
+    def create(self, input_file_id, endpoint, completion_window, metadata=None):
+        batch_id = f"batch-{len(self.list(limit=None).data)}"
+        self.mock.save(f"{batch_id}.json", {"id": batch_id, "input_file_id": input_file_id,
+                                            "metadata": metadata, "retrieved": 0})
+        return self.retrieve(batch_id, count=False)
+
+    def list(self, limit=100):
+        # One page, latest first like the API
+        names = sorted((name for name in os.listdir(self.mock.mock_dir) if name.startswith("batch-")
+                        and name.endswith(".json")), key=lambda name: int(name[len("batch-"):-len(".json")]))
+        batches = [self.retrieve(name[:-len(".json")], count=False) for name in reversed(names)]
+        return SimpleNamespace(data=batches[:limit])
+
+    def retrieve(self, batch_id, count=True):
+        batch = self.mock.load(f"{batch_id}.json")
+        if count:
+            batch["retrieved"] += 1
+            self.mock.save(f"{batch_id}.json", batch)
+        output_file_id = None
+        if batch["retrieved"] >= 2:
+            output_file_id = f"{batch_id}-output"
+            if not os.path.exists(self.mock.path(output_file_id)):
+                self.write_output(batch, output_file_id)
+        return SimpleNamespace(id=batch_id, metadata=batch["metadata"], error_file_id=None,
+                               status="completed" if output_file_id else "in_progress",
+                               output_file_id=output_file_id)
+
+    def write_output(self, batch, output_file_id):
+        with open(self.mock.path(batch["input_file_id"]), 'r', encoding='utf-8') as f:
+            requests = [json.loads(line) for line in f if line.strip()]
+        with open(self.mock.path(output_file_id), 'w', encoding='utf-8') as f:
+            for request in requests:
+                body = {"choices": [{"message": {"role": "assistant", "content": get_mock_invoice_json()}}]}
+                f.write(json.dumps({"id": f"req-{request['custom_id']}", "custom_id": request["custom_id"],
+                                    "response": {"status_code": 200, "body": body}, "error": None},
+                                   ensure_ascii=False) + "\n")
@@ -0,0 +1,632 @@
+"""Benchmarks and the local mock services they run against: a fake Dropbox and a mock OpenAI API.
+
+Nothing here is needed to process receipts, so this module is only imported by
+the bench command, --fake-dropbox and the process pool workers it starts.
+"""
+
+import base64
+import hashlib
+import json
+import mimetypes
+import os
+import random
+import re
+import shutil
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+
+import fitz  # PyMuPDF
+from openai import OpenAI
+from PIL import Image
+
+from kabalot import ratelimit
+from kabalot.config import get_dedupe_settings, get_pipeline_settings, test_config
+from kabalot.core import get_validation_settings
+from kabalot.excel import get_summary_index_path, write_summaries
+from kabalot.manifest import reset_manifest
+from kabalot.metrics import finish_run_metrics, get_metrics_settings, start_run_metrics, write_atomically
+from kabalot.pipeline import get_process_pool_context, main_extract
+from kabalot.prompt import MODEL
+from kabalot.ratelimit import RateLimiter, format_reset_duration, get_rate_limit_settings
+from kabalot.render import (encode_image_page, estimate_image_tokens, get_preprocess_settings, get_render_settings,
+    iter_pdf_pages, pdf_to_base64_images, preprocess_image, render_pdf_page_image)
+from kabalot.report import get_report_settings
+from kabalot.store import get_store_connection, get_store_settings
+from kabalot.upload import DROPBOX_HASH_BLOCK_SIZE
+
+# The required fields of sharing.LinkPermissions
+FAKE_LINK_PERMISSIONS = {
+    "can_revoke": True, "visibility_policies": [], "can_set_expiry": False, "can_remove_expiry": False,
+    "allow_download": True, "can_allow_download": True, "can_disallow_download": False,
+    "allow_comments": False, "team_restricts_comments": False,
+}
+
+def simulate_service_conditions(handler, error_status):
+    """Delay a mock service request by the server's latency and fail it at the server's error rate.
+
+    Returns True if an error was sent and the request should not be handled.
+    """
+    server = handler.server
+    with server.lock:
+        latency = server.latency_ms * server.random.uniform(0.5, 1.5) / 1000
+        failed = server.random.random() < server.error_rate
+    if latency:
+        time.sleep(latency)
+    if failed:
+        handler.send_json(error_status, {"error_summary": "simulated failure/",
+                                         "error": {"message": "simulated failure", "type": "server_error"}})
+    return failed
+
+class FakeDropboxHandler(BaseHTTPRequestHandler):
+    """Answers the Dropbox API routes used by the uploader from memory, for start_fake_dropbox_server."""
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def file_metadata(self, path):
+        entry = self.server.files[path.lower()]
+        return {".tag": "file", "name": os.path.basename(path), "id": entry["id"], "rev": entry["rev"],
+                "client_modified": entry["modified"], "server_modified": entry["modified"],
+                "size": len(entry["content"]), "path_lower": path.lower(), "path_display": path,
+                "content_hash": entry["content_hash"], "is_downloadable": True}
+
+    def store_file(self, path, content):
+        digest = hashlib.sha256()
+        for start in range(0, len(content), DROPBOX_HASH_BLOCK_SIZE):
+            digest.update(hashlib.sha256(content[start:start + DROPBOX_HASH_BLOCK_SIZE]).digest())
+        with self.server.lock:
+            self.server.revision += 1
+            self.server.files[path.lower()] = {
+                "content": bytes(content), "content_hash": digest.hexdigest(),
+                "id": f"id:{self.server.revision:012d}", "rev": f"{self.server.revision:012x}",
+                "modified": datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+            }
+        return self.file_metadata(path)
+
+    def not_found(self):
+        self.send_json(409, {"error_summary": "path/not_found/", "error": {".tag": "path", "path": {".tag": "not_found"}}})
+
+    def do_POST(self):
+        route = self.path[len("/2/"):]
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        # The Dropbox SDK retries 5xx answers with backoff
+        if simulate_service_conditions(self, 500):
+            return
+        if "Dropbox-API-Arg" in self.headers:
+            arg, content = json.loads(self.headers["Dropbox-API-Arg"]), body
+        else:
+            arg, content = json.loads(body or b"null"), b""
+
+        if route == "files/upload":
+            self.send_json(200, self.store_file(arg["path"], content))
+        elif route == "files/upload_session/start":
+            with self.server.lock:
+                session_id = f"session-{len(self.server.sessions)}"
+                self.server.sessions[session_id] = bytearray(content)
+            self.send_json(200, {"session_id": session_id})
+        elif route in ("files/upload_session/append_v2", "files/upload_session/finish"):
+            session = self.server.sessions.get(arg["cursor"]["session_id"])
+            if session is None or len(session) != arg["cursor"]["offset"]:
+                self.send_json(409, {"error_summary": "incorrect_offset/", "error": {".tag": "incorrect_offset", "correct_offset": len(session or b"")}})
+                return
+            session.extend(content)
+            if route.endswith("finish"):
+                self.send_json(200, self.store_file(arg["commit"]["path"], session))
+            else:
+                self.send_json(200, None)
+        elif route == "files/get_metadata":
+            if arg["path"].lower() not in self.server.files:
+                self.not_found()
+            else:
+                self.send_json(200, self.file_metadata(arg["path"]))
+        elif route == "sharing/list_shared_links":
+            url = self.server.links.get(arg["path"].lower())
+            links = [self.link_metadata(arg["path"], url)] if url else []
+            self.send_json(200, {"links": links, "has_more": False})
+        elif route == "sharing/create_shared_link_with_settings":
+            path = arg["path"]
+            if path.lower() not in self.server.files:
+                self.not_found()
+                return
+            with self.server.lock:
+                if path.lower() in self.server.links:
+                    self.send_json(409, {"error_summary": "shared_link_already_exists/", "error": {".tag": "shared_link_already_exists"}})
+                    return
+                url = f"https://fake.dropbox.local/s/{len(self.server.links)}/{os.path.basename(path)}"
+                self.server.links[path.lower()] = url
+            self.send_json(200, self.link_metadata(path, url))
+        else:
+            self.send_json(404, {"error_summary": f"unknown route {route}"})
+
+    def link_metadata(self, path, url):
+        metadata = self.file_metadata(path)
+        return {".tag": "file", "url": url, "name": metadata["name"], "id": metadata["id"],
+                "path_lower": metadata["path_lower"], "link_permissions": FAKE_LINK_PERMISSIONS,
+                "client_modified": metadata["client_modified"], "server_modified": metadata["server_modified"],
+                "rev": metadata["rev"], "size": metadata["size"]}
+
+def start_fake_dropbox_server(port=0, latency_ms=0, error_rate=0.0, seed=None):
+    """Start an in-memory fake Dropbox API on localhost and return its URL for config["dropbox_api_url"]."""
+    server = ThreadingHTTPServer(("127.0.0.1", port), FakeDropboxHandler)
+    server.files = {}
+    server.sessions = {}
+    server.links = {}
+    server.revision = 0
+    server.lock = threading.Lock()
+    server.latency_ms = latency_ms
+    server.error_rate = error_rate
+    server.random = random.Random(seed)
+    threading.Thread(target=server.serve_forever, name="fake-dropbox", daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+    print(f"Fake Dropbox server running at {url}")
+    return url
+
+
+def get_peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        # resource is not available on Windows
+        import psutil
+        return psutil.Process().memory_info().peak_wset / (1024 * 1024)
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is reported in bytes on macOS and in kilobytes on Linux
+    return peak_rss / (1024 * 1024) if sys.platform == "darwin" else peak_rss / 1024
+
+def run_render_benchmark(renderer, pdf_paths, dpi, colorspace):
+    pages = 0
+    start = time.perf_counter()
+    for pdf_path in pdf_paths:
+        if renderer == "pdf_to_base64_images":
+            pages += len(pdf_to_base64_images(pdf_path))
+        else:
+            for _ in iter_pdf_pages(pdf_path, dpi, colorspace):
+                pages += 1
+    seconds = time.perf_counter() - start
+    return {
+        "renderer": renderer,
+        "pages": pages,
+        "seconds": round(seconds, 3),
+        "pages_per_sec": round(pages / seconds, 2) if seconds else None,
+        "peak_rss_mb": round(get_peak_rss_mb(), 1),
+    }
+
+def benchmark_renderers(config, pdf_paths):
+    """Compare pages/sec and peak RSS of pdf_to_base64_images and iter_pdf_pages.
+
+    Each renderer runs in a fresh process so its peak RSS isn't inflated by the other.
+    pdf_to_base64_images always renders at 72 dpi, so compare at the default dpi.
+    """
+    settings = get_render_settings(config)
+    print(f"Benchmarking renderers on {len(pdf_paths)} PDFs with {settings}")
+    results = []
+    for renderer in ("pdf_to_base64_images", "iter_pdf_pages"):
+        with ProcessPoolExecutor(max_workers=1, mp_context=get_process_pool_context()) as pool:
+            result = pool.submit(run_render_benchmark, renderer, pdf_paths,
+                                 settings["dpi"], settings["colorspace"]).result()
+        print(f"{result['renderer']}: {result['pages']} pages in {result['seconds']}s, "
+              f"{result['pages_per_sec']} pages/sec, peak RSS {result['peak_rss_mb']} MB")
+        results.append(result)
+    return results
+
+def iter_original_images(config, file_path):
+    """Yield every page of a PDF or JPEG as a PIL image with the format it is sent in."""
+    mime_type, _ = mimetypes.guess_type(file_path)
+    if mime_type == "application/pdf":
+        settings = get_render_settings(config)
+        with fitz.open(file_path) as pdf_document:
+            for page in pdf_document:
+                yield render_pdf_page_image(page, settings["dpi"], settings["colorspace"]), "PNG"
+    elif mime_type == "image/jpeg":
+        with Image.open(file_path) as img:
+            yield img, "JPEG"
+
+def report_preprocessing_savings(config, input_dir):
+    """Estimate the vision tokens and bytes that preprocessing saves on every image page in input_dir.
+
+    Pages that would go as text are counted as images too, so this is an upper bound on what gets sent.
+    """
+    settings = dict(get_preprocess_settings(config), enabled=True)
+    totals = {"images": 0, "tokens_before": 0, "tokens_after": 0, "bytes_before": 0, "bytes_after": 0}
+    for filename in sorted(os.listdir(input_dir)):
+        file_path = os.path.join(input_dir, filename)
+        file_totals = dict.fromkeys(totals, 0)
+        for img, image_format in iter_original_images(config, file_path):
+            before = encode_image_page(img, image_format, settings)
+            after = encode_image_page(preprocess_image(img, settings), image_format, settings)
+            file_totals["images"] += 1
+            file_totals["tokens_before"] += before["estimated_image_tokens"]
+            file_totals["tokens_after"] += after["estimated_image_tokens"]
+            file_totals["bytes_before"] += len(before["content"])
+            file_totals["bytes_after"] += len(after["content"])
+        if not file_totals["images"]:
+            continue
+        print(f"{filename}: {file_totals['images']} images, "
+              f"{file_totals['tokens_before']} -> {file_totals['tokens_after']} tokens, "
+              f"{file_totals['bytes_before'] // 1024} -> {file_totals['bytes_after'] // 1024} KB base64")
+        for key in totals:
+            totals[key] += file_totals[key]
+
+    if totals["images"]:
+        saved = 1 - totals["tokens_after"] / totals["tokens_before"]
+        print(f"Preprocessing {totals['images']} images in {input_dir}: "
+              f"{totals['tokens_before']} -> {totals['tokens_after']} estimated tokens ({saved:.0%} saved), "
+              f"{totals['bytes_before'] // 1024} -> {totals['bytes_after'] // 1024} KB base64")
+    else:
+        print(f"No images to preprocess in {input_dir}")
+    return totals
+
+DEFAULT_BENCHMARK_SETTINGS = {
+    "dir": "./bench",
+    "invoices": 50,
+    "min_pages": 1,
+    "max_pages": 4,
+    "lines_per_page": 20,
+    "hebrew_share": 0.5,
+    "jpeg_share": 0.3,
+    # PDFs whose pages are images only, like scanned receipts
+    "scanned_share": 0.3,
+    "seed": 1,
+    "openai_latency_ms": 800,
+    "openai_error_rate": 0.01,
+    # Quota of the mock OpenAI server, 0 for none
+    "openai_rpm_limit": 0,
+    "openai_tpm_limit": 0,
+    # Share of answers the mock OpenAI server cuts off, to exercise validation retries
+    "openai_malformed_rate": 0.02,
+    "dropbox_latency_ms": 150,
+    "dropbox_error_rate": 0.01,
+}
+
+SYNTHETIC_COMPANIES = [
+    {"name": "פנגו בע\"מ", "company_id": "513902735", "hebrew": True},
+    {"name": "סלופארק טכנולוגיות", "company_id": "514456781", "hebrew": True},
+    {"name": "אחוזות החוף", "company_id": "520031576", "hebrew": True},
+    {"name": "Cellopark Technologies Ltd", "company_id": "514456781", "hebrew": False},
+    {"name": "Pango Mobile Parking", "company_id": "513902735", "hebrew": False},
+]
+SYNTHETIC_CITIES = ["תל-אביב", "רמת גן", "הרצליה", "חיפה", "ירושלים", "פתח תקווה"]
+SYNTHETIC_PLATES = ["62-728-55", "91-600-11", "12-345-67", "45-118-90"]
+
+def get_benchmark_settings(config):
+    settings = dict(DEFAULT_BENCHMARK_SETTINGS)
+    settings.update(config.get("benchmark", {}))
+    return settings
+
+def get_synthetic_invoice_html(invoice, lines, page_num, page_count):
+    hebrew = invoice["company"]["hebrew"]
+    labels = (["עיר", "לוחית רישוי", "שעת התחלה", "דקות", "חיוב"] if hebrew
+              else ["City", "License Plate", "Start Time", "Minutes", "Charge"])
+    header = (f"<h2>חשבונית מס</h2><p>{invoice['company']['name']}, ח.פ. {invoice['company']['company_id']}</p>"
+              f"<p>מספר חשבונית: {invoice['invoice_number']}</p><p>תאריך: {invoice['date']}</p>" if hebrew else
+              f"<h2>Tax Invoice</h2><p>{invoice['company']['name']}, Company ID {invoice['company']['company_id']}</p>"
+              f"<p>Invoice number: {invoice['invoice_number']}</p><p>Date: {invoice['date']}</p>")
+    rows = "".join("<tr>" + "".join(f"<td>{value}</td>" for value in line) + "</tr>" for line in lines)
+    footer = ""
+    if page_num == page_count - 1:
+        footer = (f"<p><b>סה\"כ לתשלום: {invoice['total']:.2f} ₪</b></p>" if hebrew
+                  else f"<p><b>Total due: {invoice['total']:.2f} ILS</b></p>")
+    page_label = f"<p>{page_num + 1} / {page_count}</p>"
+    direction = ' dir="rtl"' if hebrew else ""
+    return (f"<body{direction} style='font-size:10px'>{header}<table border='1'>"
+            f"<tr>{''.join(f'<th>{label}</th>' for label in labels)}</tr>{rows}</table>{footer}{page_label}</body>")
+
+def generate_synthetic_invoices(out_dir, settings):
+    """Write synthetic Hebrew and English parking invoices as text PDFs, scanned PDFs and JPEG photos.
+
+    The same settings and seed always give the same files.
+    """
+    rng = random.Random(settings["seed"])
+    os.makedirs(out_dir, exist_ok=True)
+    for filename in os.listdir(out_dir):
+        os.remove(os.path.join(out_dir, filename))
+
+    file_paths = []
+    for num in range(settings["invoices"]):
+        hebrew = rng.random() < settings["hebrew_share"]
+        company = rng.choice([company for company in SYNTHETIC_COMPANIES if company["hebrew"] == hebrew])
+        page_count = rng.randint(settings["min_pages"], settings["max_pages"])
+        kind = "jpeg" if rng.random() < settings["jpeg_share"] else "scanned" if rng.random() < settings["scanned_share"] else "text"
+        if kind == "jpeg":
+            # A photo only ever shows one page
+            page_count = 1
+        pages = [[[rng.choice(SYNTHETIC_CITIES), rng.choice(SYNTHETIC_PLATES),
+                   f"{rng.randint(1, 28):02d}/{rng.randint(1, 12):02d}/2024 {rng.randint(6, 21):02d}:{rng.randint(0, 59):02d}",
+                   rng.randint(10, 240), f"{rng.uniform(3, 40):.2f}"]
+                  for _ in range(settings["lines_per_page"])] for _ in range(page_count)]
+        invoice = {
+            "company": company,
+            "invoice_number": str(rng.randint(10 ** 8, 10 ** 9 - 1)),
+            "date": f"{rng.randint(1, 28)}/{rng.randint(1, 12)}/24",
+            "total": sum(float(line[-1]) for lines in pages for line in lines),
+        }
+
+        document = fitz.open()
+        for page_num, lines in enumerate(pages):
+            page = document.new_page(width=595, height=842)
+            page.insert_htmlbox(page.rect + (40, 40, -40, -40), get_synthetic_invoice_html(invoice, lines, page_num, page_count))
+        file_path = os.path.join(out_dir, f"invoice_{num:05d}.{'jpg' if kind == 'jpeg' else 'pdf'}")
+        if kind == "jpeg":
+            pix = document[0].get_pixmap(dpi=150)
+            img = Image.frombytes("RGB", (pix.width, pix.height), pix.samples)
+            img.rotate(rng.uniform(-3, 3), expand=True, fillcolor="white").save(file_path, format="JPEG", quality=85)
+        elif kind == "scanned":
+            scanned = fitz.open()
+            for page in document:
+                scanned_page = scanned.new_page(width=page.rect.width, height=page.rect.height)
+                scanned_page.insert_image(scanned_page.rect, stream=page.get_pixmap(dpi=150).tobytes("png"))
+            scanned.save(file_path)
+            scanned.close()
+        else:
+            document.save(file_path)
+        document.close()
+        file_paths.append(file_path)
+    print(f"Generated {len(file_paths)} synthetic invoices in {out_dir}")
+    return file_paths
+
+def find_synthetic_field(pattern, text):
+    match = re.search(pattern, text)
+    return next((group for group in match.groups() if group), None) if match else None
+
+def get_mock_chat_invoice(texts, images):
+    """Answer an extraction request with an invoice built from what the synthetic page text says.
+
+    Returns None if a synthetic page was sent as text that doesn't read in
+    order, such as Hebrew with its words reversed.
+    """
+    text = "\n".join(texts)
+    number = find_synthetic_field(r"Invoice number:\s*(\d+)|מספר חשבונית:\s*(\d+)", text)
+    if number is None and re.search(r"Tax Invoice|חשבונית", text):
+        return None
+    total = find_synthetic_field(r"Total due:\s*([\d.]+)|סה\"כ לתשלום:\s*([\d.]+)", text)
+    company_id = find_synthetic_field(r"Company ID\s*(\d+)|ח\.פ\.\s*(\d+)", text)
+    digest = hashlib.sha256("".join(images).encode("ascii") + text.encode("utf-8")).hexdigest()
+    return {
+        "Details of Services Charged": [],
+        "invoice_summary": {
+            "total_charge": total or f"{int(digest[:6], 16) % 50000 / 100:.2f}",
+            "date_of_invoice": "1/1/24",
+            "invoice_number": number or str(int(digest[:8], 16)),
+            "company_id": company_id or "",
+            "currency": "ILS",
+            "expense_type": "vehicle",
+            "type_code": "c",
+        },
+    }
+
+def get_mock_strict_invoice(invoice):
+    """The mock invoice in the strict schema of the retried requests."""
+    summary = dict(invoice["invoice_summary"], total_charge=float(invoice["invoice_summary"]["total_charge"]),
+                   date_of_invoice="2024-01-01")
+    return {"line_items": [], "invoice_summary": {key: None if value == "" else value for key, value in summary.items()}}
+
+class MockChatHandler(BaseHTTPRequestHandler):
+    """Answers POST /v1/chat/completions like the OpenAI API, for start_mock_openai_server."""
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, data, headers=None):
+        body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def get_rate_limit_headers(self):
+        limiter = self.server.limiter
+        with limiter.condition:
+            limiter.refill()
+            headers = {}
+            for kind, limit in limiter.limits.items():
+                headers[f"x-ratelimit-limit-{kind}"] = str(limit)
+                headers[f"x-ratelimit-remaining-{kind}"] = str(max(0, int(limiter.levels[kind])))
+                missing = limit - limiter.levels[kind]
+                headers[f"x-ratelimit-reset-{kind}"] = format_reset_duration(missing * 60 / limit)
+        return headers
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        if not self.path.endswith("/chat/completions"):
+            self.send_json(404, {"error": {"message": f"unknown route {self.path}", "type": "invalid_request_error"}})
+            return
+        # The OpenAI SDK retries 5xx answers with backoff
+        if simulate_service_conditions(self, 500):
+            return
+
+        texts, images = [], []
+        prompt_tokens = 0
+        prefix_tokens = None
+        for message in request["messages"]:
+            parts = message["content"] if isinstance(message["content"], list) else [{"type": "text", "text": message["content"]}]
+            for part in parts:
+                # The system prompt and the instructions are the prefix the real API would have cached
+                if prefix_tokens is None and message["role"] == "user":
+                    prefix_tokens = prompt_tokens + (len(part.get("text", "")) // 3 + 1)
+                    prefix = "\n".join(texts + [part.get("text", "")])
+                if part["type"] == "text":
+                    texts.append(part["text"])
+                    prompt_tokens += len(part["text"]) // 3 + 1
+                else:
+                    data = part["image_url"]["url"].split(",", 1)[1]
+                    images.append(data[:4096])
+                    with Image.open(BytesIO(base64.b64decode(data))) as img:
+                        prompt_tokens += estimate_image_tokens(img.width, img.height)
+        invoice = get_mock_chat_invoice(texts, images)
+        if invoice is None:
+            self.send_json(400, {"error": {"message": "The page text does not read in order (simulated)",
+                                           "type": "invalid_request_error"}})
+            return
+        if request.get("response_format", {}).get("type") == "json_schema":
+            content = json.dumps(get_mock_strict_invoice(invoice), ensure_ascii=False)
+        else:
+            content = json.dumps(invoice, ensure_ascii=False)
+            # Some answers come back cut off, like a completion that ran out of tokens
+            with self.server.lock:
+                malformed = self.server.random.random() < self.server.malformed_rate
+            if malformed:
+                content = content[:len(content) // 2]
+        cached_tokens = 0
+        # Like the API: prefixes from 1024 tokens up are cached in steps of 128 once they have been seen
+        if prefix_tokens and prefix_tokens >= 1024:
+            with self.server.lock:
+                if prefix in self.server.seen_prefixes:
+                    cached_tokens = prefix_tokens // 128 * 128
+                self.server.seen_prefixes.add(prefix)
+        headers = None
+        if self.server.limiter is not None:
+            wait = self.server.limiter.try_acquire(prompt_tokens + len(content) // 3 + 1)
+            headers = self.get_rate_limit_headers()
+            if wait:
+                headers["retry-after-ms"] = str(int(wait * 1000) + 1)
+                self.send_json(429, {"error": {"message": "Rate limit reached (simulated)", "type": "requests",
+                                               "code": "rate_limit_exceeded"}}, headers)
+                return
+        self.send_json(200, {
+            "id": f"chatcmpl-mock-{time.time_ns()}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get("model", MODEL),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": len(content) // 3 + 1,
+                      "total_tokens": prompt_tokens + len(content) // 3 + 1,
+                      "prompt_tokens_details": {"cached_tokens": cached_tokens}},
+        }, headers)
+
+def start_mock_openai_server(port=0, latency_ms=0, error_rate=0.0, seed=None, rpm_limit=0, tpm_limit=0,
+                             malformed_rate=0.0):
+    """Start a local mock chat completions API and return its base URL for OpenAI(base_url=...).
+
+    With rpm_limit and tpm_limit it throttles like the API: requests over the
+    quota get a 429 with retry-after-ms and x-ratelimit headers. A
+    malformed_rate share of the answers is cut off, except for requests with a
+    JSON schema.
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", port), MockChatHandler)
+    server.limiter = RateLimiter(rpm_limit or 10 ** 9, tpm_limit or 10 ** 12) if rpm_limit or tpm_limit else None
+    server.seen_prefixes = set()
+    server.lock = threading.Lock()
+    server.latency_ms = latency_ms
+    server.error_rate = error_rate
+    server.malformed_rate = malformed_rate
+    server.random = random.Random(seed)
+    threading.Thread(target=server.serve_forever, name="mock-openai", daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}/v1"
+    print(f"Mock OpenAI server running at {url}")
+    return url
+
+def run_benchmark_phase(phase, config, openai_url):
+    """Run one benchmark phase in this process and return its throughput, stage latencies and peak RSS."""
+    ratelimit.client = OpenAI(api_key="benchmark", base_url=openai_url)
+    test_config.clear()
+    start_run_metrics(config)
+    start = time.perf_counter()
+    if phase == "extract":
+        main_extract(config)
+    else:
+        write_summaries(config, rebuild=True)
+    seconds = time.perf_counter() - start
+    report = finish_run_metrics(config)
+    if phase == "extract":
+        files = report["files"]
+    elif get_store_settings(config)["enabled"]:
+        files = get_store_connection(config).execute("SELECT COUNT(*) FROM Invoices").fetchone()[0]
+    else:
+        files = len(os.listdir(config["output_dir"]))
+    return {
+        "phase": phase,
+        "files": files,
+        "pages": report["pages"],
+        "seconds": round(seconds, 3),
+        "files_per_sec": round(files / seconds, 2) if seconds else None,
+        "pages_per_sec": round(report["pages"] / seconds, 2) if seconds and report["pages"] else None,
+        "stages": {stage: {"calls": stats["calls"], "failures": stats["failures"], "retries": stats["retries"],
+                           "p50_seconds": stats["p50_seconds"], "p95_seconds": stats["p95_seconds"]}
+                   for stage, stats in report["stages"].items() if stats["calls"]},
+        "tokens": report["tokens"],
+        "peak_rss_mb": round(get_peak_rss_mb(), 1),
+    }
+
+def run_benchmark(config):
+    """Run main_extract and the Excel summary end to end on synthetic invoices against local mock services.
+
+    Nothing leaves the machine: the invoices are generated under benchmark.dir,
+    and OpenAI and Dropbox are local mock servers with the configured latency and
+    error rates. Each phase runs in a fresh process so its peak RSS is its own.
+    """
+    settings = get_benchmark_settings(config)
+    bench_dir = settings["dir"]
+    input_dir = os.path.join(bench_dir, "in")
+    output_dir = os.path.join(bench_dir, "out")
+    # Dedupe, dead letter and checkpoint files, which would otherwise land in the real ./state
+    state_dir = os.path.join(bench_dir, "state")
+    report_dir = os.path.join(bench_dir, "reports")
+    generate_synthetic_invoices(input_dir, settings)
+    for path in (output_dir, state_dir, report_dir):
+        if os.path.exists(path):
+            shutil.rmtree(path)
+    os.makedirs(output_dir)
+
+    bench_config = dict(config)
+    bench_config.update({
+        "input_dirs": [input_dir],
+        "output_dir": output_dir,
+        "excel_path": os.path.join(bench_dir, "summary.xlsx"),
+        "dropbox_path": "/benchmark",
+        "dropbox_access_token": "benchmark",
+        "dropbox_api_url": start_fake_dropbox_server(latency_ms=settings["dropbox_latency_ms"],
+                                                     error_rate=settings["dropbox_error_rate"], seed=settings["seed"]),
+        "manifest": {"enabled": True, "path": os.path.join(bench_dir, "manifest.jsonl")},
+        "store": dict(get_store_settings(config), path=os.path.join(bench_dir, "invoices.db")),
+        "extraction_cache": {"enabled": False},
+        "report": dict(get_report_settings(config), dir=report_dir),
+        "dedupe": dict(get_dedupe_settings(config), path=os.path.join(state_dir, "dedupe.jsonl"),
+                       review_path=os.path.join(state_dir, "duplicates.jsonl")),
+        "rate_limit": dict(get_rate_limit_settings(config), dead_letter_path=os.path.join(state_dir, "dead_letter.jsonl")),
+        "validation": dict(get_validation_settings(config), checkpoint_dir=os.path.join(state_dir, "checkpoints")),
+        "metrics": dict(get_metrics_settings(config), dir=os.path.join(bench_dir, "metrics"), prometheus_path="", profile=False),
+    })
+    openai_url = start_mock_openai_server(latency_ms=settings["openai_latency_ms"],
+                                          error_rate=settings["openai_error_rate"], seed=settings["seed"],
+                                          rpm_limit=settings["openai_rpm_limit"], tpm_limit=settings["openai_tpm_limit"],
+                                          malformed_rate=settings["openai_malformed_rate"])
+    reset_manifest(bench_config)
+    store_path = bench_config["store"]["path"]
+    for path in (bench_config["excel_path"], get_summary_index_path(bench_config),
+                 store_path, f"{store_path}-wal", f"{store_path}-shm"):
+        if os.path.exists(path):
+            os.remove(path)
+
+    results = []
+    for phase in ("extract", "summary"):
+        with ProcessPoolExecutor(max_workers=1, mp_context=get_process_pool_context()) as pool:
+            result = pool.submit(run_benchmark_phase, phase, bench_config, openai_url).result()
+        print(f"{phase}: {result['files']} files, {result['pages']} pages in {result['seconds']}s, "
+              f"{result['files_per_sec']} files/sec, {result['pages_per_sec']} pages/sec, "
+              f"peak RSS {result['peak_rss_mb']} MB")
+        for stage, stats in result["stages"].items():
+            print(f"  {stage}: p50 {stats['p50_seconds']}s, p95 {stats['p95_seconds']}s, "
+                  f"{stats['failures']} failed, {stats['retries']} retries")
+        results.append(result)
+
+    report_path = os.path.join(bench_dir, "report.json")
+    write_atomically(report_path, json.dumps({"settings": settings, "pipeline": get_pipeline_settings(config),
+                                               "results": results}, ensure_ascii=False, indent=4))
+    print(f"Benchmark report written to {report_path}")
+    return results
@@ -0,0 +1,154 @@
+"""Extraction cache: model answers kept on disk by page content, model and system prompt."""
+
+import base64
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+
+from kabalot.config import test_config
+from kabalot.prompt import DOCUMENT_INSTRUCTIONS, get_prompt_fingerprint
+
+DEFAULT_CACHE_SETTINGS = {
+    "enabled": False,
+    "dir": "./cache/extraction",
+    "max_size_mb": 512,
+    # Days since the answer was extracted, however often it was used since
+    "max_age_days": 180,
+}
+
+# Hit/miss counters for the extraction cache, shared by all extract workers
+cache_stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+_cache_lock = threading.Lock()
+
+def get_cache_settings(config):
+    settings = dict(DEFAULT_CACHE_SETTINGS)
+    settings.update(config.get("extraction_cache", {}))
+    return settings
+
+def count_cache_event(event, count=1):
+    with _cache_lock:
+        cache_stats[event] += count
+
+def get_cache_key(pages, document=False):
+    """Hash the rendered page bytes (or page text) together with the model and system prompt."""
+    digest = hashlib.sha256()
+    digest.update(get_prompt_fingerprint().encode("ascii"))
+    if document:
+        digest.update(DOCUMENT_INSTRUCTIONS.encode("utf-8"))
+    for page in pages:
+        digest.update(page["kind"].encode("ascii"))
+        if page["kind"] == "text":
+            digest.update(page["content"].encode("utf-8"))
+        else:
+            digest.update(base64.b64decode(page["content"]))
+    return digest.hexdigest()
+
+def get_cache_entry_path(settings, key):
+    return os.path.join(settings["dir"], key[:2], f"{key}.json")
+
+def read_cached_extraction(settings, key):
+    entry_path = get_cache_entry_path(settings, key)
+    try:
+        stat = os.stat(entry_path)
+        if (time.time() - stat.st_mtime) / 86400 > settings["max_age_days"]:
+            return None
+        with open(entry_path, 'r', encoding='utf-8') as f:
+            invoice_json = f.read()
+        # The modification time stays when the answer was stored, the access time is when it was last used,
+        # so entries expire by age and size-based eviction drops the least recently used first
+        os.utime(entry_path, ns=(time.time_ns(), stat.st_mtime_ns))
+    except FileNotFoundError:
+        return None
+    return invoice_json
+
+def store_cached_extraction(settings, key, invoice_json):
+    entry_path = get_cache_entry_path(settings, key)
+    os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+    # Write to a temp file first so a concurrent reader never sees a partial entry
+    temp_path = f"{entry_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        f.write(invoice_json)
+    os.replace(temp_path, entry_path)
+
+def get_cached_response(config, pages, document, extract):
+    settings = get_cache_settings(config)
+    if not settings["enabled"] or (test_config and test_config.get("mock_openai")):
+        return extract()
+
+    key = get_cache_key(pages, document)
+    invoice_json = read_cached_extraction(settings, key)
+    if invoice_json is not None:
+        count_cache_event("hits")
+        return invoice_json
+
+    count_cache_event("misses")
+    invoice_json = extract()
+    # Only keep responses that parse, a broken response should be retried next run
+    try:
+        json.loads(invoice_json)
+    except (TypeError, ValueError):
+        return invoice_json
+    store_cached_extraction(settings, key, invoice_json)
+    count_cache_event("stores")
+    return invoice_json
+
+def clear_extraction_cache(config):
+    cache_dir = get_cache_settings(config)["dir"]
+    if os.path.exists(cache_dir):
+        shutil.rmtree(cache_dir)
+        print(f"Cleared extraction cache {cache_dir}")
+
+def open_extraction_cache(config):
+    """Drop the cache when the model or system prompt changed since it was filled."""
+    settings = get_cache_settings(config)
+    if not settings["enabled"]:
+        return
+    fingerprint_path = os.path.join(settings["dir"], "prompt.sha256")
+    fingerprint = get_prompt_fingerprint()
+    if os.path.exists(fingerprint_path):
+        with open(fingerprint_path, 'r', encoding='utf-8') as f:
+            if f.read().strip() == fingerprint:
+                return
+        print("System prompt or model changed, invalidating extraction cache")
+        clear_extraction_cache(config)
+    os.makedirs(settings["dir"], exist_ok=True)
+    with open(fingerprint_path, 'w', encoding='utf-8') as f:
+        f.write(fingerprint)
+
+def prune_extraction_cache(config):
+    """Evict entries stored more than max_age_days ago, then the least recently used ones until the cache fits max_size_mb."""
+    settings = get_cache_settings(config)
+    if not os.path.exists(settings["dir"]):
+        return
+    now = time.time()
+    entries = []
+    for root, _, filenames in os.walk(settings["dir"]):
+        for filename in filenames:
+            if not filename.endswith(".json"):
+                continue
+            entry_path = os.path.join(root, filename)
+            stat = os.stat(entry_path)
+            if (now - stat.st_mtime) / 86400 > settings["max_age_days"]:
+                os.remove(entry_path)
+                count_cache_event("evictions")
+            else:
+                entries.append((stat.st_atime, stat.st_size, entry_path))
+
+    max_size = settings["max_size_mb"] * 1024 * 1024
+    total_size = sum(size for _, size, _ in entries)
+    for _, size, entry_path in sorted(entries):
+        if total_size <= max_size:
+            break
+        os.remove(entry_path)
+        total_size -= size
+        count_cache_event("evictions")
+
+def close_extraction_cache(config):
+    if not get_cache_settings(config)["enabled"]:
+        return
+    prune_extraction_cache(config)
+    print(f"Extraction cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses, "
+          f"{cache_stats['stores']} stored, {cache_stats['evictions']} evicted")
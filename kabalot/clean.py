@@ -0,0 +1,32 @@
+"""Deleting the extracted invoices and the state kept about them, so everything is extracted again.
+
+Only the light modules are imported, so clean starts without loading the
+renderer, OpenAI, Dropbox or the Excel writer.
+"""
+
+import os
+
+from kabalot.config import get_dedupe_settings
+from kabalot.manifest import reset_manifest
+from kabalot.store import clear_invoice_store, get_store_settings
+
+def reset_dedupe_index(config):
+    """Forget every input file seen and the review list, so the next run checks all files again."""
+    settings = get_dedupe_settings(config)
+    for path in (settings["path"], settings["review_path"]):
+        if os.path.exists(path):
+            os.remove(path)
+
+def clean_output_directory(config):
+    print("Cleaning output directory")
+    output_dir = config["output_dir"]
+    if os.path.exists(output_dir):
+        for filename in os.listdir(output_dir):
+            file_path = os.path.join(output_dir, filename)
+            os.remove(file_path)
+        print(f"Cleaned {output_dir}")
+    if get_store_settings(config)["enabled"]:
+        clear_invoice_store(config)
+    # Everything has to be extracted again once the invoices are gone
+    reset_manifest(config)
+    reset_dedupe_index(config)
@@ -0,0 +1,122 @@
+"""Command line entry point: python -m kabalot <command>.
+
+Each command imports only the modules it needs, and the config and credentials
+are read once the command runs, so summarize and --help start without loading
+PyMuPDF, Pillow, Dropbox or OpenAI.
+"""
+
+import argparse
+
+from kabalot.config import DEFAULT_CONFIG_FILE, DEFAULT_CREDS_FILE, load_config
+
+def get_config(args):
+    config = load_config(args.config)
+    print("config: ", config)
+    # The Dropbox token is read from here on the first upload
+    config["creds_file"] = args.creds
+    return config
+
+def use_fake_dropbox(config):
+    from kabalot.bench import start_fake_dropbox_server
+    config["dropbox_api_url"] = start_fake_dropbox_server()
+    config.setdefault("dropbox_access_token", "fake")
+
+def run_extract(args):
+    from kabalot.cache import clear_extraction_cache
+    from kabalot.config import test_config
+    from kabalot.dedupe import release_duplicate
+    from kabalot.metrics import run_measured
+    from kabalot.pipeline import extract_files, main_extract
+    from kabalot.watch import watch_input_dirs
+    config = get_config(args)
+    test_config.update(mock_openai=args.mock_openai, mock_dropbox=args.mock_dropbox)
+    if args.fake_dropbox:
+        use_fake_dropbox(config)
+    if args.clear_cache:
+        clear_extraction_cache(config)
+    for file_path in args.release_duplicate:
+        release_duplicate(config, file_path)
+
+    if args.watch:
+        watch_input_dirs(config)
+    elif args.files:
+        run_measured(config, extract_files, args.files)
+    else:
+        run_measured(config, main_extract)
+
+def run_upload(args):
+    from kabalot.upload import upload_files_to_dropbox
+    config = get_config(args)
+    if args.fake_dropbox:
+        use_fake_dropbox(config)
+    links = upload_files_to_dropbox(config, args.files)
+    for file_path, link in links.items():
+        print(f"{file_path}: {link}")
+
+def run_summarize(args):
+    from kabalot.metrics import run_measured
+    from kabalot.excel import write_summaries
+    from kabalot.store import import_json_invoices
+    config = get_config(args)
+    if args.import_json:
+        import_json_invoices(config, args.import_json)
+    run_measured(config, write_summaries, args.rebuild)
+
+def run_clean(args):
+    from kabalot.cache import clear_extraction_cache
+    from kabalot.clean import clean_output_directory
+    config = get_config(args)
+    clean_output_directory(config)
+    if args.cache:
+        clear_extraction_cache(config)
+
+def run_bench(args):
+    from kabalot import bench
+    config = get_config(args)
+    if args.render:
+        bench.benchmark_renderers(config, args.render)
+    elif args.preprocess:
+        bench.report_preprocessing_savings(config, args.preprocess)
+    else:
+        bench.run_benchmark(config)
+
+def get_parser():
+    parser = argparse.ArgumentParser(prog="kabalot", description="Extract, upload and summarize receipts and invoices.")
+    parser.add_argument("--config", default=DEFAULT_CONFIG_FILE, help="job config file (default: %(default)s)")
+    parser.add_argument("--creds", default=DEFAULT_CREDS_FILE, help="credentials file (default: %(default)s)")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    extract = commands.add_parser("extract", help="extract the new receipts in input_dirs, upload them and update the summary")
+    extract.add_argument("files", nargs="*", help="process these files instead of input_dirs")
+    extract.add_argument("--watch", action="store_true", help="keep running and process receipts as they land in input_dirs")
+    extract.add_argument("--mock-openai", action="store_true", help="use a canned invoice instead of calling OpenAI")
+    extract.add_argument("--mock-dropbox", action="store_true", help="don't upload, use a placeholder link")
+    extract.add_argument("--fake-dropbox", action="store_true", help="upload to a local in-memory fake Dropbox server")
+    extract.add_argument("--clear-cache", action="store_true", help="clear the extraction cache first")
+    extract.add_argument("--release-duplicate", action="append", default=[], metavar="FILE",
+                         help="input file reviewed as not being a duplicate, to process on this run")
+    extract.set_defaults(run=run_extract)
+
+    upload = commands.add_parser("upload", help="upload files to Dropbox and print their shared links")
+    upload.add_argument("files", nargs="+")
+    upload.add_argument("--fake-dropbox", action="store_true", help="upload to a local in-memory fake Dropbox server")
+    upload.set_defaults(run=run_upload)
+
+    summarize = commands.add_parser("summarize", help="bring the Excel summary (and CSV) up to date with the extracted invoices")
+    summarize.add_argument("--rebuild", action="store_true", help="write the workbook from scratch")
+    summarize.add_argument("--import-json", metavar="DIR", help="import a directory of invoice JSON files into the invoice store first")
+    summarize.set_defaults(run=run_summarize)
+
+    clean = commands.add_parser("clean", help="delete the extracted invoices so everything is extracted again")
+    clean.add_argument("--cache", action="store_true", help="clear the extraction cache too")
+    clean.set_defaults(run=run_clean)
+
+    bench = commands.add_parser("bench", help="run the end-to-end benchmark on synthetic invoices against local mock services")
+    bench.add_argument("--render", nargs="+", metavar="PDF", help="compare the PDF renderers on these files instead")
+    bench.add_argument("--preprocess", metavar="DIR", help="report the token savings of image preprocessing on DIR instead")
+    bench.set_defaults(run=run_bench)
+    return parser
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+    args.run(args)
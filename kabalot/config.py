@@ -0,0 +1,83 @@
+"""Loading the job config, the credentials, and the pipeline and dedupe settings.
+
+Kept free of heavy imports so any command can read them quickly.
+"""
+
+import json
+
+DEFAULT_CONFIG_FILE = './config/kabalot.json'
+DEFAULT_CREDS_FILE = './secrets/secrets.json'
+
+def load_config(config_file):
+    required_fields = {
+        "output_dir": "Output directory",
+        "input_dirs": "Input directories",
+        "upload_path": "Upload path",
+        "dropbox_path": "Dropbox path",
+        "excel_path": "Excel output path"  # Changed from csv_path to excel_pathrom csv_path to excel_path
+    }
+    
+    with open(config_file, 'r', encoding='utf-8') as f:
+        config = json.load(f)
+    
+    # Validate all required fields exist
+    missing = [field for field, name in required_fields.items() 
+              if not config.get(field)]
+    if missing:
+        raise ValueError(f"Missing required fields: {', '.join(missing)}")
+        
+    return config
+
+def get_dropbox_token(creds_file):
+    """Read Dropbox access token from credentials file."""
+    try:
+        with open(creds_file, 'r', encoding='utf-8') as cred_file:
+            creds = json.load(cred_file)
+            dropbox_access_token = creds.get("dropbox")
+            if not dropbox_access_token:
+                raise ValueError("Dropbox access token not found in credentials file.")
+            print("dropbox token: ", dropbox_access_token[-4:])
+            return dropbox_access_token
+    except FileNotFoundError:
+        raise FileNotFoundError(f"Credentials file not found: {creds_file}")
+    except json.JSONDecodeError:
+        raise ValueError(f"Invalid JSON in credentials file: {creds_file}")
+
+# Mock switches for trying the pipeline without calling OpenAI or Dropbox, set by the CLI
+test_config = {}
+
+DEFAULT_PIPELINE_SETTINGS = {
+    "mode": "serial",
+    "render_workers": 2,
+    "openai_workers": 8,
+    "upload_workers": 4,
+    "queue_size": 16,
+}
+
+def get_pipeline_settings(config):
+    settings = dict(DEFAULT_PIPELINE_SETTINGS)
+    settings.update(config.get("pipeline", {}))
+    if settings["mode"] not in ("serial", "concurrent", "batch"):
+        raise ValueError(f"Unknown pipeline mode: {settings['mode']}")
+    for key in ("render_workers", "openai_workers", "upload_workers", "queue_size"):
+        if int(settings[key]) < 1:
+            raise ValueError(f"pipeline.{key} must be at least 1")
+        settings[key] = int(settings[key])
+    return settings
+
+DEFAULT_DEDUPE_SETTINGS = {
+    "enabled": False,
+    "path": "./state/dedupe.jsonl",
+    # Suspected duplicates are listed here for review instead of being processed
+    "review_path": "./state/duplicates.jsonl",
+    # Most bits of the 256 bit first page hashes that may differ between two copies of a receipt
+    "max_phash_distance": 24,
+    # Invoices from one vendor share a layout and hash alike, so by default a first page match
+    # only marks a suspect and the invoice key check after extraction decides
+    "skip_on_phash": False,
+}
+
+def get_dedupe_settings(config):
+    settings = dict(DEFAULT_DEDUPE_SETTINGS)
+    settings.update(config.get("dedupe", {}))
+    return settings
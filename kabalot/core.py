@@ -0,0 +1,551 @@
+"""Extraction: turn the rendered pages of an input file into validated invoice data.
+
+Answers are checked and normalized as they come back, asked again with the strict
+schema when they fail, and checkpointed per page for multi-page invoices.
+"""
+
+import hashlib
+import itertools
+import json
+import math
+import os
+import re
+import threading
+
+from kabalot import prompt
+from kabalot.cache import get_cache_key, get_cache_settings, get_cached_response, store_cached_extraction
+from kabalot.config import test_config
+from kabalot.metrics import get_usage_counts
+from kabalot.prompt import (estimate_page_tokens, get_chat_request, get_document_content, get_document_request,
+    get_extraction_request, get_mock_invoice_json, get_page_content, get_prompt_fingerprint)
+from kabalot.ratelimit import create_chat_completion
+from kabalot.render import iter_file_pages, render_file_pages
+from kabalot.report import (get_charge_value, get_currency_code, get_plate_number, get_report_settings,
+    get_summary_items, iter_line_items, parse_invoice_date)
+
+# Tokens and latency of the model calls by page kind, to tune the text layer threshold
+page_kind_stats = {kind: {"pages": 0, "prompt_tokens": 0, "completion_tokens": 0, "seconds": 0.0, "estimated_image_tokens": 0}
+                   for kind in ("text", "image")}
+_page_kind_lock = threading.Lock()
+
+def count_page_kind(page, usage, seconds):
+    with _page_kind_lock:
+        stats = page_kind_stats[page["kind"]]
+        stats["pages"] += 1
+        stats["seconds"] += seconds
+        stats["estimated_image_tokens"] += page.get("estimated_image_tokens", 0)
+        if usage is not None:
+            stats["prompt_tokens"] += usage.prompt_tokens
+            stats["completion_tokens"] += usage.completion_tokens
+
+def report_page_kind_stats():
+    text, image = page_kind_stats["text"], page_kind_stats["image"]
+    if not text["pages"] and not image["pages"]:
+        return
+    print(f"Pages sent as text: {text['pages']}, as images: {image['pages']}")
+    if text["pages"] and image["pages"] and image["prompt_tokens"]:
+        # The image pages tell how many prompt tokens a request takes besides the image itself
+        overhead = (image["prompt_tokens"] - image["estimated_image_tokens"]) / image["pages"]
+        as_images = text["estimated_image_tokens"] + overhead * text["pages"]
+        print(f"Text pages used {text['prompt_tokens']} prompt tokens, about {as_images:.0f} as images, "
+              f"saving about {as_images - text['prompt_tokens']:.0f} tokens")
+    elif text["pages"]:
+        print(f"Text pages used {text['prompt_tokens']} prompt tokens, "
+              f"their images would have been about {text['estimated_image_tokens']} tokens on top of the prompt")
+    for kind, stats in page_kind_stats.items():
+        if stats["pages"]:
+            print(f"Average {kind} page: {stats['seconds'] / stats['pages']:.2f}s, "
+                  f"{stats['prompt_tokens'] / stats['pages']:.0f} prompt tokens")
+    with _page_kind_lock:
+        for stats in page_kind_stats.values():
+            stats.update({"pages": 0, "prompt_tokens": 0, "completion_tokens": 0, "seconds": 0.0, "estimated_image_tokens": 0})
+
+# Whole-document requests, to compare prompt tokens per invoice with the per-page calls
+document_stats = {"requests": 0, "pages": 0, "prompt_tokens": 0, "completion_tokens": 0, "seconds": 0.0}
+
+def report_document_stats():
+    if not document_stats["requests"]:
+        return
+    requests = document_stats["requests"]
+    print(f"Whole-document requests: {requests} invoices with {document_stats['pages']} pages, "
+          f"{document_stats['prompt_tokens'] / requests:.0f} prompt tokens and "
+          f"{document_stats['seconds'] / requests:.2f}s per invoice")
+    with _page_kind_lock:
+        document_stats.update({"requests": 0, "pages": 0, "prompt_tokens": 0, "completion_tokens": 0, "seconds": 0.0})
+
+def extract_document_data(pages):
+    if test_config and test_config.get("mock_openai"):
+        print("Using mock OpenAI response")
+        return get_mock_invoice_json()
+
+    response, seconds = create_chat_completion(get_document_request(pages), pages)
+    # Some compatible servers leave usage out
+    prompt_tokens, completion_tokens, _ = get_usage_counts(response.usage)
+    with _page_kind_lock:
+        document_stats["requests"] += 1
+        document_stats["pages"] += len(pages)
+        document_stats["seconds"] += seconds
+        document_stats["prompt_tokens"] += prompt_tokens
+        document_stats["completion_tokens"] += completion_tokens
+    return response.choices[0].message.content
+
+def extract_invoice_data(page):
+    if test_config and test_config.get("mock_openai"):
+        print("Using mock OpenAI response")
+        count_page_kind(page, None, 0.0)
+        return get_mock_invoice_json()
+
+    response, seconds = create_chat_completion(get_extraction_request(page), [page])
+    count_page_kind(page, response.usage, seconds)
+    return response.choices[0].message.content
+
+def get_invoice_data(config, page):
+    """Return the extracted JSON for a page, from the extraction cache when possible."""
+    return get_cached_response(config, [page], False, lambda: extract_invoice_data(page))
+
+def get_document_data(config, pages):
+    """Return the extracted JSON for all pages of an invoice in one request, from the extraction cache when possible."""
+    return get_cached_response(config, pages, True, lambda: extract_document_data(pages))
+
+def parse_page_data(file_path, invoice_json):
+    return add_input_file(file_path, json.loads(invoice_json))
+
+def add_input_file(file_path, invoice_data):
+    # Add input file path to invoice_summary
+    if 'invoice_summary' not in invoice_data:
+        invoice_data['invoice_summary'] = {}
+    invoice_data['invoice_summary']['input_file'] = file_path
+    return invoice_data
+
+DEFAULT_VALIDATION_SETTINGS = {
+    "enabled": True,
+    # Times an answer that fails validation is asked again, with the strict JSON schema
+    "max_retries": 1,
+    # The line items of a single page invoice add up to total_charge before or after VAT
+    "check_total": True,
+    "vat_rates": [0.17, 0.18],
+    "total_tolerance": 0.01,
+    # Pages of multi-page invoices that passed, so an interrupted run picks up where it stopped
+    "checkpoint_dir": "./state/checkpoints",
+}
+
+# ISO 4217 codes of the currencies invoices come in; any other code is taken for a misread
+KNOWN_CURRENCY_CODES = {"ILS", "USD", "EUR", "GBP", "CHF", "JPY", "CAD", "AUD", "NZD", "CNY", "HKD", "SGD", "INR",
+                        "THB", "KRW", "SEK", "NOK", "DKK", "PLN", "CZK", "HUF", "RON", "BGN", "TRY", "UAH", "AED",
+                        "JOD", "EGP", "ZAR", "BRL", "MXN"}
+
+# Section the line items of a strict answer are put under, the one the free form answers use
+STRICT_SECTION = 'Details of Services Charged'
+
+# Failed and fixed answers and pages resumed from checkpoints, counted for the run
+validation_stats = {"invalid": 0, "retries": 0, "fixed": 0, "unfixed": 0, "resumed": 0}
+_validation_lock = threading.Lock()
+_checkpoint_lock = threading.Lock()
+
+def get_validation_settings(config):
+    settings = dict(DEFAULT_VALIDATION_SETTINGS)
+    settings.update(config.get("validation", {}))
+    return settings
+
+def count_validation_event(event):
+    with _validation_lock:
+        validation_stats[event] += 1
+
+def report_validation_stats():
+    if not any(validation_stats.values()):
+        return
+    print(f"Validation: {validation_stats['invalid']} answers failed, {validation_stats['retries']} retries, "
+          f"{validation_stats['fixed']} fixed, {validation_stats['unfixed']} kept with errors, "
+          f"{validation_stats['resumed']} pages resumed from checkpoints")
+    with _validation_lock:
+        validation_stats.update(dict.fromkeys(validation_stats, 0))
+
+def parse_amount(value):
+    """A charge as a float, also when written with a currency like '₪25' or '25.00 ש"ח'; None if it has no number."""
+    if isinstance(value, bool):
+        return None
+    amount = get_charge_value(value)
+    if amount is None:
+        match = re.search(r"-?\d[\d,]*(?:\.\d+)?", str(value or ''))
+        amount = get_charge_value(match.group()) if match else None
+    return amount if amount is not None and math.isfinite(amount) else None
+
+def get_identifier(value):
+    """Invoice numbers and company ids as text, also when the model wrote them as numbers."""
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value) if isinstance(value, (int, float)) else value
+
+def validate_page_data(config, invoice_data, first_page=True, whole_invoice=False):
+    """Check one parsed answer and normalize it in place; returns the problems found, empty when it is valid.
+
+    Charges become floats, the invoice date an ISO date and the currency an ISO
+    code. Only the invoice_summary of the first page is checked, it is the one
+    the summary uses. An answer for the whole invoice also has its line items
+    checked against total_charge.
+    """
+    settings = get_validation_settings(config)
+    report_settings = get_report_settings(config)
+    errors = []
+    for _, section, item in iter_line_items([invoice_data]):
+        for key in report_settings["charge_keys"]:
+            if item.get(key) in (None, ''):
+                continue
+            amount = parse_amount(item[key])
+            if amount is None:
+                errors.append(f"the {key} '{item[key]}' of a line item in {section} is not a number")
+            else:
+                item[key] = amount
+    if not first_page:
+        return errors
+
+    summary = invoice_data.get('invoice_summary')
+    total = parse_amount(summary.get('total_charge'))
+    if total is None:
+        errors.append(f"total_charge '{summary.get('total_charge')}' is not a number")
+    else:
+        summary['total_charge'] = total
+    invoice_date = parse_invoice_date(summary.get('date_of_invoice'))
+    if invoice_date is None:
+        errors.append(f"date_of_invoice '{summary.get('date_of_invoice')}' is not a date")
+    else:
+        summary['date_of_invoice'] = invoice_date
+    currency = get_currency_code(summary.get('currency'))
+    if currency not in KNOWN_CURRENCY_CODES:
+        errors.append(f"currency '{summary.get('currency')}' is not an ISO 4217 currency code")
+    else:
+        summary['currency'] = currency
+    if summary.get('type_code') != "?" and summary.get('type_code') not in prompt.prompt_settings["expense_types"]:
+        errors.append(f"type_code '{summary.get('type_code')}' is not one of the expense type codes")
+    for field in ('invoice_number', 'company_id'):
+        if field in summary:
+            summary[field] = get_identifier(summary[field])
+
+    if whole_invoice and total is not None and settings["check_total"]:
+        error = get_total_error(settings, report_settings, [invoice_data], total)
+        if error:
+            errors.append(error)
+    return errors
+
+def get_total_items(settings, items, total):
+    """The summary items whose charges come closest to total_charge, before or after VAT, and how far off they are.
+
+    Section names follow the language of the invoice, so the section is not
+    looked up by name: each section is tried alone, since the model may repeat
+    the same charges under another section, like a per vehicle breakdown, and
+    all of them together for invoices that split their charges over sections.
+    Returns ([], None) when no line item has a charge.
+    """
+    sections = {}
+    for item in items:
+        if item[3] is not None:
+            sections.setdefault(item[1], []).append(item)
+    candidates = list(sections.values())
+    if len(candidates) > 1:
+        candidates.append([item for section in sections.values() for item in section])
+    best, best_difference = [], None
+    for candidate in candidates:
+        items_total = sum(item[3] for item in candidate)
+        difference = min(abs(items_total * (1 + rate) - total) for rate in [0] + settings["vat_rates"])
+        if best_difference is None or difference < best_difference:
+            best, best_difference = candidate, difference
+    return best, best_difference
+
+def get_total_error(settings, report_settings, pages, total):
+    """The problem with line item charges that add up to neither total_charge nor total_charge before VAT, if any."""
+    items, difference = get_total_items(settings, get_summary_items(pages, report_settings), total)
+    if not items or difference <= settings["total_tolerance"] * max(abs(total), 1.0):
+        return None
+    return (f"the line item charges add up to {round(sum(item[3] for item in items), 2)}, "
+            f"not to the total_charge {total} before or after VAT")
+
+def read_page_answer(config, file_path, invoice_json, first_page, whole_invoice, strict=False):
+    """Parse and validate one answer; returns the page data, None if it is not a JSON object, and its problems."""
+    try:
+        invoice_data = json.loads(invoice_json)
+    except (TypeError, ValueError) as e:
+        return None, [f"the answer is not valid JSON: {e}"]
+    if not isinstance(invoice_data, dict):
+        return None, ["the answer is not a JSON object"]
+    if strict and isinstance(invoice_data.get('line_items'), list):
+        invoice_data = get_free_form_data(invoice_data)
+    if not isinstance(invoice_data.get('invoice_summary', {}), dict):
+        return None, ["invoice_summary is not a JSON object"]
+    add_input_file(file_path, invoice_data)
+    return invoice_data, validate_page_data(config, invoice_data, first_page, whole_invoice)
+
+def get_strict_page_schema():
+    """JSON schema for structured outputs: every field is required, missing values are null."""
+    def nullable(kind, description=None):
+        schema = {"type": [kind, "null"]}
+        if description:
+            schema["description"] = description
+        return schema
+
+    line_item = {
+        "type": "object",
+        "properties": {"description": nullable("string"), "license_plate": nullable("string"),
+                       "charge": nullable("number", "the amount charged for this line")},
+        "required": ["description", "license_plate", "charge"],
+        "additionalProperties": False,
+    }
+    summary = {
+        "type": "object",
+        "properties": {
+            "total_charge": {"type": "number"},
+            "date_of_invoice": {"type": "string", "description": "the invoice date as YYYY-MM-DD"},
+            "invoice_number": nullable("string"),
+            "company_id": nullable("string"),
+            "currency": {"type": "string", "description": "ISO 4217 currency code, ILS if not specified"},
+            "expense_type": {"type": "string"},
+            "type_code": {"type": "string", "enum": list(prompt.prompt_settings["expense_types"]) + ["?"]},
+        },
+        "required": ["total_charge", "date_of_invoice", "invoice_number", "company_id", "currency", "expense_type",
+                     "type_code"],
+        "additionalProperties": False,
+    }
+    return {
+        "type": "object",
+        "properties": {"line_items": {"type": "array", "items": line_item}, "invoice_summary": summary},
+        "required": ["line_items", "invoice_summary"],
+        "additionalProperties": False,
+    }
+
+def get_strict_request(pages, errors, document):
+    """The extraction request again, with the problems of the previous answer and a strict response schema."""
+    content = get_document_content(pages) if document else get_page_content(pages[0])
+    content.append({"type": "text", "text": "a previous answer was rejected because:\n"
+                    + "\n".join(f"* {error}" for error in errors)
+                    + "\nanswer again, following the JSON schema."})
+    request = get_chat_request(content)
+    request["response_format"] = {"type": "json_schema", "json_schema": {
+        "name": "invoice_page", "strict": True, "schema": get_strict_page_schema()}}
+    return request
+
+def get_free_form_data(strict_data):
+    """Turn an answer in the strict schema into the shape of the free form answers, leaving out null values."""
+    items = [{"Description": item.get("description"), "License Plate": item.get("license_plate"),
+              "Charge": item.get("charge")} for item in strict_data["line_items"] if isinstance(item, dict)]
+    summary = strict_data.get("invoice_summary")
+    if isinstance(summary, dict):
+        summary = {key: value for key, value in summary.items() if value is not None}
+    return {STRICT_SECTION: [{key: value for key, value in item.items() if value is not None} for item in items],
+            "invoice_summary": summary if summary is not None else {}}
+
+def extract_strict_data(pages, errors, document):
+    if test_config and test_config.get("mock_openai"):
+        print("Using mock OpenAI response")
+        return get_mock_invoice_json()
+
+    response, _ = create_chat_completion(get_strict_request(pages, errors, document), pages)
+    return response.choices[0].message.content
+
+def get_retry_pages(config, file_path, key):
+    """Render the pages of an answer again for a retry, in batch runs where they were not kept."""
+    pages = render_file_pages(config, file_path)
+    return pages if key == "doc" else [pages[key]]
+
+def get_checked_page_data(config, file_path, key, invoice_json, pages=None, whole_invoice=False):
+    """Parse and validate the answer for page key ("doc" for a whole document request) of a file.
+
+    An answer that fails is asked again for these pages only, with the strict
+    schema, up to max_retries times. What still fails is kept with its
+    problems in invoice_summary.validation_errors rather than dropping the file.
+    """
+    settings = get_validation_settings(config)
+    if not settings["enabled"]:
+        return parse_page_data(file_path, invoice_json)
+    document = key == "doc"
+    first_page = document or key == 0
+    whole_invoice = whole_invoice or document
+    invoice_data, errors = read_page_answer(config, file_path, invoice_json, first_page, whole_invoice)
+    if errors:
+        count_validation_event("invalid")
+    label = "Invoice" if document else f"Page {key + 1}"
+    for _ in range(settings["max_retries"]):
+        if not errors:
+            break
+        print(f"{label} of {file_path} failed validation, asking again: {'; '.join(errors)}")
+        count_validation_event("retries")
+        if pages is None:
+            pages = get_retry_pages(config, file_path, key)
+        try:
+            retry_data, retry_errors = read_page_answer(config, file_path, extract_strict_data(pages, errors, document),
+                                                        first_page, whole_invoice, strict=True)
+        except Exception as e:
+            print(f"Retry of {label.lower()} of {file_path} failed: {str(e)}")
+            break
+        if retry_data is not None and (invoice_data is None or len(retry_errors) <= len(errors)):
+            invoice_data, errors = retry_data, retry_errors
+            if not errors:
+                count_validation_event("fixed")
+                store_fixed_answer(config, pages, document, invoice_data)
+    if errors:
+        count_validation_event("unfixed")
+        print(f"{label} of {file_path} kept with validation errors: {'; '.join(errors)}")
+        if invoice_data is None:
+            invoice_data = parse_page_data(file_path, "{}")
+        invoice_data['invoice_summary']['validation_errors'] = errors
+    return invoice_data
+
+def store_fixed_answer(config, pages, document, invoice_data):
+    """Replace a cached answer that failed validation with the fixed one, so the next run does not ask again."""
+    settings = get_cache_settings(config)
+    if not settings["enabled"] or (test_config and test_config.get("mock_openai")):
+        return
+    answer = dict(invoice_data)
+    answer['invoice_summary'] = {key: value for key, value in invoice_data['invoice_summary'].items()
+                                 if key != 'input_file'}
+    store_cached_extraction(settings, get_cache_key(pages, document), json.dumps(answer, ensure_ascii=False))
+
+def check_invoice_total(config, invoice):
+    """Flag a multi-page invoice whose line items do not add up to its total; it cannot tell which page is wrong."""
+    settings = get_validation_settings(config)
+    if not settings["enabled"] or not settings["check_total"] or len(invoice) < 2:
+        return
+    summary = invoice[0]['invoice_summary']
+    if not isinstance(summary.get('total_charge'), float):
+        return
+    error = get_total_error(settings, get_report_settings(config), invoice, summary['total_charge'])
+    if error:
+        print(f"Invoice of {summary.get('input_file')}: {error}")
+        summary.setdefault('validation_errors', []).append(error)
+
+def get_checkpoint_path(settings, file_path):
+    name = hashlib.sha256(os.path.abspath(file_path).encode("utf-8")).hexdigest()[:32]
+    return os.path.join(settings["checkpoint_dir"], f"{name}.jsonl")
+
+def get_checkpoint_stamp(file_path):
+    # A changed input file or system prompt makes the pages of an old checkpoint stale
+    stat = os.stat(file_path)
+    return [stat.st_size, stat.st_mtime_ns, get_prompt_fingerprint()]
+
+def read_page_checkpoint(config, file_path):
+    """The pages of a file that passed validation in an interrupted run, by page number; empty when there are none."""
+    settings = get_validation_settings(config)
+    path = get_checkpoint_path(settings, file_path)
+    with _checkpoint_lock:
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                lines = f.read().splitlines()
+        except FileNotFoundError:
+            return {}
+        try:
+            header = json.loads(lines[0])
+        except (IndexError, ValueError):
+            header = {}
+        if header.get("stamp") != get_checkpoint_stamp(file_path):
+            os.remove(path)
+            return {}
+    pages = {}
+    for line in lines[1:]:
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            # The last line of a run that was killed while writing it
+            continue
+        pages[entry["page"]] = entry["data"]
+    if pages:
+        print(f"Resuming {file_path} with {len(pages)} checked pages")
+    return pages
+
+def save_page_checkpoint(config, file_path, page_num, invoice_data):
+    settings = get_validation_settings(config)
+    path = get_checkpoint_path(settings, file_path)
+    with _checkpoint_lock:
+        os.makedirs(settings["checkpoint_dir"], exist_ok=True)
+        with open(path, 'a', encoding='utf-8') as f:
+            if f.tell() == 0:
+                f.write(json.dumps({"file": file_path, "stamp": get_checkpoint_stamp(file_path)}) + "\n")
+            f.write(json.dumps({"page": page_num, "data": invoice_data}, ensure_ascii=False) + "\n")
+
+def clear_page_checkpoint(config, file_path):
+    if not file_path:
+        return
+    path = get_checkpoint_path(get_validation_settings(config), file_path)
+    with _checkpoint_lock:
+        if os.path.exists(path):
+            os.remove(path)
+
+def get_checkpointed_page(config, file_path, page_num, checkpoint, single_page, extract):
+    """Take a page from the checkpoint of an interrupted run, or extract() it and add it to the checkpoint if it passed."""
+    if page_num in checkpoint:
+        count_validation_event("resumed")
+        return checkpoint[page_num]
+    invoice_data = extract()
+    if not single_page and 'validation_errors' not in invoice_data['invoice_summary']:
+        save_page_checkpoint(config, file_path, page_num, invoice_data)
+    return invoice_data
+
+def extract_checked_page(config, file_path, page, checkpoint, single_page):
+    page_num = page["page_num"]
+    return get_checkpointed_page(config, file_path, page_num, checkpoint, single_page, lambda: get_checked_page_data(
+        config, file_path, page_num, get_invoice_data(config, page), [page], whole_invoice=single_page))
+
+DEFAULT_DOCUMENT_SETTINGS = {
+    "enabled": False,
+    "max_pages": 8,
+    "max_images": 8,
+    "max_page_tokens": 12000,
+}
+
+def get_document_settings(config):
+    settings = dict(DEFAULT_DOCUMENT_SETTINGS)
+    settings.update(config.get("document", {}))
+    return settings
+
+def fits_document_request(settings, pages):
+    """Tell whether the pages of an invoice fit the budget for a single whole-document request."""
+    if not settings["enabled"] or not 1 < len(pages) <= settings["max_pages"]:
+        return False
+    images = sum(1 for page in pages if page["kind"] == "image")
+    tokens = sum(estimate_page_tokens(page) for page in pages)
+    return images <= settings["max_images"] and tokens <= settings["max_page_tokens"]
+
+def extract_from_multiple_pages(config, file_path):
+    pages = iter_file_pages(config, file_path)
+    settings = get_document_settings(config)
+    # One page more than the budget is enough to tell that the invoice is too long, two that it has more than one page
+    first_pages = list(itertools.islice(pages, settings["max_pages"] + 1 if settings["enabled"] else 2))
+    if fits_document_request(settings, first_pages):
+        print(f"Extracting all {len(first_pages)} pages in one request")
+        return [get_checked_page_data(config, file_path, "doc", get_document_data(config, first_pages), first_pages)]
+
+    single_page = len(first_pages) == 1
+    checkpoint = {} if single_page else read_page_checkpoint(config, file_path)
+    entire_invoice = []
+    for page in itertools.chain(first_pages, pages):
+        entire_invoice.append(extract_checked_page(config, file_path, page, checkpoint, single_page))
+    check_invoice_total(config, entire_invoice)
+    return entire_invoice
+
+def apply_vehicle_plates(config, invoice):
+    """Count only the share of the configured vehicles in the total_charge of a vehicle invoice.
+
+    This used to be a rule in the prompt. Done here, it is deterministic and
+    the plates can change without extracting anything again. The line items
+    are taken from the section that adds up to the total, as in the total
+    check, and the total is scaled by the configured plates' share of their
+    charges, so VAT and fees stay in. The total of the whole invoice is kept as
+    invoice_total_charge. Invoices without line items for other plates are
+    left as they are.
+    """
+    summary = invoice[0].get('invoice_summary') if invoice else None
+    plates = {get_plate_number(plate) for plate in prompt.prompt_settings["vehicle_plates"]}
+    if not summary or not plates or summary.get('type_code') not in prompt.prompt_settings["vehicle_type_codes"]:
+        return
+    # Scaled from the whole invoice's total, so applying the plates again changes nothing
+    total = get_charge_value(summary.get('invoice_total_charge', summary.get('total_charge')))
+    if total is None:
+        return
+    items = get_summary_items(invoice, get_report_settings(config))
+    items, _ = get_total_items(get_validation_settings(config), items, total)
+    items = [item for item in items if item[2]]
+    charges = [charge for _, _, plate, charge in items if plate in plates]
+    items_total = sum(item[3] for item in items)
+    if len(charges) == len(items) or not items_total:
+        return
+    summary.setdefault('invoice_total_charge', total)
+    summary['total_charge'] = round(total * sum(charges) / items_total, 2)
+    print(f"Counted {len(charges)} of {len(items)} vehicle charges: {summary['total_charge']} "
+          f"of {summary['invoice_total_charge']}")
@@ -0,0 +1,206 @@
+"""Duplicate receipts: the same file again, a rescan of the same receipt and the same invoice extracted twice."""
+
+import json
+import mimetypes
+import os
+import threading
+from datetime import datetime
+
+import fitz  # PyMuPDF
+from PIL import Image, ImageOps
+
+from kabalot.config import get_dedupe_settings, test_config
+from kabalot.manifest import hash_file
+from kabalot.render import DEFAULT_PREPROCESS_SETTINGS, crop_to_content, render_pdf_page_image
+from kabalot.report import get_charge_value
+
+# Dedupe entries by absolute input path, loaded once per run
+_dedupe = {"path": None, "entries": {}}
+# Reentrant so an invoice key can be checked and recorded in one step
+_dedupe_lock = threading.RLock()
+
+def is_dedupe_enabled(config):
+    # Mock OpenAI answers are all the same invoice, indexing them would mark every real file after the first a duplicate
+    return get_dedupe_settings(config)["enabled"] and not (test_config and test_config.get("mock_openai"))
+
+def load_dedupe_index(config):
+    """Return the dedupe entries: content hash, first page hash and invoice key of every input file seen.
+
+    Like the manifest, the index is an append-only JSONL file where later lines win.
+    """
+    index_path = get_dedupe_settings(config)["path"]
+    with _dedupe_lock:
+        if _dedupe["path"] != index_path:
+            entries = {}
+            if os.path.exists(index_path):
+                with open(index_path, 'r', encoding='utf-8') as f:
+                    for line in f:
+                        if line.strip():
+                            entry = json.loads(line)
+                            entries[entry["path"]] = entry
+            _dedupe["path"] = index_path
+            _dedupe["entries"] = entries
+        return _dedupe["entries"]
+
+def update_dedupe_entry(config, path, fields):
+    entries = load_dedupe_index(config)
+    index_path = get_dedupe_settings(config)["path"]
+    with _dedupe_lock:
+        entry = dict(entries.get(path, {"path": path}))
+        entry.update(fields)
+        entries[path] = entry
+        os.makedirs(os.path.dirname(index_path) or ".", exist_ok=True)
+        with open(index_path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+def add_to_review_list(config, path, duplicate_of, reason, **details):
+    review_path = get_dedupe_settings(config)["review_path"]
+    os.makedirs(os.path.dirname(review_path) or ".", exist_ok=True)
+    with _dedupe_lock, open(review_path, 'a', encoding='utf-8') as f:
+        f.write(json.dumps({"path": path, "duplicate_of": duplicate_of, "reason": reason,
+                            "detected_at": datetime.now().isoformat(timespec='seconds'), **details},
+                           ensure_ascii=False) + "\n")
+    print(f"Suspected duplicate of {duplicate_of} ({reason}), listed for review: {path}")
+
+def get_first_page_image(file_path):
+    """Render the first page of a PDF or JPEG as a small grayscale image for hashing."""
+    mime_type, _ = mimetypes.guess_type(file_path)
+    if mime_type == 'application/pdf':
+        with fitz.open(file_path) as pdf_document:
+            return render_pdf_page_image(pdf_document[0], 36, "gray")
+    if mime_type == 'image/jpeg':
+        with Image.open(file_path) as img:
+            # Let the JPEG decoder scale down while decoding
+            img.draft("L", (512, 512))
+            return ImageOps.exif_transpose(img).convert("L")
+    return None
+
+PHASH_SIZE = 16
+
+def get_perceptual_hash(file_path):
+    """dHash of the first page with its margins cropped: 256 bits comparing neighbouring pixels of a 17x16 thumbnail.
+
+    Cropping first lets a photo of a receipt match the PDF it was printed from.
+    """
+    img = get_first_page_image(file_path)
+    if img is None:
+        return None
+    img = crop_to_content(img, DEFAULT_PREPROCESS_SETTINGS["crop_threshold"], 0)
+    pixels = img.resize((PHASH_SIZE + 1, PHASH_SIZE), Image.LANCZOS).tobytes()
+    bits = 0
+    for row in range(PHASH_SIZE):
+        for col in range(PHASH_SIZE):
+            offset = row * (PHASH_SIZE + 1) + col
+            bits = (bits << 1) | (pixels[offset] > pixels[offset + 1])
+    return f"{bits:0{PHASH_SIZE * PHASH_SIZE // 4}x}"
+
+def get_hash_distance(first, second):
+    return bin(int(first, 16) ^ int(second, 16)).count("1")
+
+def find_duplicate_file(config, path, sha256, phash):
+    """Return (original path, reason, distance) for a file whose content or first page matches another input."""
+    max_distance = get_dedupe_settings(config)["max_phash_distance"]
+    best = None
+    for other in load_dedupe_index(config).values():
+        if other["path"] == path or other.get("duplicate_of"):
+            continue
+        if other.get("sha256") == sha256:
+            return other["path"], "sha256", 0
+        if phash and other.get("phash"):
+            distance = get_hash_distance(phash, other["phash"])
+            if distance <= max_distance and (best is None or distance < best[2]):
+                best = (other["path"], "phash", distance)
+    return best
+
+def filter_duplicate_files(config, file_paths):
+    """Drop the input files whose content (or, with skip_on_phash, rendered first page) matches another input file.
+
+    Every file that passes is added to the index, so the second copy within
+    one run is caught too. A file keeps being skipped until it changes or is
+    released with release_duplicate.
+    """
+    settings = get_dedupe_settings(config)
+    if not is_dedupe_enabled(config):
+        return file_paths
+    entries = load_dedupe_index(config)
+    selected = []
+    for file_path in file_paths:
+        if not os.path.isfile(file_path):
+            selected.append(file_path)
+            continue
+        path = os.path.abspath(file_path)
+        sha256 = hash_file(file_path)
+        entry = entries.get(path)
+        if entry is not None and entry.get("sha256") == sha256:
+            if entry.get("duplicate_of"):
+                print(f"Skipping {file_path}, a known duplicate of {entry['duplicate_of']}")
+                continue
+            selected.append(file_path)
+            continue
+        try:
+            phash = get_perceptual_hash(file_path)
+        except Exception as e:
+            print(f"Could not hash the first page of {file_path}: {str(e)}")
+            phash = None
+        duplicate = None if entry is not None and entry.get("released") else find_duplicate_file(config, path, sha256, phash)
+        if duplicate and duplicate[1] == "phash" and not settings["skip_on_phash"]:
+            print(f"{file_path} looks like {duplicate[0]}, its invoice is checked after extraction")
+            update_dedupe_entry(config, path, {"sha256": sha256, "phash": phash, "key": None, "duplicate_of": None,
+                                               "similar_to": duplicate[0], "distance": duplicate[2]})
+            selected.append(file_path)
+            continue
+        update_dedupe_entry(config, path, {"sha256": sha256, "phash": phash, "key": None, "similar_to": None,
+                                           "duplicate_of": duplicate[0] if duplicate else None})
+        if duplicate:
+            add_to_review_list(config, path, duplicate[0], duplicate[1], distance=duplicate[2])
+            continue
+        selected.append(file_path)
+    if len(selected) < len(file_paths):
+        print(f"Skipped {len(file_paths) - len(selected)} suspected duplicates")
+    return selected
+
+def get_invoice_key(invoice):
+    summary = invoice[0].get('invoice_summary', {}) if invoice else {}
+    invoice_number = str(summary.get('invoice_number') or '').strip()
+    if not invoice_number:
+        return None
+    total_charge = get_charge_value(summary.get('total_charge', ''))
+    return [str(summary.get('company_id') or '').strip(), invoice_number,
+            round(total_charge, 2) if total_charge is not None else None]
+
+def is_duplicate_invoice(config, file_path, invoice, record=True):
+    """Tell whether an extracted invoice has the company_id, invoice_number and total_charge of another input.
+
+    Checking and recording the key is one step under the dedupe lock, so of
+    two copies the one recorded first is the original; a duplicate is not
+    written and goes to the review list instead. The concurrent pipeline
+    records from its writer, in input order like the serial path, and only
+    looks with record=False before uploading.
+    """
+    if not is_dedupe_enabled(config):
+        return False
+    key = get_invoice_key(invoice)
+    if key is None:
+        return False
+    path = os.path.abspath(file_path)
+    with _dedupe_lock:
+        entries = load_dedupe_index(config)
+        entry = entries.get(path, {})
+        original = None
+        if not entry.get("released"):
+            original = next((other["path"] for other in entries.values() if other["path"] != path
+                             and not other.get("duplicate_of") and other.get("key") == key), None)
+        if not record:
+            return original is not None
+        if original is None:
+            update_dedupe_entry(config, path, {"key": key})
+            return False
+        update_dedupe_entry(config, path, {"key": key, "duplicate_of": original})
+    add_to_review_list(config, path, original, "invoice", company_id=key[0], invoice_number=key[1],
+                       total_charge=key[2], similar_first_page=entry.get("similar_to") == original)
+    return True
+
+def release_duplicate(config, file_path):
+    """Clear a suspected duplicate after review, so the next run processes it like any other file."""
+    update_dedupe_entry(config, os.path.abspath(file_path), {"duplicate_of": None, "released": True})
+    print(f"Released {file_path} from the duplicates review list")
@@ -0,0 +1,301 @@
+"""The Excel summary of the invoice JSON files in output_dir or of the invoice store, and its CSV copy."""
+
+import csv
+import json
+import os
+from datetime import datetime
+
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
+
+from kabalot.manifest import get_file_stamp, mark_manifest_summarized
+from kabalot.metrics import timed_stage
+from kabalot.report import (SUMMARY_FIELDS, SUMMARY_ITEM_FIELDS, get_currency_code, get_json_report_tables,
+    get_report_settings, get_store_report_tables, get_summary_items, get_totals_sheet_rows, write_report)
+from kabalot.store import (flush_invoice_store, get_store_connection, get_store_settings, iter_stored_summaries,
+    store_lock)
+
+# Number formats of total_charge: shekel amounts show the sign, other currencies only their two decimals
+ILS_FORMAT = '#,##0.00₪'
+AMOUNT_FORMAT = '#,##0.00'
+
+def get_summary_index_path(config):
+    return f"{config['excel_path']}.index.jsonl"
+
+def load_summary_index(index_path):
+    """Read the sidecar index: a header line followed by one line per JSON file in the workbook.
+
+    A file line is its name, size and mtime then its row and items as JSON, tab
+    separated, so finding new and changed files does not parse the rows. Lines
+    are only ever appended between rewrites, so later lines win.
+    """
+    if not os.path.exists(index_path):
+        return None
+    index = {"files": {}, "workbook": None, "totals": None}
+    try:
+        with open(index_path, 'r', encoding='utf-8') as f:
+            header = json.loads(f.readline())
+            if header != get_summary_index_header():
+                print("Summary fields changed since the index was written")
+                return None
+            # Split on newlines only, JSON strings may hold other line breaks
+            for line in f.read().split('\n'):
+                if line.startswith('{'):
+                    entry = json.loads(line)
+                    index["workbook"] = entry["workbook"]
+                    index["totals"] = entry.get("totals")
+                elif line:
+                    name, size, mtime, data = line.split('\t', 3)
+                    index["files"][json.loads(name)] = {"stamp": [int(size), int(mtime)], "data": data}
+    except (OSError, ValueError, KeyError) as e:
+        print(f"Warning: Could not read summary index {index_path}: {str(e)}")
+        return None
+    return index
+
+def decode_summary_index(files):
+    """Parse the row and items of the index entries that are still raw JSON."""
+    names = [name for name, entry in files.items() if "data" in entry]
+    # One loads call for all entries is much faster than one per entry
+    values = json.loads("[" + ",".join(files[name]["data"] for name in names) + "]")
+    for name, value in zip(names, values):
+        files[name] = {"stamp": files[name]["stamp"], "row": value["row"], "items": value["items"]}
+
+def get_summary_index_header():
+    return {"fields": SUMMARY_FIELDS, "items": SUMMARY_ITEM_FIELDS, "format": 2}
+
+def get_summary_index_lines(files, workbook_stamp, totals):
+    lines = []
+    for name, entry in files.items():
+        data = entry.get("data") or json.dumps({"row": entry["row"], "items": entry["items"]}, ensure_ascii=False)
+        lines.append(f"{json.dumps(name, ensure_ascii=False)}\t{entry['stamp'][0]}\t{entry['stamp'][1]}\t{data}")
+    # The workbook as written and the totals so far, so the next run only reports the new invoices
+    lines.append(json.dumps({"workbook": workbook_stamp, "totals": totals}, ensure_ascii=False))
+    return ''.join(f"{line}\n" for line in lines)
+
+def save_summary_index(index_path, files, workbook_stamp, totals):
+    temp_path = f"{index_path}.tmp"
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        f.write(json.dumps(get_summary_index_header()) + "\n")
+        f.write(get_summary_index_lines(files, workbook_stamp, totals))
+    os.replace(temp_path, index_path)
+
+def append_summary_index(index_path, files, workbook_stamp, totals):
+    with open(index_path, 'a', encoding='utf-8') as f:
+        f.write(get_summary_index_lines(files, workbook_stamp, totals))
+
+def read_summary_entry(file_path, report_settings):
+    """Read the summary row and the report line items of one invoice JSON file."""
+    with open(file_path, 'r', encoding='utf-8') as f:
+        invoice_data = json.load(f)
+    pages = invoice_data if isinstance(invoice_data, list) else [invoice_data]
+    invoice_dict = pages[0] if pages else {}
+    return {"row": get_summary_row(dict(invoice_dict.get('invoice_summary', {}))),
+            "items": get_summary_items(pages, report_settings)}
+
+def get_summary_row(summary):
+    # Convert total_charge to float
+    total_charge = summary.get('total_charge', '')
+    if isinstance(total_charge, str) and total_charge:
+        try:
+            summary['total_charge'] = float(total_charge.replace(',', ''))
+        except ValueError:
+            print(f"Warning: Could not convert total charge to float: {total_charge}")
+
+    row = []
+    for field in SUMMARY_FIELDS:
+        value = summary.get(field, '')
+        # Nested values can't go into a cell as they are
+        if isinstance(value, (dict, list)):
+            value = json.dumps(value, ensure_ascii=False)
+        row.append(value)
+    return row
+
+def keep_edited_workbook(excel_path, workbook_stamp):
+    """Move the workbook aside if it was changed since the summary last wrote it, so the changes are not lost.
+
+    Returns True if it was moved. A workbook the summary has no stamp for,
+    like one from before the index, counts as changed.
+    """
+    if not os.path.exists(excel_path) or get_file_stamp(excel_path) == workbook_stamp:
+        return False
+    root, ext = os.path.splitext(excel_path)
+    backup_path = f"{root}.edited-{datetime.now().strftime('%Y%m%d_%H%M%S')}{ext}"
+    os.replace(excel_path, backup_path)
+    print(f"Excel file was changed outside of the summary, kept it as {backup_path}")
+    return True
+
+def write_summary_workbook(excel_path, rows, totals):
+    """Write the summary and totals sheets in openpyxl's write-only mode; returns the stamp of the new workbook.
+
+    The workbook goes to a temporary file first, so an interrupted run
+    leaves the previous one in place.
+    """
+    charge_column = SUMMARY_FIELDS.index('total_charge')
+    currency_column = SUMMARY_FIELDS.index('currency')
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet(title="Invoice Summary")
+    ws.append(SUMMARY_FIELDS)
+    for row in rows:
+        row = [ILLEGAL_CHARACTERS_RE.sub('', value) if isinstance(value, str) else value for value in row]
+        charge = row[charge_column]
+        if isinstance(charge, (int, float)) and not isinstance(charge, bool):
+            cell = WriteOnlyCell(ws, value=charge)
+            cell.number_format = ILS_FORMAT if get_currency_code(row[currency_column]) == "ILS" else AMOUNT_FORMAT
+            row[charge_column] = cell
+        ws.append(row)
+
+    pivot_ws = wb.create_sheet(title="Pivot Summary")
+    for row in get_totals_sheet_rows(totals):
+        pivot_ws.append(row)
+    root, ext = os.path.splitext(excel_path)
+    temp_path = f"{root}.tmp{ext}"
+    wb.save(temp_path)
+    os.replace(temp_path, excel_path)
+    return get_file_stamp(excel_path)
+
+@timed_stage("excel")
+def write_invoice_summary_to_excel(config, rebuild=False):
+    """Bring the Excel summary up to date with the JSON invoices in output_dir.
+
+    A sidecar index next to the workbook keeps the row and line items of every
+    JSON file in it, so a run only parses the new and changed files and, when
+    files were only added, reports just the new invoices and adds their totals
+    to the stored ones. The workbook itself is written whole from the index
+    each time; a workbook changed outside of the summary is kept next to it
+    first.
+    """
+    excel_path = config["excel_path"]
+    json_dir = config["output_dir"]
+    index_path = get_summary_index_path(config)
+
+    print(f"\nStarting Excel summary generation...")
+    print(f"Reading JSON files from: {json_dir}")
+    print(f"Writing to Excel file: {excel_path}")
+
+    index = load_summary_index(index_path)
+    edited = keep_edited_workbook(excel_path, index["workbook"] if index is not None else None)
+    if rebuild:
+        index = None
+    known = index["files"] if index is not None else {}
+
+    current = {}
+    with os.scandir(json_dir) as entries:
+        for entry in entries:
+            if entry.name.endswith(".json") and entry.is_file():
+                stat = entry.stat()
+                current[entry.name] = [stat.st_size, stat.st_mtime_ns]
+
+    new_files = sorted(name for name in current if name not in known)
+    changed_files = [name for name in known if name in current and known[name]["stamp"] != current[name]]
+    removed_files = [name for name in known if name not in current]
+    print(f"\nFound {len(current)} JSON files: {len(new_files)} new, "
+          f"{len(changed_files)} changed, {len(removed_files)} removed")
+
+    report_settings = get_report_settings(config)
+    read = {}
+    for file in new_files + changed_files:
+        try:
+            read[file] = read_summary_entry(os.path.join(json_dir, file), report_settings)
+        except (OSError, ValueError) as e:
+            print(f"Warning: Skipping {file}: {str(e)}")
+            current.pop(file, None)
+
+    appended = index is not None and index["totals"] is not None and not changed_files and not removed_files
+    if appended and not read and not edited and os.path.exists(excel_path):
+        print("Excel summary is already up to date")
+        return
+
+    # Keep the existing row order and add new invoices at the end
+    decode_summary_index(known)
+    files = {}
+    for name in list(known) + new_files:
+        if name not in current:
+            continue
+        files[name] = {**(read[name] if name in read else known[name]), "stamp": current[name]}
+    if appended:
+        added_files = {name: files[name] for name in new_files if name in files}
+        # Only the new invoices go to the report, their totals are added to the stored ones
+        totals = write_report(config, get_json_report_tables(added_files.values()), index["totals"])
+    else:
+        totals = write_report(config, get_json_report_tables(files.values()))
+    print(f"Writing Excel file with {len(files)} rows")
+    stamp = write_summary_workbook(excel_path, [entry["row"] for entry in files.values()], totals)
+    if appended:
+        append_summary_index(index_path, added_files, stamp, totals)
+    else:
+        save_summary_index(index_path, files, stamp, totals)
+    print(f"\nExcel file successfully updated: {excel_path}")
+
+@timed_stage("excel")
+def write_store_summary_to_excel(config, rebuild=False):
+    """Bring the Excel summary up to date with the invoice store.
+
+    Each invoice records the workbook row it went to. When invoices were only
+    added, just the ones without a row are reported and their totals added to
+    the stored ones. The workbook itself is written whole from the store each
+    time; a workbook changed outside of the summary is kept next to it first.
+    """
+    excel_path = config["excel_path"]
+    flush_invoice_store(config)
+    with store_lock:
+        connection = get_store_connection(config)
+        meta = dict(connection.execute("SELECT key, value FROM StoreMeta"))
+        print(f"\nWriting Excel summary from {get_store_settings(config)['path']} to {excel_path}")
+        edited = keep_edited_workbook(excel_path, json.loads(meta.get("workbook") or "null"))
+        appended = (not rebuild and meta.get("excel_dirty") != "1" and meta.get("excel_path") == excel_path
+                    and "totals" in meta)
+
+        report_settings = get_report_settings(config)
+        new_count = connection.execute("SELECT COUNT(*) FROM Invoices WHERE excel_row IS NULL").fetchone()[0]
+        if appended and not new_count and not edited and os.path.exists(excel_path):
+            print("Excel summary is already up to date")
+            return
+        if appended:
+            # Only the new invoices go to the report, their totals are added to the stored ones
+            totals = write_report(config, get_store_report_tables(connection, report_settings, "WHERE excel_row IS NULL"),
+                                  json.loads(meta["totals"]))
+        else:
+            totals = write_report(config, get_store_report_tables(connection, report_settings))
+        invoices = list(iter_stored_summaries(connection))
+        print(f"Writing Excel file with {len(invoices)} rows")
+        stamp = write_summary_workbook(excel_path, [get_summary_row(summary) for _, summary in invoices], totals)
+        with connection:
+            connection.execute("UPDATE Invoices SET excel_row = NULL")
+            connection.executemany("UPDATE Invoices SET excel_row = ? WHERE invoice_id = ?",
+                                   [(row, invoice_id) for row, (invoice_id, _) in enumerate(invoices, start=2)])
+            connection.execute("DELETE FROM StoreMeta WHERE key = 'sheet'")
+            connection.executemany("INSERT OR REPLACE INTO StoreMeta (key, value) VALUES (?, ?)", [
+                ("workbook", json.dumps(stamp)),
+                ("totals", json.dumps(totals, ensure_ascii=False)),
+                ("excel_path", excel_path),
+                ("excel_dirty", "0"),
+            ])
+    print(f"\nExcel file successfully updated: {excel_path}")
+
+def write_store_summary_to_csv(config):
+    """Write the summary of every stored invoice to csv_path, replacing the file."""
+    csv_path = config["csv_path"]
+    flush_invoice_store(config)
+    os.makedirs(os.path.dirname(csv_path) or ".", exist_ok=True)
+    temp_path = f"{csv_path}.tmp"
+    count = 0
+    with store_lock:
+        connection = get_store_connection(config)
+        with open(temp_path, 'w', newline='', encoding='utf-8-sig') as f:
+            writer = csv.writer(f)
+            writer.writerow(SUMMARY_FIELDS)
+            for _, summary in iter_stored_summaries(connection):
+                writer.writerow(get_summary_row(summary))
+                count += 1
+    os.replace(temp_path, csv_path)
+    print(f"Wrote {count} invoice summaries to CSV file: {csv_path}")
+
+def write_summaries(config, rebuild=False):
+    if get_store_settings(config)["enabled"]:
+        write_store_summary_to_excel(config, rebuild)
+        if config.get("csv_path"):
+            write_store_summary_to_csv(config)
+    else:
+        write_invoice_summary_to_excel(config, rebuild)
+    mark_manifest_summarized(config)
@@ -0,0 +1,118 @@
+"""Manifest of the input files already processed, so a run only extracts new and changed files."""
+
+import hashlib
+import json
+import os
+import threading
+from datetime import datetime
+
+from kabalot.config import test_config
+
+DEFAULT_MANIFEST_SETTINGS = {
+    "enabled": True,
+    "path": "./state/manifest.jsonl",
+}
+
+# Manifest entries by absolute input path, loaded once per run
+_manifest = {"path": None, "entries": {}}
+_manifest_lock = threading.Lock()
+
+def get_manifest_settings(config):
+    settings = dict(DEFAULT_MANIFEST_SETTINGS)
+    settings.update(config.get("manifest", {}))
+    if test_config and test_config.get("mock_openai"):
+        # Mock extractions go to a manifest of their own, so a real run still extracts those files
+        base, ext = os.path.splitext(settings["path"])
+        settings["path"] = f"{base}.mock{ext}"
+    return settings
+
+def load_manifest(config):
+    """Return the manifest entries: what was extracted, uploaded, written and summarized for each input file.
+
+    The manifest is an append-only JSONL file where later lines win; it is
+    compacted here when most of its lines are stale.
+    """
+    manifest_path = get_manifest_settings(config)["path"]
+    with _manifest_lock:
+        if _manifest["path"] == manifest_path:
+            return _manifest["entries"]
+        entries = {}
+        line_count = 0
+        if os.path.exists(manifest_path):
+            with open(manifest_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        entries[entry["path"]] = entry
+                        line_count += 1
+        if line_count > 2 * len(entries) + 100:
+            temp_path = f"{manifest_path}.tmp"
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                for entry in entries.values():
+                    f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            os.replace(temp_path, manifest_path)
+        _manifest["path"] = manifest_path
+        _manifest["entries"] = entries
+        return entries
+
+def update_manifest_entries(config, updates):
+    """Merge the updates into their manifest entries and append the new entries to the manifest file."""
+    entries = load_manifest(config)
+    manifest_path = get_manifest_settings(config)["path"]
+    with _manifest_lock:
+        os.makedirs(os.path.dirname(manifest_path) or ".", exist_ok=True)
+        with open(manifest_path, 'a', encoding='utf-8') as f:
+            for path, fields in updates.items():
+                entry = dict(entries.get(path, {"path": path}))
+                entry.update(fields)
+                entries[path] = entry
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+def reset_manifest(config):
+    manifest_path = get_manifest_settings(config)["path"]
+    with _manifest_lock:
+        if os.path.exists(manifest_path):
+            os.remove(manifest_path)
+        _manifest["path"] = None
+        _manifest["entries"] = {}
+
+def hash_file(file_path):
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def get_previous_output_file(config, input_file):
+    if not input_file or not get_manifest_settings(config)["enabled"]:
+        return None
+    entry = load_manifest(config).get(os.path.abspath(input_file))
+    return entry.get("output_file") if entry else None
+
+def record_written_invoice(config, input_file, output_file, link):
+    if not input_file or not get_manifest_settings(config)["enabled"]:
+        return
+    size, mtime_ns = get_file_stamp(input_file)
+    now = datetime.now().isoformat(timespec='seconds')
+    update_manifest_entries(config, {os.path.abspath(input_file): {
+        "size": size,
+        "mtime_ns": mtime_ns,
+        "sha256": hash_file(input_file),
+        "extracted_at": now,
+        "dropbox_link": link,
+        "output_file": output_file,
+        "summarized_at": None,
+    }})
+
+def mark_manifest_summarized(config):
+    if not get_manifest_settings(config)["enabled"]:
+        return
+    now = datetime.now().isoformat(timespec='seconds')
+    updates = {path: {"summarized_at": now} for path, entry in load_manifest(config).items()
+               if entry.get("output_file") and not entry.get("summarized_at")}
+    if updates:
+        update_manifest_entries(config, updates)
+
+def get_file_stamp(file_path):
+    stat = os.stat(file_path)
+    return [stat.st_size, stat.st_mtime_ns]
@@ -0,0 +1,272 @@
+"""Stage timings and token usage of a run, written as a JSON report and a Prometheus textfile."""
+
+import cProfile
+import functools
+import json
+import math
+import os
+import pstats
+import threading
+import time
+from datetime import datetime
+
+from kabalot import prompt
+from kabalot.prompt import estimate_text_tokens
+
+DEFAULT_METRICS_SETTINGS = {
+    "enabled": True,
+    # A JSON report per run is written here
+    "dir": "./metrics",
+    # For the node_exporter textfile collector, rewritten after every run
+    "prometheus_path": "./metrics/kabalot.prom",
+    "profile": False,
+}
+
+METRIC_STAGES = ("render", "openai", "upload", "write", "excel")
+
+# Timings and counters of the current run, shared by all pipeline threads; None outside of a run
+run_metrics = None
+_metrics_lock = threading.Lock()
+
+def get_metrics_settings(config):
+    settings = dict(DEFAULT_METRICS_SETTINGS)
+    settings.update(config.get("metrics", {}))
+    return settings
+
+def start_run_metrics(config):
+    global run_metrics
+    if not get_metrics_settings(config)["enabled"]:
+        run_metrics = None
+        return
+    run_metrics = {
+        "run_id": datetime.now().strftime('%Y%m%d_%H%M%S_%f'),
+        "started": time.time(),
+        "start": time.perf_counter(),
+        "stages": {stage: {"calls": 0, "seconds": 0.0, "durations": [], "failures": 0, "retries": 0}
+                   for stage in METRIC_STAGES},
+        "tokens": {"prompt": 0, "completion": 0, "cached": 0},
+        "files": {},
+        "calls": [],
+    }
+
+def get_file_metrics(file_path):
+    if file_path not in run_metrics["files"]:
+        run_metrics["files"][file_path] = {
+            "pages": 0, "model_calls": 0, "retries": 0, "failures": 0,
+            "prompt_tokens": 0, "completion_tokens": 0, "cached_tokens": 0,
+            "stage_seconds": dict.fromkeys(METRIC_STAGES, 0.0),
+        }
+    return run_metrics["files"][file_path]
+
+def record_stage(stage, seconds, file_path=None, failed=False, retries=0):
+    """Record one run of a pipeline stage, for the file it worked on if there is one."""
+    if run_metrics is None:
+        return
+    with _metrics_lock:
+        stats = run_metrics["stages"][stage]
+        stats["calls"] += 1
+        stats["seconds"] += seconds
+        stats["retries"] += retries
+        if failed:
+            stats["failures"] += 1
+        else:
+            stats["durations"].append(seconds)
+        if file_path is not None:
+            file_stats = get_file_metrics(file_path)
+            file_stats["stage_seconds"][stage] += seconds
+            file_stats["retries"] += retries
+            file_stats["failures"] += failed
+            if stage == "render" and not failed:
+                file_stats["pages"] += 1
+
+def get_usage_counts(usage):
+    """Return prompt, completion and cached tokens of a usage object or of a usage dict from a batch result."""
+    if usage is None:
+        return 0, 0, 0
+    if isinstance(usage, dict):
+        details = usage.get("prompt_tokens_details") or {}
+        return usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0), details.get("cached_tokens") or 0
+    details = getattr(usage, "prompt_tokens_details", None)
+    return usage.prompt_tokens, usage.completion_tokens, (getattr(details, "cached_tokens", None) or 0)
+
+def record_model_call(file_path, page_nums, usage, seconds=None, retries=0):
+    """Record the token usage of one model call; seconds is None for batch results, which have no latency."""
+    if run_metrics is None:
+        return
+    prompt_tokens, completion_tokens, cached_tokens = get_usage_counts(usage)
+    with _metrics_lock:
+        run_metrics["tokens"]["prompt"] += prompt_tokens
+        run_metrics["tokens"]["completion"] += completion_tokens
+        run_metrics["tokens"]["cached"] += cached_tokens
+        run_metrics["calls"].append({
+            "file": file_path, "pages": page_nums, "seconds": seconds, "retries": retries,
+            "prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "cached_tokens": cached_tokens,
+        })
+        if file_path is not None:
+            file_stats = get_file_metrics(file_path)
+            file_stats["model_calls"] += 1
+            file_stats["prompt_tokens"] += prompt_tokens
+            file_stats["completion_tokens"] += completion_tokens
+            file_stats["cached_tokens"] += cached_tokens
+
+def timed_stage(stage, get_file_path=None):
+    """Decorate a function so every call is recorded as a run of the pipeline stage."""
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            file_path = get_file_path(*args, **kwargs) if get_file_path else None
+            start = time.perf_counter()
+            try:
+                result = func(*args, **kwargs)
+            except Exception:
+                record_stage(stage, time.perf_counter() - start, file_path, failed=True)
+                raise
+            record_stage(stage, time.perf_counter() - start, file_path)
+            return result
+        return wrapper
+    return decorate
+
+def get_percentile(values, fraction):
+    """Nearest-rank percentile of values, None if there are none."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return round(ordered[max(0, math.ceil(fraction * len(ordered)) - 1)], 4)
+
+def get_prompt_cache_report(calls):
+    """Share of prompt tokens served from the provider's prompt cache, and the latency of calls with and without a hit."""
+    prompt_tokens = sum(call["prompt_tokens"] for call in calls)
+    cached_tokens = sum(call["cached_tokens"] for call in calls)
+    hits = [call["seconds"] for call in calls if call["cached_tokens"] and call["seconds"] is not None]
+    misses = [call["seconds"] for call in calls if not call["cached_tokens"] and call["seconds"] is not None]
+    return {
+        "calls": len(calls),
+        "calls_with_cached_tokens": sum(1 for call in calls if call["cached_tokens"]),
+        "cached_share": round(cached_tokens / prompt_tokens, 4) if prompt_tokens else None,
+        "p50_seconds_cached": get_percentile(hits, 0.5),
+        "p50_seconds_uncached": get_percentile(misses, 0.5),
+    }
+
+def get_run_report():
+    wall_seconds = time.perf_counter() - run_metrics["start"]
+    stages = {}
+    for stage, stats in run_metrics["stages"].items():
+        durations = stats["durations"]
+        stages[stage] = {
+            "calls": stats["calls"],
+            "failures": stats["failures"],
+            "retries": stats["retries"],
+            "seconds": round(stats["seconds"], 4),
+            "p50_seconds": get_percentile(durations, 0.5),
+            "p95_seconds": get_percentile(durations, 0.95),
+            "max_seconds": round(max(durations), 4) if durations else None,
+        }
+    files = run_metrics["files"]
+    return {
+        "run_id": run_metrics["run_id"],
+        "started": datetime.fromtimestamp(run_metrics["started"]).isoformat(timespec="seconds"),
+        "wall_seconds": round(wall_seconds, 4),
+        "files": len(files),
+        "pages": sum(file_stats["pages"] for file_stats in files.values()),
+        "tokens": dict(run_metrics["tokens"]),
+        "prompt": {"version": prompt.prompt_settings["version"], "chars": len(prompt.system_prompt),
+                   "estimated_tokens": estimate_text_tokens(prompt.system_prompt)},
+        "prompt_cache": get_prompt_cache_report(run_metrics["calls"]),
+        "stages": stages,
+        "per_file": files,
+        "model_calls": run_metrics["calls"],
+    }
+
+def format_prometheus_metrics(report):
+    """Render the run report in the Prometheus text format, as gauges describing the last run."""
+    lines = []
+
+    def add(name, help_text, samples):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} gauge")
+        for labels, value in samples:
+            label_text = ",".join(f'{key}="{label}"' for key, label in labels.items())
+            lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+
+    stages = report["stages"].items()
+    add("kabalot_last_run_timestamp_seconds", "Start time of the last run.", [({}, round(run_metrics["started"], 3))])
+    add("kabalot_last_run_duration_seconds", "Wall time of the last run.", [({}, report["wall_seconds"])])
+    add("kabalot_last_run_files", "Input files processed by the last run.", [({}, report["files"])])
+    add("kabalot_last_run_pages", "Pages rendered by the last run.", [({}, report["pages"])])
+    add("kabalot_last_run_stage_calls", "Calls of each pipeline stage.",
+        [({"stage": stage}, stats["calls"]) for stage, stats in stages])
+    add("kabalot_last_run_stage_seconds_total", "Time spent in each pipeline stage, summed over workers.",
+        [({"stage": stage}, stats["seconds"]) for stage, stats in stages])
+    # Percentiles as gauges of their own, a quantile label is only valid on a summary
+    add("kabalot_last_run_stage_p50_seconds", "Median latency of each pipeline stage.",
+        [({"stage": stage}, stats["p50_seconds"]) for stage, stats in stages if stats["p50_seconds"] is not None])
+    add("kabalot_last_run_stage_p95_seconds", "95th percentile latency of each pipeline stage.",
+        [({"stage": stage}, stats["p95_seconds"]) for stage, stats in stages if stats["p95_seconds"] is not None])
+    add("kabalot_last_run_stage_failures", "Failed calls of each pipeline stage.",
+        [({"stage": stage}, stats["failures"]) for stage, stats in stages])
+    add("kabalot_last_run_stage_retries", "Retries taken by each pipeline stage.",
+        [({"stage": stage}, stats["retries"]) for stage, stats in stages])
+    add("kabalot_last_run_tokens", "Model tokens used by the last run.",
+        [({"type": token_type}, count) for token_type, count in report["tokens"].items()])
+    return "\n".join(lines) + "\n"
+
+def write_atomically(path, text):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    temp_path = f"{path}.tmp"
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(temp_path, path)
+
+def finish_run_metrics(config):
+    """Print the stage timings of the run and write its JSON report and Prometheus textfile."""
+    global run_metrics
+    if run_metrics is None:
+        return None
+    settings = get_metrics_settings(config)
+    report = get_run_report()
+    print(f"Run {report['run_id']}: {report['files']} files, {report['pages']} pages in {report['wall_seconds']:.2f}s")
+    for stage, stats in report["stages"].items():
+        if stats["calls"]:
+            p95 = f"{stats['p95_seconds']:.3f}s" if stats["p95_seconds"] is not None else "n/a"
+            print(f"  {stage}: {stats['calls']} calls, {stats['seconds']:.2f}s total, p95 {p95}, "
+                  f"{stats['failures']} failed, {stats['retries']} retries")
+    tokens = report["tokens"]
+    print(f"  tokens: {tokens['prompt']} prompt ({tokens['cached']} cached), {tokens['completion']} completion")
+    cache = report["prompt_cache"]
+    if cache["calls"]:
+        share = f"{cache['cached_share']:.0%}" if cache["cached_share"] is not None else "n/a"
+        print(f"  prompt {report['prompt']['version']} (~{report['prompt']['estimated_tokens']} tokens): "
+              f"{share} of prompt tokens cached, {cache['calls_with_cached_tokens']} of {cache['calls']} calls had a hit, "
+              f"p50 {cache['p50_seconds_cached']}s cached vs {cache['p50_seconds_uncached']}s uncached")
+
+    report_path = os.path.join(settings["dir"], f"run_{report['run_id']}.json")
+    write_atomically(report_path, json.dumps(report, ensure_ascii=False, indent=4))
+    if settings["prometheus_path"]:
+        write_atomically(settings["prometheus_path"], format_prometheus_metrics(report))
+    print(f"Run report written to {report_path}")
+    run_metrics = None
+    return report
+
+def run_measured(config, job, *args):
+    """Run job(config, *args) as one measured run, profiling it with cProfile if metrics.profile is set.
+
+    cProfile only sees the calling thread, so profile with the serial pipeline.
+    """
+    settings = get_metrics_settings(config)
+    start_run_metrics(config)
+    profiler = cProfile.Profile() if settings["profile"] else None
+    try:
+        if profiler is not None:
+            profiler.enable()
+        return job(config, *args)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            os.makedirs(settings["dir"], exist_ok=True)
+            profile_path = os.path.join(settings["dir"], f"run_{run_metrics['run_id'] if run_metrics else 'profile'}.prof")
+            profiler.dump_stats(profile_path)
+            pstats.Stats(profiler).sort_stats("cumulative").print_stats(25)
+            print(f"Profile written to {profile_path}")
+        finish_run_metrics(config)
@@ -0,0 +1,251 @@
+"""Running the extraction over input files: one at a time, as a concurrent pipeline of stages, or in batches."""
+
+import multiprocessing
+import os
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from kabalot.batch import process_files_in_batch
+from kabalot.cache import close_extraction_cache, open_extraction_cache
+from kabalot.config import get_pipeline_settings
+from kabalot.core import (apply_vehicle_plates, check_invoice_total, clear_page_checkpoint, extract_checked_page,
+    extract_from_multiple_pages, fits_document_request, get_checked_page_data, get_document_data,
+    get_document_settings, read_page_checkpoint, report_document_stats, report_page_kind_stats,
+    report_validation_stats)
+from kabalot.dedupe import filter_duplicate_files, is_duplicate_invoice
+from kabalot.excel import write_summaries
+from kabalot.manifest import get_file_stamp, get_manifest_settings, hash_file, load_manifest, update_manifest_entries
+from kabalot.metrics import record_stage
+from kabalot.prompt import load_prompt
+from kabalot.ratelimit import close_rate_limiter, open_rate_limiter
+from kabalot.render import render_file_pages
+from kabalot.store import STORE_OUTPUT_PREFIX, flush_invoice_store, stored_invoice_exists
+from kabalot.upload import report_upload_stats, upload_file_to_dropbox
+from kabalot.writer import upload_and_write_invoice, write_invoice
+
+def list_input_files(config):
+    file_paths = []
+    for input_dir in config["input_dirs"]:
+        print(f"Extracting data from files in {input_dir}")
+        for filename in os.listdir(input_dir):
+            file_paths.append(os.path.join(input_dir, filename))
+    return file_paths
+
+def select_unprocessed_files(config, file_paths):
+    """Return the input files that are new or changed since their invoice was written.
+
+    Files whose size and mtime match the manifest are skipped without reading
+    them; only files whose stat changed are hashed to tell a real change from
+    a touch or a copy.
+    """
+    if not get_manifest_settings(config)["enabled"]:
+        return file_paths
+    entries = load_manifest(config)
+    selected = []
+    restamped = {}
+    for file_path in file_paths:
+        entry = entries.get(os.path.abspath(file_path))
+        if (not os.path.isfile(file_path) or entry is None or not entry.get("output_file")
+                or not output_exists(config, entry["output_file"])):
+            selected.append(file_path)
+            continue
+        size, mtime_ns = get_file_stamp(file_path)
+        if entry["size"] == size and entry["mtime_ns"] == mtime_ns:
+            continue
+        if hash_file(file_path) == entry["sha256"]:
+            restamped[os.path.abspath(file_path)] = {"size": size, "mtime_ns": mtime_ns}
+            continue
+        selected.append(file_path)
+    if restamped:
+        update_manifest_entries(config, restamped)
+    print(f"{len(selected)} of {len(file_paths)} input files are new or changed")
+    return selected
+
+def output_exists(config, output_file):
+    if output_file.startswith(STORE_OUTPUT_PREFIX):
+        return stored_invoice_exists(config, int(output_file[len(STORE_OUTPUT_PREFIX):]))
+    return os.path.exists(output_file)
+
+def main_extract(config):
+    extract_files(config, select_unprocessed_files(config, list_input_files(config)))
+
+def extract_files(config, file_paths):
+    process_files(config, file_paths)
+    # Write Excel summary after processing all files
+    write_summaries(config)
+
+def process_files(config, file_paths):
+    """Run the files through the serial, concurrent or batch pipeline, as configured."""
+    # Known duplicates are dropped before anything is sent to OpenAI or Dropbox
+    file_paths = filter_duplicate_files(config, file_paths)
+    load_prompt(config)
+    open_extraction_cache(config)
+    open_rate_limiter(config)
+    mode = get_pipeline_settings(config)["mode"]
+    if mode == "concurrent":
+        process_files_concurrently(config, file_paths)
+    elif mode == "batch":
+        process_files_in_batch(config, file_paths)
+    else:
+        for file_path in file_paths:
+            print(f"Extracting data from {os.path.basename(file_path)}")
+            process_file(config, file_path)
+    close_extraction_cache(config)
+    close_rate_limiter(config)
+    flush_invoice_store(config)
+    report_upload_stats()
+    report_page_kind_stats()
+    report_document_stats()
+    report_validation_stats()
+
+def process_file(config, file_path):
+    print(f"Processing file: {file_path}")
+    if os.path.isfile(file_path):
+        try:
+            invoice = extract_from_multiple_pages(config, file_path)
+            upload_and_write_invoice(config, file_path, invoice)
+        except Exception as e:
+            print(f"Error processing file {file_path}: {str(e)}")
+    else:
+        print(f"Skipping {file_path}, not a file.")
+
+# Marks the end of the input for a pipeline stage worker
+_STAGE_DONE = object()
+
+def run_stage(name, workers, in_queue, out_queue, handle_job):
+    """Start worker threads that take jobs from in_queue, handle them and pass them on to out_queue.
+
+    A job that failed in an earlier stage is passed on untouched so that the
+    writer still sees every file and never waits for one that was dropped.
+    """
+    def worker():
+        while True:
+            job = in_queue.get()
+            if job is _STAGE_DONE:
+                break
+            if job["error"] is None:
+                try:
+                    handle_job(job)
+                except Exception as e:
+                    job["error"] = f"{name}: {str(e)}"
+            out_queue.put(job)
+
+    threads = [threading.Thread(target=worker, name=f"{name}-{i}", daemon=True) for i in range(workers)]
+    for thread in threads:
+        thread.start()
+    return threads
+
+def finish_stage(threads, in_queue):
+    for _ in threads:
+        in_queue.put(_STAGE_DONE)
+    for thread in threads:
+        thread.join()
+
+def get_process_pool_context():
+    """Start pool workers from a clean server process rather than by forking this one.
+
+    The stage threads and their locks already exist when a pool starts its
+    workers, and a fork could copy a lock held by another thread into the child.
+    """
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+
+def process_files_concurrently(config, file_paths):
+    """Process files through bounded queues: render -> extract -> upload -> write.
+
+    Pages are rendered in a process pool, OpenAI calls and Dropbox uploads run in
+    their own thread pools and a single writer thread writes the JSON files in
+    input order, so the output is the same as with the serial path.
+    """
+    settings = get_pipeline_settings(config)
+    print(f"Running concurrent pipeline: {settings}")
+
+    render_queue = queue.Queue(maxsize=settings["queue_size"])
+    extract_queue = queue.Queue(maxsize=settings["queue_size"])
+    upload_queue = queue.Queue(maxsize=settings["queue_size"])
+    write_queue = queue.Queue(maxsize=settings["queue_size"])
+
+    render_pool = ProcessPoolExecutor(max_workers=settings["render_workers"], mp_context=get_process_pool_context())
+    openai_pool = ThreadPoolExecutor(max_workers=settings["openai_workers"], thread_name_prefix="openai")
+
+    def render(job):
+        try:
+            job["pages"] = render_pool.submit(render_file_pages, config, job["file_path"]).result()
+        except Exception:
+            record_stage("render", 0.0, job["file_path"], failed=True)
+            raise
+        # Rendered in another process, so the render times come back with the pages
+        for page in job["pages"]:
+            record_stage("render", page["render_seconds"], job["file_path"])
+
+    document_settings = get_document_settings(config)
+
+    def extract(job):
+        file_path = job["file_path"]
+        pages = job.pop("pages")
+        if fits_document_request(document_settings, pages):
+            invoice_json = openai_pool.submit(get_document_data, config, pages).result()
+            job["invoice"] = [get_checked_page_data(config, file_path, "doc", invoice_json, pages)]
+            return
+        single_page = len(pages) == 1
+        checkpoint = {} if single_page else read_page_checkpoint(config, file_path)
+        futures = [openai_pool.submit(extract_checked_page, config, file_path, page, checkpoint, single_page)
+                   for page in pages]
+        job["invoice"] = [future.result() for future in futures]
+        check_invoice_total(config, job["invoice"])
+
+    def upload(job):
+        apply_vehicle_plates(config, job["invoice"])
+        # A copy of an invoice that is already recorded is not uploaded; the writer decides in input order
+        if is_duplicate_invoice(config, job["file_path"], job["invoice"], record=False):
+            return
+        link = upload_file_to_dropbox(config, job["file_path"])
+        job["invoice"][0]['invoice_summary']['dropbox_link'] = link
+
+    def write():
+        # Jobs finish out of order; hold them back so files are written in input order
+        pending = {}
+        next_seq = 0
+        while True:
+            job = write_queue.get()
+            if job is _STAGE_DONE:
+                break
+            pending[job["seq"]] = job
+            while next_seq in pending:
+                job = pending.pop(next_seq)
+                next_seq += 1
+                if job["error"] is not None:
+                    print(f"Error processing file {job['file_path']}: {job['error']}")
+                    continue
+                try:
+                    if is_duplicate_invoice(config, job["file_path"], job["invoice"]):
+                        clear_page_checkpoint(config, job["file_path"])
+                        continue
+                    write_invoice(config, job["invoice"])
+                except Exception as e:
+                    print(f"Error processing file {job['file_path']}: {str(e)}")
+
+    writer = threading.Thread(target=write, name="writer", daemon=True)
+    writer.start()
+    try:
+        render_threads = run_stage("render", settings["render_workers"], render_queue, extract_queue, render)
+        extract_threads = run_stage("extract", settings["openai_workers"], extract_queue, upload_queue, extract)
+        upload_threads = run_stage("upload", settings["upload_workers"], upload_queue, write_queue, upload)
+
+        for seq, file_path in enumerate(file_paths):
+            print(f"Processing file: {file_path}")
+            if os.path.isfile(file_path):
+                render_queue.put({"seq": seq, "file_path": file_path, "error": None})
+            else:
+                print(f"Skipping {file_path}, not a file.")
+                write_queue.put({"seq": seq, "file_path": file_path, "error": "not a file"})
+
+        finish_stage(render_threads, render_queue)
+        finish_stage(extract_threads, extract_queue)
+        finish_stage(upload_threads, upload_queue)
+        write_queue.put(_STAGE_DONE)
+        writer.join()
+    finally:
+        openai_pool.shutdown()
+        render_pool.shutdown()
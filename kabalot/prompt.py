@@ -0,0 +1,245 @@
+"""The system prompt and the chat requests sent to the model, and the token estimates of both."""
+
+import hashlib
+import json
+
+MODEL = "gpt-4o"
+
+# The system prompt as it was first written: the expense types, the plates and the examples are part of the text
+PROMPT_V1 = """
+    You are an OCR-like data extraction tool that extracts invoice data from PDFs.
+   
+    * extract the data in this invoice, grouping data according to theme/sub groups, and then output into JSON.
+
+    * keep the keys and values of the JSON in the original language. use native characters for the keys and values,
+    dont encode them to characters like "utf-8" or "ascii".
+
+    * The type of data you might encounter in the invoice includes but is not limited to: supplier information such as name and identity number, itemized charges, invoice information,
+    such as invoice number, taxes such as vat amount or price before vat, and total charges etc. 
+
+    * If the page contains no charge data, output an empty JSON object and don't make up any data.
+
+    * If there are blank data fields in the invoice, include them as "null" values in the JSON object.
+    
+    * If there are tables in the invoice, capture all of the rows and columns in the JSON object. 
+    Even if a column is blank, include it as a key in the JSON object with a null value.
+    
+    * If a row is blank denote missing fields with "null" values. 
+    
+    * Don't interpolate or make up data. use only the data that is in the invoice.
+
+    * Please maintain the table structure of the charges, i.e. capture all of the rows and columns in the JSON object.
+
+    * add a last group named invoice_summary which repeats the values of the following fields with the field names designated below:
+    total charge including vat: total_charge,
+    date of invoice: date,
+    invoice number: invoice_number. 
+    these values should also be included in the relevant group and repeated in this group. 
+    unlike other groups, in this group the key names should be in english as specified here.
+    
+    * make sure the total_charge is a number and not a string. 
+    make sure the total charge includes vat if it is included in the invoice.
+    it is unlikely that vat is not payed.
+    total charge that does include vat will typically but not neccessarily be tagged by "סהכ לתשלום" or "סהכ לתשלום כולל מעמ".
+    if the total charge does not include vat or the vat value is 0 then verify that the total charge was extracted correctly.
+    if vat was not specified in the invoice or was 0 then specify that in the JSON object.
+
+    * try to deduce if the type of invoice, i.e. what is it for.
+    use the following possible expense types and mark them both in english and with the code in parenthesis:
+    parking (p), gas (g), other vehicle expenses (c), clothing (b), office (m), supplies and equipment (s),
+    maintenance and repair (9), food and refreshment (f). If you can't deduce the expense type, mark it as "?". 
+    add the expense type name and the expense type code in separate fields, expense_type and type_code respectively,
+    to the invoice_summary grouped mentioned above.
+    internet services such as hosting, domain registration and chatgpt should be marked as office (m).
+
+    * car insurance should be marked as other vehicle expenses (c).
+    the total charge will be specified like the examples below:
+    'התשלום החודשי עבור כיסוי לנהג צעיר במסלול ישיר צעיר, אותו רכשת במסגרת הפוליסה הינו ₪213' -> total_charge is 213
+    'התשלום החודשי עבור כיסוי לנהג צעיר במסלול ישיר צעיר, אותו רכשת במסגרת הפוליסה הינו ₪105' -> total_charge is 105
+
+    * if the invoice is for a vehicle related purchase such as parking or gas only sum the amounts 
+    that are associated to vehicle with registration number 9160011 or 27228903 to the total charge field in the invoice_summary group.
+    
+    * add the company idenity number to the invoice_summary group as the field company_id. the identityy number typically starts with the digits 51
+    and is tagged with the hebrew word ח.פ. in the invoice. it might also be tagged with the hebrew "עוסק מורשה".
+
+    * add a field named currency to the invoice_summary group with the actual invoice currency name.
+    if the currency is not specified in the invoice then assume it is shekels (ILS) and add the field with the value ILS.
+    
+    """
+
+# The instructions that are the same for every deployment come first and the configured rules last, and
+# nothing in the system prompt changes between calls, so every request starts with the same cacheable prefix
+PROMPT_V2 = """You are an OCR-like data extraction tool that extracts invoice data from PDFs.
+
+* extract the data in this invoice, grouping data according to theme/sub groups, and then output into JSON.
+
+* keep the keys and values of the JSON in the original language. use native characters for the keys and values,
+dont encode them to characters like "utf-8" or "ascii".
+
+* The type of data you might encounter in the invoice includes but is not limited to: supplier information such as name and identity number, itemized charges, invoice information,
+such as invoice number, taxes such as vat amount or price before vat, and total charges etc.
+
+* If the page contains no charge data, output an empty JSON object and don't make up any data.
+
+* If there are blank data fields in the invoice, include them as "null" values in the JSON object.
+
+* If there are tables in the invoice, capture all of the rows and columns in the JSON object.
+Even if a column is blank, include it as a key in the JSON object with a null value.
+
+* If a row is blank denote missing fields with "null" values.
+
+* Don't interpolate or make up data. use only the data that is in the invoice.
+
+* Please maintain the table structure of the charges, i.e. capture all of the rows and columns in the JSON object.
+
+* if the charges are itemized per vehicle, add the vehicle registration number of every row to the row
+in a field named "License Plate".
+
+* add a last group named invoice_summary which repeats the values of the following fields with the field names designated below:
+total charge including vat: total_charge,
+date of invoice: date_of_invoice,
+invoice number: invoice_number.
+these values should also be included in the relevant group and repeated in this group.
+unlike other groups, in this group the key names should be in english as specified here.
+
+* make sure the total_charge is a number and not a string.
+make sure the total charge includes vat if it is included in the invoice.
+it is unlikely that vat is not payed.
+total charge that does include vat will typically but not neccessarily be tagged by "סהכ לתשלום" or "סהכ לתשלום כולל מעמ".
+if the total charge does not include vat or the vat value is 0 then verify that the total charge was extracted correctly.
+if vat was not specified in the invoice or was 0 then specify that in the JSON object.
+the total charge is the total of the whole invoice, for all of the vehicles in it.
+
+* add the company idenity number to the invoice_summary group as the field company_id. the identityy number typically starts with the digits 51
+and is tagged with the hebrew word ח.פ. in the invoice. it might also be tagged with the hebrew "עוסק מורשה".
+
+* add a field named currency to the invoice_summary group with the actual invoice currency name.
+if the currency is not specified in the invoice then assume it is shekels (ILS) and add the field with the value ILS.
+
+* try to deduce if the type of invoice, i.e. what is it for.
+use the following possible expense types and mark them both in english and with the code in parenthesis:
+{expense_types}. If you can't deduce the expense type, mark it as "?".
+add the expense type name and the expense type code in separate fields, expense_type and type_code respectively,
+to the invoice_summary grouped mentioned above.
+{expense_type_rules}
+{total_charge_examples}"""
+
+PROMPT_TEMPLATES = {"v1": PROMPT_V1, "v2": PROMPT_V2}
+
+DEFAULT_PROMPT_SETTINGS = {
+    "version": "v2",
+    "expense_types": {"p": "parking", "g": "gas", "c": "other vehicle expenses", "b": "clothing", "m": "office",
+                      "s": "supplies and equipment", "9": "maintenance and repair", "f": "food and refreshment"},
+    "expense_type_rules": [
+        "internet services such as hosting, domain registration and chatgpt should be marked as office (m).",
+        "car insurance should be marked as other vehicle expenses (c).",
+    ],
+    # Sentences the model tends to get the total charge of wrong, with the total they state
+    "total_charge_examples": [
+        ["התשלום החודשי עבור כיסוי לנהג צעיר במסלול ישיר צעיר, אותו רכשת במסגרת הפוליסה הינו ₪213", 213],
+        ["התשלום החודשי עבור כיסוי לנהג צעיר במסלול ישיר צעיר, אותו רכשת במסגרת הפוליסה הינו ₪105", 105],
+    ],
+    # Invoices of these expense types only count the charges of these license plates, filtered after extraction;
+    # no plates to count every charge
+    "vehicle_plates": ["9160011", "27228903"],
+    "vehicle_type_codes": ["p", "g", "c"],
+}
+
+def get_prompt_settings(config):
+    settings = dict(DEFAULT_PROMPT_SETTINGS)
+    settings.update(config.get("prompt", {}))
+    if settings["version"] not in PROMPT_TEMPLATES:
+        raise ValueError(f"Unknown prompt version: {settings['version']}")
+    return settings
+
+def get_system_prompt(settings):
+    """Render the system prompt of the configured version; v1 is the original text and takes no settings."""
+    if settings["version"] == "v1":
+        return PROMPT_V1
+    rules = "".join(f"\n* {rule}" for rule in settings["expense_type_rules"])
+    examples = ""
+    if settings["total_charge_examples"]:
+        examples = "\n* the total charge will be specified like the examples below:" + "".join(
+            f"\n'{text}' -> total_charge is {total}" for text, total in settings["total_charge_examples"])
+    return PROMPT_V2.format(
+        expense_types=", ".join(f"{name} ({code})" for code, name in settings["expense_types"].items()),
+        expense_type_rules=rules.lstrip("\n"), total_charge_examples=examples.lstrip("\n"))
+
+# The settings and system prompt of the run, set by load_prompt; the defaults until then
+prompt_settings = dict(DEFAULT_PROMPT_SETTINGS)
+system_prompt = get_system_prompt(prompt_settings)
+
+def load_prompt(config):
+    global prompt_settings, system_prompt
+    prompt_settings = get_prompt_settings(config)
+    system_prompt = get_system_prompt(prompt_settings)
+    # OpenAI only caches prompts from 1024 tokens up, so a shorter system prompt is never a cache hit on its own
+    print(f"System prompt {prompt_settings['version']}: {len(system_prompt)} chars, "
+          f"~{estimate_text_tokens(system_prompt)} tokens")
+
+def estimate_text_tokens(text):
+    return len(text) // 3
+
+MOCK_INVOICE = {'Details of Services Charged': [{'City': 'הרצליה', 'Zone': 'אזור התעשיה', 'License Plate': '62-728-55', 'Start Time': '15/01/2024 08:50', 'To Time': '15/01/2024 10:14', 'Minutes': '83:19', 'Charge': '8.61'}, {'City': 'רמת גן', 'Zone': 'הבימה ת\"א חניון הבימה והיכל התרבות', 'License Plate': '91-600-11', 'Start Time': '26/12/2023 14:41', 'To Time': '26/12/2023 16:06', 'Minutes': '84:46', 'Charge': '8.90'}, {'City': 'תל-אביב', 'Zone': 'מרכז העיר 17:00-חניה חופשית או חניה בתשלום באזור', 'License Plate': '91-600-11', 'Start Time': '24/01/2024 07:57', 'To Time': '24/01/2024 09:38', 'Minutes': '38:04', 'Charge': '7.87'}], 'invoice_summary': {'total_charge': '25.38', 'date_of_invoice': '3/9/24', 'invoice_number': "1234567890", 'expense_type': 'vehicle', 'type_code':'c'}}
+
+def get_mock_invoice_json():
+    return json.dumps(MOCK_INVOICE, ensure_ascii=False, indent=4)
+
+# Kept free of the page count so it stays part of the cached prefix
+DOCUMENT_INSTRUCTIONS = """extract the data in this invoice and output into JSON.
+the pages below are all pages of one invoice. output a single JSON object for the whole invoice,
+with the charges of all pages, and a single invoice_summary group whose total_charge is the total of the whole invoice."""
+
+def get_page_parts(page):
+    if page["kind"] == "text":
+        return [{"type": "text", "text": "this is the text layer of the invoice page:\n\n" + page["content"]}]
+    mime = page.get("mime", "image/png")
+    return [{"type": "image_url", "image_url": {"url": f"data:{mime};base64,{page['content']}", "detail": "high"}}]
+
+def get_page_content(page):
+    return [{"type": "text", "text": "extract the data in this invoice and output into JSON "}] + get_page_parts(page)
+
+def get_document_content(pages):
+    content = [{"type": "text", "text": DOCUMENT_INSTRUCTIONS}]
+    for page_num, page in enumerate(pages, start=1):
+        content.append({"type": "text", "text": f"page {page_num} of {len(pages)}:"})
+        content.extend(get_page_parts(page))
+    return content
+
+def get_extraction_request(page):
+    """Build the chat completions request for one page, shared by the direct and the batch calls."""
+    return get_chat_request(get_page_content(page))
+
+def get_document_request(pages):
+    """Build one chat completions request for all pages of an invoice."""
+    return get_chat_request(get_document_content(pages))
+
+def get_chat_request(user_content):
+    return {
+        "model": MODEL,
+        "response_format": { "type": "json_object" },
+        "messages": [
+            {
+                "role": "system",
+                "content": system_prompt
+            },
+            {
+                "role": "user",
+                "content": user_content
+            }
+        ],
+        "temperature": 0.0,
+    }
+
+def get_prompt_fingerprint():
+    return hashlib.sha256(f"{MODEL}\0{system_prompt}".encode("utf-8")).hexdigest()
+
+# Used for pages without an estimate: a portrait page resized to 768x2048 is 8 tiles
+DEFAULT_IMAGE_TOKENS = 85 + 170 * 8
+
+def estimate_page_tokens(page):
+    if page["kind"] == "text":
+        # Hebrew text takes more tokens per character than English, err on the high side
+        return len(page["content"]) // 2 + 1
+    return page.get("estimated_image_tokens", DEFAULT_IMAGE_TOKENS)
@@ -0,0 +1,255 @@
+"""The OpenAI client and the chat completion calls of the extract workers, kept under the account limits and retried."""
+
+import json
+import os
+import random
+import re
+import threading
+import time
+from datetime import datetime
+
+# APITimeoutError is an APIConnectionError
+from openai import APIConnectionError, InternalServerError, OpenAI, RateLimitError
+
+from kabalot import prompt
+from kabalot.metrics import get_usage_counts, record_model_call, record_stage
+from kabalot.prompt import estimate_page_tokens, estimate_text_tokens
+
+# The OpenAI client, created by get_openai_client on the first model call
+client = None
+_client_lock = threading.Lock()
+
+def get_openai_client():
+    global client
+    with _client_lock:
+        if client is None:
+            client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+    return client
+
+DEFAULT_RATE_LIMIT_SETTINGS = {
+    "enabled": True,
+    # Requests and tokens per minute of our OpenAI quota for the model
+    "rpm": 500,
+    "tpm": 30000,
+    # Completion tokens reserved per request until the real usage is known
+    "completion_tokens": 1000,
+    "max_retries": 6,
+    "base_delay_sec": 1.0,
+    "max_delay_sec": 60.0,
+    "dead_letter_path": "./state/dead_letter.jsonl",
+}
+
+class RateLimiter:
+    """Token buckets for requests and tokens per minute, shared by all OpenAI workers.
+
+    Both buckets refill continuously at their limit per minute. The limits and
+    levels follow the x-ratelimit headers of the responses, and a 429 pauses
+    every worker instead of just the one that got it.
+    """
+
+    def __init__(self, rpm, tpm):
+        self.condition = threading.Condition()
+        self.configured = (rpm, tpm)
+        self.limits = {"requests": rpm, "tokens": tpm}
+        self.levels = dict(self.limits)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.stats = {"throttled": 0, "waits": 0, "wait_seconds": 0.0}
+
+    def refill(self):
+        now = time.monotonic()
+        elapsed = now - self.updated
+        self.updated = now
+        for kind, limit in self.limits.items():
+            self.levels[kind] = min(limit, self.levels[kind] + elapsed * limit / 60)
+
+    def try_acquire(self, tokens):
+        """Take one request and the tokens if both fit; otherwise return how long to wait for them."""
+        with self.condition:
+            self.refill()
+            paused = self.paused_until - time.monotonic()
+            if paused > 0:
+                return paused
+            # A request larger than the whole bucket only has to wait for a full bucket
+            tokens = min(tokens, self.limits["tokens"])
+            missing_requests = 1 - self.levels["requests"]
+            missing_tokens = tokens - self.levels["tokens"]
+            if missing_requests <= 0 and missing_tokens <= 0:
+                self.levels["requests"] -= 1
+                self.levels["tokens"] -= tokens
+                return 0.0
+            return max(missing_requests * 60 / self.limits["requests"], missing_tokens * 60 / self.limits["tokens"])
+
+    def acquire(self, tokens):
+        waited = 0.0
+        while True:
+            wait = self.try_acquire(tokens)
+            if not wait:
+                break
+            with self.condition:
+                self.condition.wait(wait)
+            waited += wait
+        if waited:
+            with self.condition:
+                self.stats["waits"] += 1
+                self.stats["wait_seconds"] += waited
+
+    def settle(self, reserved, used):
+        """Give back what a request reserved beyond what it used, or take the difference if it used more."""
+        with self.condition:
+            self.levels["tokens"] = min(self.limits["tokens"], self.levels["tokens"] + reserved - used)
+            self.condition.notify_all()
+
+    def pause(self, seconds):
+        with self.condition:
+            self.stats["throttled"] += 1
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def update_from_headers(self, headers):
+        with self.condition:
+            self.refill()
+            for kind in self.limits:
+                limit = headers.get(f"x-ratelimit-limit-{kind}")
+                if limit and int(limit) > 0:
+                    self.limits[kind] = int(limit)
+                remaining = headers.get(f"x-ratelimit-remaining-{kind}")
+                if remaining is not None:
+                    self.levels[kind] = min(self.levels[kind], int(remaining))
+
+def parse_reset_duration(value):
+    """Parse an x-ratelimit-reset value like '20ms', '1s' or '6m0s' into seconds."""
+    units = {"h": 3600, "m": 60, "s": 1, "ms": 0.001}
+    return sum(float(number) * units[unit] for number, unit in re.findall(r"(\d+(?:\.\d+)?)(ms|h|m|s)", value or ""))
+
+def format_reset_duration(seconds):
+    return f"{int(seconds * 1000)}ms" if seconds < 1 else f"{seconds:.3f}s"
+
+def get_retry_after(error):
+    """Seconds the server asked us to wait before retrying, None if it didn't say."""
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    if headers.get("retry-after-ms"):
+        return float(headers["retry-after-ms"]) / 1000
+    if headers.get("retry-after"):
+        try:
+            return float(headers["retry-after"])
+        except ValueError:
+            return None
+    resets = [parse_reset_duration(headers.get(f"x-ratelimit-reset-{kind}")) for kind in ("requests", "tokens")]
+    return max(resets) or None
+
+def get_backoff_delay(attempt):
+    """Exponential backoff with jitter, so workers that failed together don't retry together."""
+    delay = min(rate_limit_settings["max_delay_sec"], rate_limit_settings["base_delay_sec"] * 2 ** (attempt - 1))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+def estimate_request_tokens(pages):
+    return (sum(estimate_page_tokens(page) for page in pages) + estimate_text_tokens(prompt.system_prompt)
+            + rate_limit_settings["completion_tokens"])
+
+# Set up by open_rate_limiter for the run; the limiter is kept between runs so watch mode can't burst past the quota
+rate_limit_settings = dict(DEFAULT_RATE_LIMIT_SETTINGS)
+rate_limiter = None
+# Pages whose model call still failed after the last retry
+dead_letters = []
+_dead_letter_lock = threading.Lock()
+
+def get_rate_limit_settings(config):
+    settings = dict(DEFAULT_RATE_LIMIT_SETTINGS)
+    settings.update(config.get("rate_limit", {}))
+    return settings
+
+def open_rate_limiter(config):
+    global rate_limit_settings, rate_limiter
+    rate_limit_settings = get_rate_limit_settings(config)
+    if not rate_limit_settings["enabled"]:
+        rate_limiter = None
+    elif rate_limiter is None or rate_limiter.configured != (rate_limit_settings["rpm"], rate_limit_settings["tpm"]):
+        rate_limiter = RateLimiter(rate_limit_settings["rpm"], rate_limit_settings["tpm"])
+
+def add_dead_letter(pages, error):
+    with _dead_letter_lock:
+        dead_letters.append({"file": pages[0].get("file_path"), "pages": [page.get("page_num") for page in pages],
+                             "error": f"{type(error).__name__}: {str(error)}",
+                             "failed_at": datetime.now().isoformat(timespec='seconds')})
+
+def close_rate_limiter(config):
+    """Report the throttling of the run and append the pages that still failed to the dead-letter list."""
+    if rate_limiter is not None and (rate_limiter.stats["throttled"] or rate_limiter.stats["waits"]):
+        print(f"Rate limiter: {rate_limiter.stats['throttled']} throttled responses, {rate_limiter.stats['waits']} "
+              f"requests waited {rate_limiter.stats['wait_seconds']:.1f}s for quota")
+        rate_limiter.stats.update({"throttled": 0, "waits": 0, "wait_seconds": 0.0})
+    with _dead_letter_lock:
+        failed = list(dead_letters)
+        dead_letters.clear()
+    if not failed:
+        return
+    dead_letter_path = get_rate_limit_settings(config)["dead_letter_path"]
+    os.makedirs(os.path.dirname(dead_letter_path) or ".", exist_ok=True)
+    with open(dead_letter_path, 'a', encoding='utf-8') as f:
+        for entry in failed:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+    print(f"{len(failed)} model calls failed after retrying, listed in {dead_letter_path}")
+    for entry in failed:
+        print(f"  {entry['file']} pages {entry['pages']}: {entry['error']}")
+
+def create_chat_completion(request, pages):
+    """Send a chat completions request through the rate limiter, retrying throttled and failed calls.
+
+    The SDK's own retries are turned off so that every retry goes through the
+    limiter and the backoff here. A request that still fails goes to the
+    dead-letter list. Latency, token usage and retries are recorded for the
+    pages the request covers.
+    """
+    # APITimeoutError is an APIConnectionError
+    file_path = pages[0].get("file_path")
+    page_nums = [page.get("page_num") for page in pages]
+    reserved = estimate_request_tokens(pages)
+    start = time.perf_counter()
+    attempt = 0
+    while True:
+        if rate_limiter is not None:
+            rate_limiter.acquire(reserved)
+        try:
+            raw_response = get_openai_client().with_options(max_retries=0).chat.completions.with_raw_response.create(**request)
+            response = raw_response.parse()
+            break
+        except (RateLimitError, APIConnectionError, InternalServerError) as e:
+            retry_after = get_retry_after(e)
+            throttled = rate_limiter is not None and isinstance(e, RateLimitError)
+            if rate_limiter is not None:
+                # A failed request isn't counted against the quota
+                rate_limiter.settle(reserved, 0)
+                if throttled:
+                    rate_limiter.update_from_headers(e.response.headers)
+            attempt += 1
+            delay = max(retry_after or 0, get_backoff_delay(attempt))
+            if throttled:
+                # Every thread waits out the pause in acquire, this one included
+                rate_limiter.pause(delay)
+            if attempt > rate_limit_settings["max_retries"]:
+                record_stage("openai", time.perf_counter() - start, file_path, failed=True, retries=attempt - 1)
+                add_dead_letter(pages, e)
+                raise
+            print(f"OpenAI call for {file_path} failed ({type(e).__name__}), retry {attempt} in {delay:.1f}s")
+            if not throttled:
+                time.sleep(delay)
+        except Exception as e:
+            if rate_limiter is not None:
+                rate_limiter.settle(reserved, 0)
+            record_stage("openai", time.perf_counter() - start, file_path, failed=True, retries=attempt)
+            add_dead_letter(pages, e)
+            raise
+    seconds = time.perf_counter() - start
+    if rate_limiter is not None:
+        rate_limiter.update_from_headers(raw_response.headers)
+        prompt_tokens, completion_tokens, _ = get_usage_counts(response.usage) if response.usage else (reserved, 0, 0)
+        rate_limiter.settle(reserved, prompt_tokens + completion_tokens)
+    retries = attempt + (getattr(raw_response, "retries_taken", 0) or 0)
+    record_stage("openai", seconds, file_path, retries=retries)
+    record_model_call(file_path, page_nums, response.usage, seconds, retries)
+    prompt_tokens, completion_tokens, cached_tokens = get_usage_counts(response.usage)
+    print(f"Model call: {prompt_tokens} prompt tokens ({cached_tokens} cached), {completion_tokens} completion, {seconds:.2f}s")
+    return response, seconds
@@ -0,0 +1,297 @@
+"""Rendering input files to the pages sent to the model: PDF text layers, page images and their preprocessing.
+
+Process pool workers import this module to render pages, so it does not import OpenAI or Dropbox.
+"""
+
+import base64
+import io
+import itertools
+import math
+import mimetypes
+import os
+import re
+import time
+from io import BytesIO
+
+import fitz  # PyMuPDF
+from PIL import Image, ImageOps
+
+from kabalot.metrics import record_stage
+
+@staticmethod
+def encode_image(image_path):
+    with open(image_path, "rb") as image_file:
+        return base64.b64encode(image_file.read()).decode("utf-8")
+
+DEFAULT_RENDER_SETTINGS = {
+    "dpi": 72,
+    "colorspace": "rgb",
+}
+
+# PyMuPDF colorspace names
+RENDER_COLORSPACES = {
+    "rgb": "RGB",
+    "gray": "GRAY",
+}
+
+def get_render_settings(config):
+    settings = dict(DEFAULT_RENDER_SETTINGS)
+    settings.update(config.get("render", {}))
+    if settings["colorspace"] not in RENDER_COLORSPACES:
+        raise ValueError(f"Unsupported render colorspace: {settings['colorspace']}")
+    return settings
+
+DEFAULT_TEXT_LAYER_SETTINGS = {
+    "enabled": False,
+    # Pages with fewer non-space characters than this are sent as images
+    "min_chars": 200,
+    # Scans often carry an invisible OCR text layer over a page-sized image
+    "max_image_coverage": 0.5,
+    "tables": True,
+}
+
+def get_text_layer_settings(config):
+    settings = dict(DEFAULT_TEXT_LAYER_SETTINGS)
+    settings.update(config.get("text_layer", {}))
+    return settings
+
+IMAGE_TILE_SIZE = 512
+
+def get_model_image_size(width, height):
+    """Return the size the model scales a high detail image to: within 2048px, shortest side at most 768px."""
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    return width * scale, height * scale
+
+def estimate_image_tokens(width, height):
+    """Estimate the prompt tokens of a high detail image: 85 plus 170 per 512px tile after the model's resizing."""
+    width, height = get_model_image_size(width, height)
+    tiles = math.ceil(width / IMAGE_TILE_SIZE) * math.ceil(height / IMAGE_TILE_SIZE)
+    return 85 + 170 * tiles
+
+DEFAULT_PREPROCESS_SETTINGS = {
+    "enabled": False,
+    "crop": True,
+    # Pixels darker than this (0-255 grayscale) count as content when cropping margins
+    "crop_threshold": 200,
+    "crop_margin": 16,
+    # Shrink a little further when an edge spills this many pixels into an extra tile row or column
+    "tile_snap_px": 96,
+    "grayscale": False,
+    "autocontrast": False,
+    "jpeg_quality": 85,
+}
+
+def get_preprocess_settings(config):
+    settings = dict(DEFAULT_PREPROCESS_SETTINGS)
+    settings.update(config.get("preprocess", {}))
+    return settings
+
+def crop_to_content(img, threshold, margin):
+    """Crop the blank margins around the content of a page or photo."""
+    mask = img.convert("L").point(lambda value: 255 if value < threshold else 0)
+    bbox = mask.getbbox()
+    if bbox is None:
+        return img
+    left, top, right, bottom = bbox
+    bbox = (max(0, left - margin), max(0, top - margin), min(img.width, right + margin), min(img.height, bottom + margin))
+    return img.crop(bbox) if bbox != (0, 0, img.width, img.height) else img
+
+def get_tile_grid_size(width, height, tile_snap_px):
+    """Return the size to send an image at: what the model would scale it to, snapped down onto the tile grid."""
+    width, height = get_model_image_size(width, height)
+    scale = 1.0
+    for side in (width, height):
+        tiles = math.ceil(side / IMAGE_TILE_SIZE)
+        if tiles > 1 and side - (tiles - 1) * IMAGE_TILE_SIZE <= tile_snap_px:
+            scale = min(scale, (tiles - 1) * IMAGE_TILE_SIZE / side)
+    return max(1, int(width * scale)), max(1, int(height * scale))
+
+def preprocess_image(img, settings):
+    """Turn a page or photo upright, crop its margins and scale it to the model's tile grid."""
+    img = ImageOps.exif_transpose(img)
+    if img.mode not in ("RGB", "L"):
+        img = img.convert("RGB")
+    if settings["crop"]:
+        img = crop_to_content(img, settings["crop_threshold"], settings["crop_margin"])
+    if settings["grayscale"]:
+        img = img.convert("L")
+    if settings["autocontrast"]:
+        img = ImageOps.autocontrast(img, cutoff=1)
+    size = get_tile_grid_size(img.width, img.height, settings["tile_snap_px"])
+    if size != img.size:
+        img = img.resize(size, Image.LANCZOS)
+    return img
+
+def encode_image_page(img, image_format, settings):
+    """Encode an image as an image page dict with its MIME type and estimated token cost."""
+    if image_format == "JPEG" and img.mode not in ("RGB", "L"):
+        img = img.convert("RGB")
+    buffered = BytesIO()
+    if image_format == "JPEG":
+        img.save(buffered, format="JPEG", quality=settings["jpeg_quality"])
+    else:
+        img.save(buffered, format=image_format)
+    return {"kind": "image", "content": base64.b64encode(buffered.getvalue()).decode("utf-8"),
+            "mime": Image.MIME[image_format], "estimated_image_tokens": estimate_image_tokens(img.width, img.height)}
+
+# Hebrew letters, which make a page read right to left
+RTL_LETTERS_RE = re.compile(r"[\u0590-\u05ff]")
+LATIN_LETTERS_RE = re.compile(r"[A-Za-z]")
+
+def get_line_text(line):
+    """Join the spans of a text line in the order they are stored, which is reading order, even for Hebrew."""
+    text = ""
+    previous = None
+    for span in line["spans"]:
+        # Table cells can end up in one line with nothing but a gap between them
+        if previous is not None and text and not text[-1].isspace() and not span["text"][:1].isspace():
+            gap = max(span["bbox"][0] - previous[2], previous[0] - span["bbox"][2])
+            if gap > 0.2 * span["size"]:
+                text += " "
+        text += span["text"]
+        previous = span["bbox"]
+    return text
+
+def get_page_reading_text(page):
+    """Return the text of a page row by row from the top, in reading order.
+
+    PyMuPDF's sort=True orders the words of a line from left to right, which
+    reverses Hebrew. Here only whole lines are moved: into rows from the top
+    down, and right to left within a row on a page that is mostly Hebrew.
+    """
+    lines = [(line["bbox"], get_line_text(line))
+             for block in page.get_text("dict", flags=fitz.TEXTFLAGS_TEXT)["blocks"] for line in block["lines"]]
+    rows = []
+    for bbox, text in sorted((line for line in lines if line[1].strip()), key=lambda line: line[0][1]):
+        if rows and (bbox[1] + bbox[3]) / 2 < rows[-1][0]:
+            rows[-1][1].append((bbox, text))
+        else:
+            rows.append((bbox[3], [(bbox, text)]))
+    page_text = "".join(text for _, text in lines)
+    rtl = len(RTL_LETTERS_RE.findall(page_text)) > len(LATIN_LETTERS_RE.findall(page_text))
+    return "\n".join("  ".join(text.strip() for _, text in sorted(row, key=lambda line: -line[0][2] if rtl else line[0][0]))
+                     for _, row in rows)
+
+def get_page_text(page, settings):
+    """Return the text layer of a born-digital page, or None if the page should go as an image."""
+    text = get_page_reading_text(page)
+    chars = len("".join(text.split()))
+    if chars < settings["min_chars"]:
+        return None
+    # Fonts without a unicode mapping come out as replacement characters
+    if text.count("\ufffd") > 0.05 * chars:
+        return None
+    page_area = abs(page.rect)
+    image_area = sum(abs(fitz.Rect(image["bbox"]) & page.rect) for image in page.get_image_info())
+    if page_area and image_area / page_area > settings["max_image_coverage"]:
+        return None
+
+    if settings["tables"]:
+        tables = [table.to_markdown() for table in page.find_tables().tables]
+        if tables:
+            text += "\n\nTables on this page:\n\n" + "\n\n".join(tables)
+    return text
+
+def iter_pdf_document_pages(pdf_path, render_settings, text_settings, preprocess_settings=DEFAULT_PREPROCESS_SETTINGS):
+    """Yield the pages of a PDF as page dicts, sending pages with a usable text layer as text."""
+    with fitz.open(pdf_path) as pdf_document:
+        for page_num, page in enumerate(pdf_document):
+            zoom = render_settings["dpi"] / 72
+            estimated_tokens = estimate_image_tokens(page.rect.width * zoom, page.rect.height * zoom)
+            text = get_page_text(page, text_settings) if text_settings["enabled"] else None
+            if text is not None:
+                print(f"Page {page_num + 1}: text layer ({len(text)} chars)")
+                yield {"kind": "text", "content": text, "estimated_image_tokens": estimated_tokens}
+                continue
+            if preprocess_settings["enabled"]:
+                img = preprocess_image(render_pdf_page_image(page, render_settings["dpi"], render_settings["colorspace"]),
+                                       preprocess_settings)
+                image_page = encode_image_page(img, "PNG", preprocess_settings)
+            else:
+                image_page = {"kind": "image", "content": render_pdf_page(page, render_settings["dpi"], render_settings["colorspace"]),
+                              "mime": "image/png", "estimated_image_tokens": estimated_tokens}
+            print(f"Page {page_num + 1}: image (~{image_page['estimated_image_tokens']} tokens)")
+            yield image_page
+
+def render_pdf_page(page, dpi, colorspace):
+    pix = page.get_pixmap(dpi=dpi, colorspace=RENDER_COLORSPACES[colorspace])
+    return base64.b64encode(pix.tobytes("png")).decode("utf-8")
+
+def render_pdf_page_image(page, dpi, colorspace):
+    """Render a page straight into a PIL image, skipping the PNG round trip."""
+    pix = page.get_pixmap(dpi=dpi, colorspace=RENDER_COLORSPACES[colorspace], alpha=False)
+    return Image.frombytes("L" if pix.n == 1 else "RGB", (pix.width, pix.height), pix.samples)
+
+def iter_pdf_pages(pdf_path, dpi=72, colorspace="rgb"):
+    """Yield the pages of a PDF as base64 PNGs, rendering one page at a time in memory."""
+    with fitz.open(pdf_path) as pdf_document:
+        for page in pdf_document:
+            yield render_pdf_page(page, dpi, colorspace)
+
+# Previous renderer, kept as the baseline for benchmark_renderers
+def pdf_to_base64_images(pdf_path):
+    #Handles PDFs with multiple pages
+    pdf_document = fitz.open(pdf_path)
+    base64_images = []
+    temp_image_paths = []
+
+    total_pages = len(pdf_document)
+
+    for page_num in range(total_pages):
+        page = pdf_document.load_page(page_num)
+        pix = page.get_pixmap()
+        img = Image.open(io.BytesIO(pix.tobytes()))
+        # Include the pid so render workers running in parallel don't overwrite each other's pages
+        temp_image_path = f"temp_page_{os.getpid()}_{page_num}.png"
+        img.save(temp_image_path, format="PNG")
+        temp_image_paths.append(temp_image_path)
+        base64_image = encode_image(temp_image_path)
+        base64_images.append(base64_image)
+
+    for temp_image_path in temp_image_paths:
+        os.remove(temp_image_path)
+
+    return base64_images
+
+def iter_jpg_pages(jpg_file_path, preprocess_settings=DEFAULT_PREPROCESS_SETTINGS):
+    """Yield a phone photo or scan as a single JPEG image page."""
+    with Image.open(jpg_file_path) as img:
+        if preprocess_settings["enabled"]:
+            original_tokens = estimate_image_tokens(*ImageOps.exif_transpose(img).size)
+            img = preprocess_image(img, preprocess_settings)
+            print(f"Image: {original_tokens} -> {estimate_image_tokens(img.width, img.height)} estimated tokens")
+        yield encode_image_page(img, "JPEG", preprocess_settings)
+
+def iter_file_pages(config, file_path):
+    mime_type, _ = mimetypes.guess_type(file_path)
+    print(f"File type: {mime_type}")
+    if mime_type == 'application/pdf':
+        pages = iter_pdf_document_pages(file_path, get_render_settings(config), get_text_layer_settings(config),
+                                        get_preprocess_settings(config))
+    elif mime_type == 'image/jpeg':
+        pages = iter_jpg_pages(file_path, get_preprocess_settings(config))
+    else:
+        record_stage("render", 0.0, file_path, failed=True)
+        raise ValueError(f"Unsupported file type: {mime_type}")
+    yield from measure_rendered_pages(file_path, pages)
+
+def measure_rendered_pages(file_path, pages):
+    """Pass the pages through, tagging each with its file, page number and render time."""
+    for page_num in itertools.count():
+        start = time.perf_counter()
+        try:
+            page = next(pages)
+        except StopIteration:
+            return
+        except Exception:
+            record_stage("render", time.perf_counter() - start, file_path, failed=True)
+            raise
+        page.update(file_path=file_path, page_num=page_num, render_seconds=time.perf_counter() - start)
+        record_stage("render", page["render_seconds"], file_path)
+        yield page
+
+def render_file_pages(config, file_path):
+    # The concurrent pipeline needs all pages of a file back from the render process at once
+    return list(iter_file_pages(config, file_path))
@@ -0,0 +1,319 @@
+"""Summary line items and totals, and the columnar report export.
+
+pyarrow is optional: without it the totals are computed in Python and the export is skipped.
+"""
+
+import json
+import os
+import re
+from datetime import datetime
+
+DEFAULT_REPORT_SETTINGS = {
+    # Write the summaries, line items and totals as columnar files for analysis outside of Excel (needs pyarrow)
+    "enabled": True,
+    "dir": "./reports",
+    # parquet, or arrow for Arrow IPC (Feather) files
+    "format": "parquet",
+    # Line item keys holding the license plate and the charge, in the order they are tried
+    "plate_keys": ["License Plate", "מספר רכב", "מס' רכב", "מספר רישוי", "רכב"],
+    "charge_keys": ["Charge", "סכום", "חיוב", "מחיר", "לתשלום"],
+}
+
+SUMMARY_FIELDS = ['type_code','total_charge','dropbox_link', 'date_of_invoice','currency','company_id', 'invoice_number',  'input_file',  'expense_type']
+
+# Line item fields kept in the summary index, so the report doesn't have to read every JSON file again
+SUMMARY_ITEM_FIELDS = ["page_num", "section", "license_plate", "charge"]
+
+REPORT_COLUMNS = {
+    "invoices": {"input_file": "string", "invoice_number": "string", "company_id": "string", "type_code": "string",
+                 "date_of_invoice": "string", "month": "string", "currency": "string", "total_charge": "float64"},
+    "line_items": {"input_file": "string", "company_id": "string", "month": "string", "currency": "string",
+                   "page_num": "int64", "section": "string", "license_plate": "string", "charge": "float64"},
+    "totals": {"group": "string", "key": "string", "currency": "string", "count": "int64", "total": "float64"},
+}
+
+# (group, sheet title, key label, table, key column, amount column); every group is also split by currency
+REPORT_GROUPS = [
+    ("type_code", "By expense type", "Expense Type Code", "invoices", "type_code", "total_charge"),
+    ("month", "By month", "Month", "invoices", "month", "total_charge"),
+    ("company_id", "By company", "Company ID", "invoices", "company_id", "total_charge"),
+    ("license_plate", "By license plate", "License Plate", "line_items", "license_plate", "charge"),
+    ("currency", "By currency", None, "invoices", None, "total_charge"),
+]
+
+CURRENCY_CODES = {"₪": "ILS", "ש\"ח": "ILS", "שח": "ILS", "NIS": "ILS", "$": "USD", "€": "EUR", "£": "GBP"}
+CURRENCY_NAMES = {"שקל": "ILS", "SHEKEL": "ILS", "DOLLAR": "USD", "דולר": "USD", "EURO": "EUR", "אירו": "EUR"}
+
+def get_report_settings(config):
+    settings = dict(DEFAULT_REPORT_SETTINGS)
+    settings.update(config.get("report", {}))
+    return settings
+
+def parse_invoice_date(value):
+    """ISO date of an invoice date in the formats the model returns, day first as on Israeli invoices; None if unreadable."""
+    text = str(value or '').strip()
+    match = re.match(r"(\d{4})[-/.](\d{1,2})[-/.](\d{1,2})", text)
+    if match:
+        year, month, day = match.groups()
+    else:
+        match = re.match(r"(\d{1,2})[-/.](\d{1,2})[-/.](\d{4}|\d{2})\b", text)
+        if not match:
+            return None
+        day, month, year = match.groups()
+        if len(year) == 2:
+            year = f"20{year}"
+    try:
+        return datetime(int(year), int(month), int(day)).date().isoformat()
+    except ValueError:
+        return None
+
+def get_charge_value(value):
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        return float(str(value).replace(',', ''))
+    except ValueError:
+        return None
+
+def get_currency_code(value):
+    """Normalize a currency the way the model writes it ('₪', 'ILS', 'shekels') to its ISO code.
+
+    Invoices without a currency are in shekels, as the prompt tells the model to assume.
+    """
+    text = str(value or '').strip().upper()
+    if not text:
+        return "ILS"
+    if text in CURRENCY_CODES:
+        return CURRENCY_CODES[text]
+    code = re.search(r"\b[A-Z]{3}\b", text)
+    if code:
+        return CURRENCY_CODES.get(code.group(), code.group())
+    for name, code in CURRENCY_NAMES.items():
+        if name in text:
+            return code
+    return text
+
+def get_invoice_month(value):
+    """'YYYY-MM' of an invoice date in the formats the model returns; None if unreadable."""
+    invoice_date = parse_invoice_date(value)
+    return invoice_date[:7] if invoice_date else None
+
+def get_plate_number(value):
+    """License plate digits only, so '91-600-11' and '9160011' are the same car."""
+    digits = re.sub(r"\D", "", str(value or ''))
+    return digits or None
+
+def get_line_item_value(item, keys):
+    for key in keys:
+        value = item.get(key)
+        if value not in (None, ''):
+            return value
+    return None
+
+def iter_line_items(pages):
+    """Every list of records on a page, like 'Details of Services Charged', is a section of line items."""
+    for page_num, page in enumerate(pages):
+        if not isinstance(page, dict):
+            continue
+        for section, items in page.items():
+            if isinstance(items, list):
+                for item in items:
+                    if isinstance(item, dict):
+                        yield page_num, section, item
+
+def get_summary_item(page_num, section, item, settings):
+    """The SUMMARY_ITEM_FIELDS of a line item, None if it has neither a license plate nor a charge."""
+    plate = get_plate_number(get_line_item_value(item, settings["plate_keys"]))
+    charge = get_line_item_value(item, settings["charge_keys"])
+    charge = get_charge_value(charge) if charge is not None else None
+    if not plate and charge is None:
+        return None
+    return [page_num, section, plate, charge]
+
+def get_summary_items(pages, settings):
+    items = [get_summary_item(page_num, section, item, settings) for page_num, section, item in iter_line_items(pages)]
+    return [item for item in items if item is not None]
+
+def get_empty_report_tables():
+    return {name: {column: [] for column in columns} for name, columns in REPORT_COLUMNS.items() if name != "totals"}
+
+def add_report_invoice(tables, fields, items):
+    """Add one invoice, given as a dict of its summary fields, and its SUMMARY_ITEM_FIELDS line items to the tables."""
+    charge = fields.get('total_charge')
+    invoice = {
+        "input_file": fields.get('input_file') or None,
+        "invoice_number": str(fields['invoice_number']) if fields.get('invoice_number') not in (None, '') else None,
+        "company_id": str(fields['company_id']) if fields.get('company_id') not in (None, '') else None,
+        "type_code": fields.get('type_code') or None,
+        "date_of_invoice": str(fields['date_of_invoice']) if fields.get('date_of_invoice') else None,
+        "month": get_invoice_month(fields.get('date_of_invoice')),
+        "currency": get_currency_code(fields.get('currency')),
+        "total_charge": get_charge_value(charge) if charge not in (None, '') else None,
+    }
+    for column, value in invoice.items():
+        tables["invoices"][column].append(value)
+    for item in items:
+        line_item = dict(zip(SUMMARY_ITEM_FIELDS, item))
+        for column in REPORT_COLUMNS["line_items"]:
+            tables["line_items"][column].append(line_item[column] if column in line_item else invoice[column])
+
+def get_json_report_tables(entries):
+    """Report tables from summary index entries, without reading the JSON files again."""
+    tables = get_empty_report_tables()
+    for entry in entries:
+        add_report_invoice(tables, dict(zip(SUMMARY_FIELDS, entry["row"])), entry["items"])
+    return tables
+
+def get_store_report_tables(connection, settings, where=""):
+    """Report tables of the stored invoices, or of those matching a WHERE clause on Invoices."""
+    tables = get_empty_report_tables()
+    items = {}
+    for invoice_id, page_num, section, data in connection.execute(
+            "SELECT invoice_id, page_num, section, data FROM LineItems "
+            f"WHERE invoice_id IN (SELECT invoice_id FROM Invoices {where}) ORDER BY line_item_id"):
+        item = get_summary_item(page_num, section, json.loads(data), settings)
+        if item is not None:
+            items.setdefault(invoice_id, []).append(item)
+    columns = ["input_file", "invoice_number", "company_id", "type_code", "date_of_invoice", "currency", "total_charge"]
+    for invoice_id, *values in connection.execute(
+            f"SELECT invoice_id, {', '.join(columns)} FROM Invoices {where} ORDER BY invoice_id"):
+        add_report_invoice(tables, dict(zip(columns, values)), items.get(invoice_id, []))
+    return tables
+
+def get_report_totals_with_arrow(tables, pa, pc):
+    totals = []
+    arrow_tables = {name: pa.table(columns, schema=get_arrow_schema(pa, name)) for name, columns in tables.items()}
+    for group, _, _, table_name, key, amount in REPORT_GROUPS:
+        table = arrow_tables[table_name]
+        if table_name == "line_items":
+            # Only line items that have the key, a charge without a plate says nothing about a car
+            table = table.filter(pc.is_valid(table[key]))
+        keys = [key, "currency"] if key else ["currency"]
+        grouped = table.group_by(keys).aggregate([(amount, "sum"), (amount, "count", pc.CountOptions(mode="all"))])
+        grouped = grouped.to_pydict()
+        for num, currency in enumerate(grouped["currency"]):
+            totals.append((group, grouped[key][num] if key else None, currency,
+                           grouped[f"{amount}_count"][num], grouped[f"{amount}_sum"][num]))
+    return totals
+
+def get_report_totals_in_python(tables):
+    totals = []
+    for group, _, _, table_name, key, amount in REPORT_GROUPS:
+        columns = tables[table_name]
+        sums = {}
+        for num, currency in enumerate(columns["currency"]):
+            value = columns[key][num] if key else None
+            if table_name == "line_items" and value is None:
+                continue
+            count, total = sums.get((value, currency), (0, None))
+            charge = columns[amount][num]
+            sums[(value, currency)] = (count + 1, total if charge is None else (total or 0) + charge)
+        totals.extend((group, value, currency, count, total) for (value, currency), (count, total) in sums.items())
+    return totals
+
+def get_arrow_schema(pa, name):
+    return pa.schema([(column, getattr(pa, kind)()) for column, kind in REPORT_COLUMNS[name].items()])
+
+def get_report_totals(tables):
+    """Invoice count and total per type_code, month, company_id, license plate and currency, each split by currency.
+
+    Returns (group, key, currency, count, total) tuples in REPORT_GROUPS order.
+    The group-bys run vectorized in Arrow when pyarrow is installed.
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.compute as pc
+        totals = get_report_totals_with_arrow(tables, pa, pc)
+    except ImportError:
+        totals = get_report_totals_in_python(tables)
+    return sort_report_totals(totals)
+
+def sort_report_totals(totals):
+    groups = [group[0] for group in REPORT_GROUPS]
+    return sorted(((group, key, currency, count, round(total, 2) if total is not None else None)
+                   for group, key, currency, count, total in totals),
+                  key=lambda total: (groups.index(total[0]), total[1] is None, total[1] or '', total[2] or ''))
+
+def merge_report_totals(totals, new_totals):
+    """Add the totals of new invoices to the totals so far; counts and sums add up, so nothing is computed again."""
+    merged = {}
+    for group, key, currency, count, total in list(totals) + list(new_totals):
+        old_count, old_total = merged.get((group, key, currency), (0, None))
+        merged[(group, key, currency)] = (old_count + count,
+                                          old_total if total is None else (old_total or 0) + total)
+    return sort_report_totals((group, key, currency, count, total)
+                              for (group, key, currency), (count, total) in merged.items())
+
+def get_totals_sheet_rows(totals):
+    """The Pivot Summary sheet: one block of literal totals per REPORT_GROUPS group."""
+    rows = []
+    for group, title, label, _, _, _ in REPORT_GROUPS:
+        if rows:
+            rows.append([])
+        rows.append([title])
+        rows.append(([label] if label else []) + ["Currency", "Count", "Total Amount Paid"])
+        for total_group, key, currency, count, total in totals:
+            if total_group == group:
+                rows.append(([key] if label else []) + [currency, count, total])
+    return rows
+
+def write_report(config, tables, previous_totals=None):
+    """Compute the totals of the report tables and export the tables and totals as Parquet or Arrow files.
+
+    Each table is a directory of part files. Without previous_totals the
+    tables hold every invoice and replace all parts; with them they hold only
+    the new invoices, which go to a new part, and their totals are merged into
+    previous_totals. Returns the totals for the Pivot Summary sheet.
+    """
+    totals = get_report_totals(tables)
+    if previous_totals is not None:
+        totals = merge_report_totals(previous_totals, totals)
+    settings = get_report_settings(config)
+    if not settings["enabled"]:
+        return totals
+    # Loaded only here, it is the slowest import of the summary
+    try:
+        import pyarrow as pa
+        import pyarrow.feather
+        import pyarrow.parquet
+    except ImportError:
+        print("pyarrow is not installed, skipping the columnar report export")
+        return totals
+
+    if settings["format"] not in ("parquet", "arrow"):
+        raise ValueError(f"Unsupported report format: {settings['format']}")
+    os.makedirs(settings["dir"], exist_ok=True)
+    columns = dict(tables, totals={column: [total[num] for total in totals]
+                                   for num, column in enumerate(REPORT_COLUMNS["totals"])})
+    for name, table_columns in columns.items():
+        table = pa.table(table_columns, schema=get_arrow_schema(pa, name))
+        if name == "totals":
+            path = os.path.join(settings["dir"], f"{name}.{settings['format']}")
+        else:
+            path = get_report_part_path(settings, name, append=previous_totals is not None)
+        # Dataset readers skip files starting with a dot, so a part is never read half written
+        temp_path = os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.tmp")
+        if settings["format"] == "parquet":
+            pyarrow.parquet.write_table(table, temp_path)
+        else:
+            pyarrow.feather.write_feather(table, temp_path)
+        os.replace(temp_path, path)
+    print(f"Wrote {len(tables['invoices']['input_file'])} invoices, {len(tables['line_items']['input_file'])} line items "
+          f"and {len(totals)} totals to {settings['dir']}")
+    return totals
+
+def get_report_part_path(settings, name, append):
+    """Path for the next part file of a report table; a full export first removes the parts written so far."""
+    table_dir = os.path.join(settings["dir"], name)
+    os.makedirs(table_dir, exist_ok=True)
+    parts = [part for part in os.listdir(table_dir) if part.startswith("part-")]
+    if not append:
+        for part in parts:
+            os.remove(os.path.join(table_dir, part))
+        parts = []
+        # Written as a single file before the tables were split into parts
+        old_path = os.path.join(settings["dir"], f"{name}.{settings['format']}")
+        if os.path.exists(old_path):
+            os.remove(old_path)
+    number = max((int(part.split("-")[1].split(".")[0]) for part in parts), default=-1) + 1
+    return os.path.join(table_dir, f"part-{number:05d}.{settings['format']}")
@@ -0,0 +1,223 @@
+"""The SQLite invoice store of the extracted invoices."""
+
+import json
+import os
+import sqlite3
+import threading
+from datetime import datetime
+
+from kabalot.manifest import record_written_invoice
+from kabalot.report import get_charge_value, iter_line_items
+
+DEFAULT_STORE_SETTINGS = {
+    "enabled": False,
+    "path": "./state/invoices.db",
+    # Invoices are inserted in one transaction per batch
+    "batch_size": 50,
+}
+
+# Manifest output_file of an invoice kept in the store instead of a JSON file
+STORE_OUTPUT_PREFIX = "store:"
+
+STORE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS Invoices (
+    invoice_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    input_file TEXT UNIQUE,
+    source_file TEXT,
+    company_id TEXT,
+    invoice_number TEXT,
+    date_of_invoice TEXT,
+    type_code TEXT,
+    expense_type TEXT,
+    currency TEXT,
+    total_charge REAL,
+    dropbox_link TEXT,
+    summary TEXT,
+    excel_row INTEGER,
+    written_at TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_invoices_company_number ON Invoices(company_id, invoice_number);
+CREATE INDEX IF NOT EXISTS idx_invoices_date ON Invoices(date_of_invoice);
+CREATE INDEX IF NOT EXISTS idx_invoices_type_code ON Invoices(type_code);
+CREATE INDEX IF NOT EXISTS idx_invoices_source_file ON Invoices(source_file);
+
+CREATE TABLE IF NOT EXISTS Pages (
+    page_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    invoice_id INTEGER NOT NULL REFERENCES Invoices(invoice_id) ON DELETE CASCADE,
+    page_num INTEGER,
+    data TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_pages_invoice ON Pages(invoice_id, page_num);
+
+CREATE TABLE IF NOT EXISTS LineItems (
+    line_item_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    invoice_id INTEGER NOT NULL REFERENCES Invoices(invoice_id) ON DELETE CASCADE,
+    page_num INTEGER,
+    section TEXT,
+    data TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_line_items_invoice ON LineItems(invoice_id);
+
+CREATE TABLE IF NOT EXISTS Summaries (
+    invoice_id INTEGER NOT NULL REFERENCES Invoices(invoice_id) ON DELETE CASCADE,
+    field TEXT,
+    value TEXT,
+    PRIMARY KEY (invoice_id, field)
+);
+CREATE INDEX IF NOT EXISTS idx_summaries_field_value ON Summaries(field, value);
+
+CREATE TABLE IF NOT EXISTS StoreMeta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+# One connection per store path, shared by the writer threads; invoices wait in pending until a batch is full
+_store = {"path": None, "connection": None, "pending": []}
+# Held while using the shared connection
+store_lock = threading.RLock()
+
+def get_store_settings(config):
+    settings = dict(DEFAULT_STORE_SETTINGS)
+    settings.update(config.get("store", {}))
+    return settings
+
+def get_store_connection(config):
+    path = get_store_settings(config)["path"]
+    with store_lock:
+        if _store["path"] != path:
+            if _store["connection"] is not None:
+                _store["connection"].close()
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            connection = sqlite3.connect(path, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute("PRAGMA foreign_keys=ON")
+            connection.executescript(STORE_SCHEMA)
+            _store.update({"path": path, "connection": connection, "pending": []})
+        return _store["connection"]
+
+def insert_invoice(cursor, invoice, source_file=None):
+    """Insert one invoice with its pages, line items and summary fields; returns its invoice_id.
+
+    An invoice for an input file that is already in the store replaces it.
+    """
+    pages = invoice if isinstance(invoice, list) else [invoice]
+    summary = pages[0].get('invoice_summary', {}) if pages else {}
+    input_file = summary.get('input_file')
+    if input_file:
+        replaced = cursor.execute("SELECT excel_row FROM Invoices WHERE input_file = ?", (input_file,)).fetchone()
+        if replaced is not None:
+            cursor.execute("DELETE FROM Invoices WHERE input_file = ?", (input_file,))
+            if replaced[0] is not None:
+                # The row is gone from the middle of the workbook
+                cursor.execute("INSERT OR REPLACE INTO StoreMeta (key, value) VALUES ('excel_dirty', '1')")
+
+    cursor.execute("""
+    INSERT INTO Invoices (input_file, source_file, company_id, invoice_number, date_of_invoice, type_code,
+                          expense_type, currency, total_charge, dropbox_link, summary, written_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, (
+        input_file,
+        source_file,
+        summary.get('company_id'),
+        summary.get('invoice_number'),
+        summary.get('date_of_invoice'),
+        summary.get('type_code'),
+        summary.get('expense_type'),
+        summary.get('currency'),
+        get_charge_value(summary.get('total_charge', '')),
+        summary.get('dropbox_link'),
+        json.dumps(summary, ensure_ascii=False),
+        datetime.now().isoformat(timespec='seconds'),
+    ))
+    invoice_id = cursor.lastrowid
+
+    cursor.executemany("INSERT INTO Pages (invoice_id, page_num, data) VALUES (?, ?, ?)",
+                       [(invoice_id, page_num, json.dumps(page, ensure_ascii=False)) for page_num, page in enumerate(pages)])
+    cursor.executemany("INSERT INTO LineItems (invoice_id, page_num, section, data) VALUES (?, ?, ?, ?)",
+                       [(invoice_id, page_num, section, json.dumps(item, ensure_ascii=False))
+                        for page_num, section, item in iter_line_items(pages)])
+    cursor.executemany("INSERT INTO Summaries (invoice_id, field, value) VALUES (?, ?, ?)",
+                       [(invoice_id, field, value if isinstance(value, str) else json.dumps(value, ensure_ascii=False))
+                        for field, value in summary.items()])
+    return invoice_id
+
+def queue_invoice_for_store(config, invoice):
+    with store_lock:
+        get_store_connection(config)
+        _store["pending"].append(invoice)
+        full = len(_store["pending"]) >= get_store_settings(config)["batch_size"]
+    if full:
+        flush_invoice_store(config)
+
+def flush_invoice_store(config):
+    """Insert the pending invoices in one transaction, then record them in the manifest.
+
+    The manifest is only updated after the commit, so invoices lost to a crash
+    before it are extracted again on the next run.
+    """
+    if not get_store_settings(config)["enabled"]:
+        return
+    with store_lock:
+        pending, _store["pending"] = _store["pending"], []
+        if not pending:
+            return
+        connection = get_store_connection(config)
+        try:
+            with connection:
+                cursor = connection.cursor()
+                invoice_ids = [insert_invoice(cursor, invoice) for invoice in pending]
+        except sqlite3.Error as e:
+            print(f"Error storing {len(pending)} invoices: {str(e)}")
+            raise
+    for invoice, invoice_id in zip(pending, invoice_ids):
+        summary = invoice[0].get('invoice_summary', {})
+        record_written_invoice(config, summary.get('input_file'), f"{STORE_OUTPUT_PREFIX}{invoice_id}",
+                               summary.get('dropbox_link'))
+    print(f"Stored {len(pending)} invoices in {_store['path']}")
+
+def stored_invoice_exists(config, invoice_id):
+    with store_lock:
+        connection = get_store_connection(config)
+        return connection.execute("SELECT 1 FROM Invoices WHERE invoice_id = ?", (invoice_id,)).fetchone() is not None
+
+def import_json_invoices(config, json_dir):
+    """Import a directory of invoice JSON files into the store, skipping files imported before."""
+    settings = get_store_settings(config)
+    with store_lock:
+        connection = get_store_connection(config)
+        imported = {row[0] for row in connection.execute("SELECT source_file FROM Invoices WHERE source_file IS NOT NULL")}
+    file_paths = sorted(os.path.abspath(os.path.join(json_dir, name)) for name in os.listdir(json_dir) if name.endswith(".json"))
+    file_paths = [file_path for file_path in file_paths if file_path not in imported]
+    print(f"Importing {len(file_paths)} JSON invoices from {json_dir}")
+
+    count = 0
+    for start in range(0, len(file_paths), settings["batch_size"]):
+        invoices = []
+        for file_path in file_paths[start:start + settings["batch_size"]]:
+            try:
+                with open(file_path, 'r', encoding='utf-8') as f:
+                    invoices.append((file_path, json.load(f)))
+            except (OSError, ValueError) as e:
+                print(f"Warning: Skipping {file_path}: {str(e)}")
+        with store_lock, connection:
+            cursor = connection.cursor()
+            for file_path, invoice in invoices:
+                insert_invoice(cursor, invoice, source_file=file_path)
+        count += len(invoices)
+    print(f"Imported {count} invoices into {settings['path']}")
+    return count
+
+def clear_invoice_store(config):
+    with store_lock:
+        connection = get_store_connection(config)
+        _store["pending"] = []
+        with connection:
+            connection.execute("DELETE FROM Invoices")
+            connection.execute("INSERT OR REPLACE INTO StoreMeta (key, value) VALUES ('excel_dirty', '1')")
+    print(f"Cleared {get_store_settings(config)['path']}")
+
+def iter_stored_summaries(connection, where=""):
+    for invoice_id, summary in connection.execute(f"SELECT invoice_id, summary FROM Invoices {where} ORDER BY invoice_id"):
+        yield invoice_id, json.loads(summary)
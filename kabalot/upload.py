@@ -0,0 +1,166 @@
+"""Uploading receipts to Dropbox and getting their shared links."""
+
+import hashlib
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import dropbox
+
+from kabalot.config import DEFAULT_CREDS_FILE, get_dropbox_token, get_pipeline_settings, test_config
+from kabalot.metrics import timed_stage
+
+DEFAULT_DROPBOX_SETTINGS = {
+    # Files larger than one chunk are uploaded through an upload session
+    "chunk_size_mb": 8,
+    "max_connections": 8,
+}
+
+# Dropbox computes content_hash over 4 MB blocks
+DROPBOX_HASH_BLOCK_SIZE = 4 * 1024 * 1024
+
+# One Dropbox client shared by all upload workers
+_dropbox = {"client": None}
+_dropbox_lock = threading.Lock()
+
+# Upload counters for the throughput report, shared by all upload workers
+upload_stats = {"uploaded": 0, "skipped": 0, "bytes": 0, "started": None, "finished": None}
+
+class LocalDropbox(dropbox.Dropbox):
+    """Dropbox client that sends its requests to a local fake server over plain http."""
+
+    def __init__(self, api_url, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._api_url = api_url.rstrip('/')
+
+    def _get_route_url(self, hostname, route_name):
+        return f"{self._api_url}/2/{route_name}"
+
+def get_dropbox_settings(config):
+    settings = dict(DEFAULT_DROPBOX_SETTINGS)
+    settings.update(config.get("dropbox", {}))
+    return settings
+
+def get_dropbox_client(config):
+    with _dropbox_lock:
+        if _dropbox["client"] is None:
+            settings = get_dropbox_settings(config)
+            # Read the token only once something is actually uploaded
+            if not config.get("dropbox_access_token"):
+                config["dropbox_access_token"] = get_dropbox_token(config.get("creds_file", DEFAULT_CREDS_FILE))
+            session = dropbox.create_session(max_connections=settings["max_connections"])
+            if config.get("dropbox_api_url"):
+                _dropbox["client"] = LocalDropbox(config["dropbox_api_url"], config["dropbox_access_token"], session=session)
+            else:
+                _dropbox["client"] = dropbox.Dropbox(config["dropbox_access_token"], session=session)
+            print("Initialized Dropbox client.")
+        return _dropbox["client"]
+
+def dropbox_content_hash(file_path):
+    """Compute the Dropbox content_hash of a local file: sha256 over the sha256 of each 4 MB block."""
+    block_hashes = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(DROPBOX_HASH_BLOCK_SIZE), b''):
+            block_hashes.update(hashlib.sha256(block).digest())
+    return block_hashes.hexdigest()
+
+def get_remote_content_hash(dbx, dropbox_file_path):
+    try:
+        metadata = dbx.files_get_metadata(dropbox_file_path)
+    except dropbox.exceptions.ApiError as e:
+        if e.error.is_path() and e.error.get_path().is_not_found():
+            return None
+        raise
+    return getattr(metadata, "content_hash", None)
+
+def upload_file_contents(dbx, file_path, dropbox_file_path, chunk_size):
+    mode = dropbox.files.WriteMode.overwrite
+    file_size = os.path.getsize(file_path)
+    with open(file_path, 'rb') as f:
+        if file_size <= chunk_size:
+            dbx.files_upload(f.read(), dropbox_file_path, mode=mode)
+            return
+        session = dbx.files_upload_session_start(f.read(chunk_size))
+        cursor = dropbox.files.UploadSessionCursor(session_id=session.session_id, offset=f.tell())
+        while file_size - f.tell() > chunk_size:
+            dbx.files_upload_session_append_v2(f.read(chunk_size), cursor)
+            cursor.offset = f.tell()
+        commit = dropbox.files.CommitInfo(path=dropbox_file_path, mode=mode)
+        dbx.files_upload_session_finish(f.read(chunk_size), cursor, commit)
+
+def get_shared_link(dbx, dropbox_file_path):
+    """Return the file's existing shared link, creating one only if there is none yet."""
+    links = dbx.sharing_list_shared_links(path=dropbox_file_path, direct_only=True).links
+    if links:
+        return links[0].url
+    try:
+        return dbx.sharing_create_shared_link_with_settings(dropbox_file_path).url
+    except dropbox.exceptions.ApiError as e:
+        # Someone else created the link between listing and creating it
+        if not e.error.is_shared_link_already_exists():
+            raise
+    return dbx.sharing_list_shared_links(path=dropbox_file_path, direct_only=True).links[0].url
+
+def count_upload(event, size=0):
+    now = time.perf_counter()
+    with _dropbox_lock:
+        upload_stats[event] += 1
+        upload_stats["bytes"] += size
+        upload_stats["finished"] = now
+
+@timed_stage("upload", lambda config, filename: filename)
+def upload_file_to_dropbox(config, filename):
+    if test_config and test_config.get("mock_dropbox"):
+        print("Skipping Dropbox upload (mocked)")
+        return "https://dropbox.com/link"
+
+    if not os.path.isfile(filename):
+        print(f"Skipping {filename}, not a file.")
+        return None
+
+    dbx = get_dropbox_client(config)
+    with _dropbox_lock:
+        if upload_stats["started"] is None:
+            upload_stats["started"] = time.perf_counter()
+    dropbox_file_path = os.path.join(config["dropbox_path"], filename)
+
+    # Skip the upload when Dropbox already holds the same content
+    if get_remote_content_hash(dbx, dropbox_file_path) == dropbox_content_hash(filename):
+        print(f"{filename} is unchanged in Dropbox:{dropbox_file_path}, skipping upload")
+        count_upload("skipped")
+    else:
+        print(f'Attempting to upload {filename} to Dropbox:{dropbox_file_path}...')
+        chunk_size = int(get_dropbox_settings(config)["chunk_size_mb"] * 1024 * 1024)
+        upload_file_contents(dbx, filename, dropbox_file_path, chunk_size)
+        count_upload("uploaded", os.path.getsize(filename))
+        print(f"Uploaded {filename} to {dropbox_file_path}")
+
+    file_link = get_shared_link(dbx, dropbox_file_path)
+    print(f"Shared link for {filename}: {file_link}")
+    return file_link
+
+def upload_files_to_dropbox(config, file_paths):
+    """Upload files in parallel on the shared client and return their shared links by path."""
+    workers = get_pipeline_settings(config)["upload_workers"]
+    links = {}
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="upload") as pool:
+        futures = {pool.submit(upload_file_to_dropbox, config, file_path): file_path for file_path in file_paths}
+        for future, file_path in futures.items():
+            try:
+                links[file_path] = future.result()
+            except Exception as e:
+                print(f"Error uploading file {file_path}: {str(e)}")
+    report_upload_stats()
+    return links
+
+def report_upload_stats():
+    if upload_stats["started"] is None:
+        return
+    seconds = upload_stats["finished"] - upload_stats["started"]
+    megabytes = upload_stats["bytes"] / (1024 * 1024)
+    throughput = f"{megabytes / seconds:.2f} MB/s" if seconds > 0 else "n/a"
+    print(f"Dropbox: {upload_stats['uploaded']} uploaded ({megabytes:.1f} MB, {throughput}), "
+          f"{upload_stats['skipped']} unchanged")
+    with _dropbox_lock:
+        upload_stats.update({"uploaded": 0, "skipped": 0, "bytes": 0, "started": None, "finished": None})
@@ -0,0 +1,50 @@
+"""Watching the input directories and extracting receipts as they land."""
+
+import os
+import time
+
+from kabalot.manifest import get_file_stamp, get_manifest_settings
+from kabalot.metrics import run_measured
+from kabalot.pipeline import extract_files, select_unprocessed_files
+
+DEFAULT_WATCH_SETTINGS = {
+    "poll_interval_sec": 2,
+}
+
+def get_watch_settings(config):
+    settings = dict(DEFAULT_WATCH_SETTINGS)
+    settings.update(config.get("watch", {}))
+    return settings
+
+def watch_input_dirs(config):
+    """Process receipts as they land in input_dirs until interrupted with Ctrl+C.
+
+    A file is picked up once its size and mtime stayed the same for one poll,
+    so files that are still being copied in are left alone.
+    """
+    if not get_manifest_settings(config)["enabled"]:
+        raise ValueError("Watch mode needs the manifest to be enabled")
+    settings = get_watch_settings(config)
+    print(f"Watching {config['input_dirs']} for new receipts, press Ctrl+C to stop")
+    seen = {}
+    # Stamps of files already tried, so a file that fails isn't retried until it changes
+    attempted = {}
+    try:
+        while True:
+            stamps = {}
+            for input_dir in config["input_dirs"]:
+                with os.scandir(input_dir) as entries:
+                    for entry in entries:
+                        if entry.is_file():
+                            stamps[entry.path] = get_file_stamp(entry.path)
+            ready = [path for path, stamp in stamps.items() if seen.get(path) == stamp and attempted.get(path) != stamp]
+            seen = stamps
+            if ready:
+                new_files = select_unprocessed_files(config, ready)
+                for path in ready:
+                    attempted[path] = stamps[path]
+                if new_files:
+                    run_measured(config, extract_files, new_files)
+            time.sleep(settings["poll_interval_sec"])
+    except KeyboardInterrupt:
+        print("Stopped watching input directories")
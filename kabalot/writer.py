@@ -0,0 +1,114 @@
+"""Writing extracted invoices: the JSON files in output_dir, the invoice store and the manifest."""
+
+import csv
+import json
+import os
+import re
+from datetime import datetime
+
+from kabalot.core import apply_vehicle_plates, clear_page_checkpoint
+from kabalot.dedupe import is_duplicate_invoice
+from kabalot.manifest import get_previous_output_file, record_written_invoice
+from kabalot.metrics import timed_stage
+from kabalot.store import get_store_settings, queue_invoice_for_store
+from kabalot.upload import upload_file_to_dropbox
+
+def get_safe_filename(invoice_data):
+    # Handle both single invoice and list of invoices
+    invoice_dict = invoice_data[0] if isinstance(invoice_data, list) else invoice_data
+    
+    # Safely navigate nested structure
+    invoice_summary = invoice_dict.get('invoice_summary', {})
+    invoice_number = invoice_summary.get('invoice_number')
+    
+    if not invoice_number:
+        # Fallback to timestamp if no invoice number
+        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S_%f')[:-3]
+        invoice_number = f"invoice_{timestamp}"
+    
+    # Sanitize filename
+    safe_name = re.sub(r'[<>:"/\\|?*]', '_', str(invoice_number))
+    return f"{safe_name}.json"
+
+@timed_stage("write", lambda config, invoice: invoice[0].get('invoice_summary', {}).get('input_file'))
+def write_invoice(config, invoice):
+    # The invoice is complete, an interrupted run no longer needs its checked pages
+    clear_page_checkpoint(config, invoice[0].get('invoice_summary', {}).get('input_file'))
+    if get_store_settings(config)["enabled"]:
+        queue_invoice_for_store(config, invoice)
+        return None
+    output_dir = config["output_dir"]
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    summary = invoice[0].get('invoice_summary', {})
+    # A changed input file replaces the invoice written for its previous version
+    previous_output = get_previous_output_file(config, summary.get('input_file'))
+    if (previous_output and os.path.exists(previous_output)
+            and os.path.dirname(os.path.abspath(previous_output)) == os.path.abspath(output_dir)):
+        os.remove(previous_output)
+        print(f"Removed {previous_output}, replaced by the changed input file")
+    filename = get_safe_filename(invoice)
+    output_file = os.path.join(output_dir, filename)
+    # Check if the file already exists and add a numerical postfix if necessary
+    base_name, ext = os.path.splitext(output_file)
+    counter = 1
+    while os.path.exists(output_file):
+        output_file = f"{base_name}_{counter}{ext}"
+        counter += 1
+
+    with open(output_file, 'w', encoding='utf-8') as f:
+        json.dump(invoice, f, ensure_ascii=False, indent=4)
+    print(f"Data written to {output_file}")
+    record_written_invoice(config, summary.get('input_file'), output_file, summary.get('dropbox_link'))
+    return output_file
+
+def write_invoice_summary_to_csv(config, invoice_data):
+    """Write invoice summary data to CSV file."""
+
+    csv_path = config["csv_path"]
+    file_exists = os.path.isfile(csv_path)
+    
+    try:
+        # Get the invoice summary from the first page if it's a list
+        invoice_dict = invoice_data[0] if isinstance(invoice_data, list) else invoice_data
+        summary = invoice_dict.get('invoice_summary', {})
+        
+        # Define the fields we want to write
+        fields = ['invoice_number', 'date_of_invoice', 'total_charge', 
+                 'expense_type', 'input_file', 'dropbox_link', 'type_code']
+        
+        # Create directory if it doesn't exist
+        os.makedirs(os.path.dirname(csv_path), exist_ok=True)
+        
+        # Open file in append mode if exists, write mode if new
+        mode = 'a' if file_exists else 'w'
+        print(f"Writing to CSV file: {csv_path}")
+        
+        with open(csv_path, mode, newline='', encoding='utf-8-sig') as f:
+            writer = csv.DictWriter(f, fieldnames=fields)
+            
+            # Write header only if file is new
+            if not file_exists:
+                writer.writeheader()
+                print("Wrote CSV header")
+            
+            # Extract only the fields we want
+            row = {field: summary.get(field, '') for field in fields}
+            writer.writerow(row)
+            print(f"Wrote invoice summary for invoice {row.get('invoice_number', 'unknown')}")
+            
+    except Exception as e:
+        print(f"Error writing to CSV: {str(e)}")
+        raise
+
+def upload_and_write_invoice(config, file_path, invoice):
+    apply_vehicle_plates(config, invoice)
+    if is_duplicate_invoice(config, file_path, invoice):
+        # Not written, so nothing else clears the checked pages of the copy
+        clear_page_checkpoint(config, file_path)
+        return
+    link = upload_file_to_dropbox(config, file_path)
+    print(invoice)
+    invoice[0]['invoice_summary']['dropbox_link'] = link
+    print(invoice)
+    write_invoice(config, invoice)